@@ -35,6 +35,8 @@ import operator
 import pprint
 import time
 import logging
+import hashlib
+import threading
 
 import numpy as np
 
@@ -48,6 +50,9 @@ import smap.util as util
 import smap.sjson as json
 from smap.operators import null
 from smap.core import SmapException
+from smap.archiver.idcache import IdCache
+from smap.archiver.rdbpool import ReadingdbPool
+from smap.archiver import rdbwrite
 import settings
 
 def makeErrback(request_):
@@ -63,64 +68,165 @@ def makeErrback(request_):
 def escape_string(s):
     return psycopg2.extensions.QuotedString(s).getquoted()
 
-class ReadingdbPool:
-    def __init__(self):
-        self.pool = []
-        reactor.addSystemEventTrigger('after', 'shutdown', 
-                                      self.shutdown)
-
-    def shutdown(self):
-        log.msg("ReadingdbPool shutting down:", len(self.pool))
-        map(settings.rdb.db_close, self.pool)
-
-    def get(self):
-        # print "connect", settings.READINGDB_HOST, settings.READINGDB_PORT
-        return settings.rdb.db_open(host=settings.conf['readingdb']['host'],
-                           port=settings.conf['readingdb']['port'])
-            
-    def put(self, conn):
-        # self.pool.append(conn)
-        settings.rdb.db_close(conn)
-
-try:
-    if hasattr(settings, "rdb"):
-        rdb_pool
-    else:
-        log.err("failed to find readingdb module")
-except NameError:
-    rdb_pool = ReadingdbPool()
+# opened on first use rather than at import, since the plugin imports
+# this before it loads --conf
+rdb_pool = None
+rdb_pool_lock = threading.Lock()
+
+def get_rdb_pool():
+    """The pool of readingdb connections, opened with the settings
+    in effect the first time it is asked for"""
+    global rdb_pool
+    with rdb_pool_lock:
+        if rdb_pool == None:
+            if not hasattr(settings, "rdb"):
+                log.err("failed to find readingdb module")
+            # one connection for each thread which might be using one
+            rdb_pool = ReadingdbPool(getattr(settings, 'rdb', None),
+                                     settings.conf['readingdb']['host'],
+                                     settings.conf['readingdb']['port'],
+                                     max_connections=settings.conf['threadpool size'])
+        return rdb_pool
+
+def shutdown_rdb_pool():
+    if rdb_pool != None:
+        rdb_pool.shutdown()
+reactor.addSystemEventTrigger('after', 'shutdown', shutdown_rdb_pool)
+
+# uuid -> (subscription id, stream id) for streams we have inserted
+# into, so known streams don't need add_stream
+stream_ids = IdCache()
+# uuid -> digest of the metadata we last applied to that stream
+metadata_digests = IdCache()
+# subscription id -> util.MetadataCache of the collections it has sent
+metadata_caches = IdCache()
+
+def configure_caches():
+    """Size the caches from settings.conf.  This module is imported
+    before --conf is loaded, so this is called again once it is."""
+    for cache, size in [(stream_ids, 'streams'),
+                        (metadata_digests, 'streams'),
+                        (metadata_caches, 'keys')]:
+        cache.max_size = settings.conf['cache'][size]
+        cache.ttl = settings.conf['cache']['ttl']
+configure_caches()
+
+def invalidate_streams(uuids):
+    """Forget what we know about streams changed or deleted by
+    something other than an insert"""
+    for uid in uuids:
+        stream_ids.invalidate(uid)
+        metadata_digests.invalidate(uid)
+    metadata_caches.clear()
+
+def check_report(obj):
+    """Check that a report is something we can store, so that bad
+    reports are refused instead of being queued.  Raises a
+    SmapException (400) if it isn't."""
+    if not isinstance(obj, dict):
+        raise SmapException("Invalid report\n", 400)
+    for path, ts in obj.iteritems():
+        if not util.is_string(path) or not isinstance(ts, dict):
+            raise SmapException("Invalid timeseries: %s\n" % str(path), 400)
+        if not 'Readings' in ts:
+            continue
+        if not util.is_string(ts.get('uuid')):
+            raise SmapException("Missing uuid: %s\n" % path, 400)
+        try:
+            rdbwrite.to_rows(ts['Readings'], 1)
+        except (TypeError, ValueError, IndexError):
+            raise SmapException("Invalid readings: %s\n" % path, 400)
 
 class SmapMetadata:
+    """Apply the metadata in reports to their streams.
+
+    A digest of the metadata last applied to each stream is kept, so
+    that streams whose metadata hasn't changed (the usual case, since
+    sources send their metadata with every report) are skipped, and
+    the rest are updated with one statement.
+
+    The collections each source sends are kept in a
+    :py:class:`~smap.util.MetadataCache`, so the metadata streams
+    inherit from them is flattened once, rather than pushed down into
+    every stream of every report.  Sources only send a collection
+    again once it has changed.
+    """
     def __init__(self, db):
-        self.db = db    
+        self.db = db
+        self.updated = 0
+        self.skipped = 0
+
+    @staticmethod
+    def cache(subid):
+        cache = metadata_caches.get(subid)
+        if cache == None:
+            cache = util.MetadataCache()
+            metadata_caches.put(subid, cache)
+        return cache
+
+    def collections(self, subid, obj):
+        """Record the collections in a report, and remove them from it
+        so only its timeseries are left"""
+        cache = self.cache(subid)
+        for path in [p for p, v in obj.iteritems() if not 'Readings' in v]:
+            cache.update(path, obj.pop(path))
+
+    @staticmethod
+    def digest(path, pairs):
+        return hashlib.sha1(repr((path, sorted(pairs)))).digest()
 
     @defer.inlineCallbacks
     def add(self, subid, ids, obj):
         """Set the metadata for a Timeseries object
         """
         tic = time.time()
-        for path, ts in obj.iteritems():
+        rows, digests, skipped = [], {}, 0
+        # a uuid sent under several paths would be updated from
+        # whichever row postgres saw last; use the last path instead
+        streams = {}
+        for path in sorted(obj.iterkeys()):
             if not util.is_string(path):
                 raise Exception("Invalid path: " + path)
+            streams[obj[path]['uuid']] = (path, obj[path])
+
+        cache = self.cache(subid)
+        for uid in sorted(streams.iterkeys()):
+            path, ts = streams[uid]
+            tags = cache.tags(path, ts)
+            tags.pop('uuid', None)
+            # skip path updates if no other metadata
+            if len(tags) == 0:
+                continue
+            pairs = [(name, str(val)) for name, val in tags.iteritems()]
+            digest = self.digest(path, pairs)
+            if metadata_digests.get(uid) == digest:
+                skipped += 1
+                continue
 
             tags = ["hstore('Path', %s)" % escape_string(path)]
-            for name, val in util.buildkv('', ts):
-                if name == 'Readings' or name == 'uuid': continue
-                name, val = escape_string(name), escape_string(str(val))
+            for name, val in pairs:
+                name, val = escape_string(name), escape_string(val)
                 if not (util.is_string(name) and util.is_string(val)):
                     raise SmapException('Invalid metadata pair: "%s" -> "%s"' % (str(name),
                                                                                  str(val)),
                                         400)
                 tags.append("hstore(%s, %s)" % (name, val))
+            rows.append("(%s, %s)" % (escape_string(uid), " || ".join(tags)))
+            digests[uid] = digest
 
-            query = "UPDATE stream SET metadata = metadata || " + " || ".join(tags) + \
-                " WHERE uuid = %s" % escape_string(ts['uuid'])
-
-            # skip path updates if no other metadata
-            if len(tags) == 1:
-                continue
+        if len(rows):
+            query = "UPDATE stream SET metadata = metadata || v.tags " \
+                "FROM (VALUES " + ", ".join(rows) + ") AS v(uuid, tags) " \
+                "WHERE stream.uuid = v.uuid"
             yield self.db.runOperation(query)
-        logging.getLogger('stats').info("Metadata insert took %0.6fs" % (time.time() - tic))
+            # only once they're applied
+            for uid, digest in digests.iteritems():
+                metadata_digests.put(uid, digest)
+        self.updated += len(rows)
+        self.skipped += skipped
+        logging.getLogger('stats').info("Metadata insert took %0.6fs "
+                                        "(%i updated, %i unchanged)" % 
+                                        (time.time() - tic, len(rows), skipped))
 
 
 class SmapData:
@@ -133,40 +239,34 @@ class SmapData:
     """
     def __init__(self, db):
         self.db = db
+        self.metadata = SmapMetadata(db)
 
-    def _add_data_real(self, ids, obj):
+    def _add_data_real(self, ids, streams):
         """Send data to a readingdb backend
         """
-        r = None
         divisor = settings.conf['readingdb']['divisor']
-        try:
-            r = rdb_pool.get()
-            for ts in obj.itervalues():
-                data = [(int(x[0] / divisor), 0, float(x[1])) 
-                        for x in ts['Readings'] if x[0] > 0]
-                # print "add", len(data), "to", ids[ts['uuid']], data[0][0]
-                while len(data) > 128:
-                    settings.rdb.db_add(r, ids[ts['uuid']], data[:128])
-                    del data[:128]
-                if len(data) > 0:
-                    settings.rdb.db_add(r, ids[ts['uuid']], data[:128])
-        except:
-            raise
-        finally:
-            if r != None:
-                rdb_pool.put(r)
-            else:
-                raise Exception("Error creating RDB connection!")
+        pool = get_rdb_pool()
+        with pool.connection() as r:
+            for ts in streams:
+                rdbwrite.write_rows(settings.rdb, r, ids[ts['uuid']],
+                                    rdbwrite.to_rows(ts['Readings'], divisor))
+        logging.getLogger('stats').info("readingdb pool: %(Active)i/%(Open)i in use, "
+                                        "%(Waits)i waits, %(WaitTime)0.6fs waiting" %
+                                        pool.stats())
         return True
 
     def _add_data(self, subid, ids, obj):
         """Store the data and metadata contained in a Timeseires
         """
         ids = dict(zip(map(operator.itemgetter('uuid'), obj.itervalues()), ids))
-        md = SmapMetadata(self.db)
-        meta_deferred = md.add(subid, ids, obj)
-        data_deferred = threads.deferToThread(self._add_data_real, ids, obj)        
-        d = defer.DeferredList([meta_deferred, data_deferred], 
+        meta_deferred = self.metadata.add(subid, ids, obj)
+        # big reports are written by several threads at once
+        streams = rdbwrite.partition([ts for ts in obj.itervalues() if 'Readings' in ts],
+                                     settings.conf['readingdb']['writers'],
+                                     size=lambda ts: len(ts['Readings']))
+        data_deferreds = [threads.deferToThread(self._add_data_real, ids, group)
+                          for group in streams]
+        d = defer.DeferredList([meta_deferred] + data_deferreds,
                                fireOnOneErrback=True, consumeErrors=True)
         # propagate the original error... 
         d.addErrback(lambda x: x.value.subFailure)
@@ -191,17 +291,36 @@ class SmapData:
     def _create_ids(self, subid, obj):
         """Create any missing streamids from a Timeseries object.
         This way a select will always return the right results.
+
+        Stream ids are cached, so this only goes to the database for
+        streams we haven't seen recently.
         """
-        uuids = []
-        query = "SELECT "
-        for ts in obj.itervalues():
-            uuids.append("add_stream(%i, %s)" % (subid,
-                                                 escape_string(ts['uuid'])))
-    
-        query += ','.join(uuids)
-        return self._run_create(uuids, [], [[]])
+        uuids = [ts['uuid'] for ts in obj.itervalues()]
+        ids = []
+        for uid in uuids:
+            cached = stream_ids.get(uid)
+            # a uuid owned by another key still goes through
+            # add_stream, which will refuse it
+            ids.append(cached[1] if cached and cached[0] == subid else None)
+        missing = [uid for uid, id in zip(uuids, ids) if id == None]
+        if len(missing) == 0:
+            return defer.succeed(ids)
+
+        def fill(created):
+            created = dict(zip(missing, created))
+            for uid, id in created.iteritems():
+                stream_ids.put(uid, (subid, id))
+            logging.getLogger('stats').info("stream id cache: %(Hits)i hits, "
+                                            "%(Misses)i misses" % stream_ids.stats())
+            return [id if id != None else created[uid]
+                    for uid, id in zip(uuids, ids)]
+        d = self._run_create(["add_stream(%i, %s)" % (subid, escape_string(uid))
+                              for uid in missing], [], [[]])
+        d.addCallback(fill)
+        return d
 
     def add(self, subid, obj):
+        self.metadata.collections(subid, obj)
         d = self._create_ids(subid, obj)
         # d.addCallback(lambda rv: self._get_ids(subid, obj))
         d.addCallback(lambda rv: self._add_data(subid, rv, obj))
@@ -210,12 +329,9 @@ class SmapData:
         return d
 
 def del_streams(streams):
-    try:
-        r = rdb_pool.get()
+    with get_rdb_pool().connection() as r:
         for sid in streams:
             settings.rdb.db_del(r, sid, 0, 0xffffffff)
-    finally:
-        rdb_pool.put(r)
         
 
 class DataRequester:
@@ -0,0 +1,316 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+"""
+@author Stephen Dawson-Haggerty <stevedh@eecs.berkeley.edu>
+"""
+
+import time
+import collections
+
+from twisted.internet import reactor, defer, error
+from twisted.python import log, failure
+
+from smap import disklog
+
+class IngestQueue:
+    """A write-ahead queue of reports waiting to be stored.
+
+    Reports are appended to a :py:class:`~smap.disklog.SegmentedLog`,
+    and :py:meth:`add` returns once they are committed to disk, so
+    that sources can be acknowledged without waiting for the
+    database.  Reports which arrive together share one commit.  Up to
+    *workers* batches of up to *batch* committed reports are passed
+    to *write* at a time, and reports are removed from the log once
+    they and every report before them have been written.  Each
+    subscription's reports are written in order: a report isn't
+    handed out while an earlier one from the same subscription is
+    still being written or waiting to be retried, so that its
+    metadata can't be overwritten by older metadata.
+
+    If a write fails with one of the *retry_on* errors (the database
+    being unreachable, say), draining stops and the batch is retried
+    with exponential backoff.  Any other error means the report
+    itself can't be stored, so retrying it would only block the
+    queue: the batch is written again one report at a time, and the
+    report which fails is logged and dropped.
+
+    Everything still in the log when the queue is opened is written
+    again, so reports are written at least once even after a crash;
+    a few which had already been written may be written twice.
+
+    :param write: ``write(subid, obj)``, which stores a report and
+     may return a Deferred.
+    :param retry_on: exception classes which are worth retrying.
+    """
+    RETRY = (EnvironmentError, error.ConnectError, error.ConnectionLost,
+             defer.TimeoutError)
+
+    def __init__(self, dirname, write, workers=4, batch=16,
+                 retry_delay=1, max_retry_delay=60, retry_on=RETRY,
+                 **kwargs):
+        self.write = write
+        self.retry_on = retry_on
+        self.workers = workers
+        self.batch = batch
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        kwargs.setdefault('threaded', True)
+        self.log = disklog.SegmentedLog(dirname, **kwargs)
+
+        # reports waiting to be committed
+        self.waiting = []
+        self.commit_call = None
+        # everything before this is on disk, and may be written
+        self.committed = self.log.bounds()[1]
+        # the next report to hand out, reports handed out, and
+        # written reports which can't be removed yet
+        self.next = self.log.bounds()[0]
+        self.active = 0
+        self.done = set()
+        # seq -> record for each report handed out and not yet done,
+        # subid -> how many of those each subscription has, and the
+        # subscriptions being written right now
+        self.records = {}
+        self.held = {}
+        self.writing = set()
+        # batches to try again
+        self.failed = []
+        self.delay = 0
+        self.retry_call = None
+        self.running = False
+
+        # (seq, time queued) for each report still in the log, so the
+        # drain lag doesn't have to read the head.  Reports queued
+        # before we were opened all get the time of the oldest.
+        self.times = collections.deque()
+        head, tail = self.log.bounds()
+        if head < tail:
+            oldest = self.log.get(head)
+            self.times.append((head, oldest[2] if oldest else time.time()))
+
+        self.written = self.retries = self.dropped = 0
+
+    def add(self, subid, obj):
+        """Queue a report.  Returns a Deferred which fires once it is
+        committed to disk."""
+        now = time.time()
+        self.log.append((subid, obj, now))
+        self.times.append((self.log.bounds()[1] - 1, now))
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if self.commit_call == None:
+            self.commit_call = reactor.callLater(0, self._commit)
+        return d
+
+    def _commit(self):
+        self.commit_call = None
+        waiting, tail = self.waiting, self.log.bounds()[1]
+        self.waiting = []
+        self.log.sync(lambda: reactor.callFromThread(self._committed,
+                                                      waiting, tail))
+
+    def _committed(self, waiting, tail):
+        self.committed = max(self.committed, tail)
+        for d in waiting:
+            d.callback(None)
+        self.drain()
+
+    def start(self):
+        self.running = True
+        self.drain()
+
+    def drain(self):
+        """Hand out committed reports to idle workers"""
+        if not self.running or self.retry_call != None:
+            return
+        self.next = max(self.next, self.log.bounds()[0])
+        while self.active < self.workers:
+            seqs = self._next_failed() or self._next_batch()
+            if not seqs:
+                break
+            self.writing.update(self._subids(seqs))
+            self.active += 1
+            self._write(seqs)
+
+    def _subids(self, seqs):
+        return set((self.records[seq][0] for seq in seqs
+                    if self.records[seq] != None))
+
+    def _next_failed(self):
+        """The first batch to try again whose subscriptions aren't
+        being written, or in an earlier batch waiting to be"""
+        blocked = set(self.writing)
+        for i, seqs in enumerate(self.failed):
+            subids = self._subids(seqs)
+            if blocked.isdisjoint(subids):
+                return self.failed.pop(i)
+            blocked.update(subids)
+
+    def _next_batch(self):
+        """Up to *batch* committed reports, stopping at one from a
+        subscription which already has reports handed out"""
+        seqs, subids = [], set()
+        while self.next < self.committed and len(seqs) < self.batch:
+            record = self.log.get(self.next)
+            if record != None:
+                subid = record[0]
+                if self.held.get(subid) and not subid in subids:
+                    break
+                subids.add(subid)
+                self.held[subid] = self.held.get(subid, 0) + 1
+            self.records[self.next] = record
+            seqs.append(self.next)
+            self.next += 1
+        return seqs
+
+    @staticmethod
+    def merge(records):
+        """Combine the reports in a batch into one per subscription.
+        Readings for the same path are concatenated."""
+        rv = {}
+        for subid, obj, _ in records:
+            merged = rv.setdefault(subid, {})
+            for path, ts in obj.iteritems():
+                if path in merged and 'Readings' in merged[path] and \
+                        'Readings' in ts:
+                    readings = list(merged[path]['Readings']) + list(ts['Readings'])
+                    merged[path] = dict(merged[path], **ts)
+                    merged[path]['Readings'] = readings
+                elif path in merged:
+                    merged[path] = dict(merged[path], **ts)
+                else:
+                    merged[path] = ts
+        return rv
+
+    def _write(self, seqs):
+        records = []
+        for seq in seqs:
+            record = self.records[seq]
+            if record == None:
+                log.err("Lost queued report " + str(seq))
+            else:
+                records.append(record)
+        try:
+            reports = self.merge(records)
+        except Exception:
+            return self._failed(failure.Failure(), seqs)
+        d = defer.DeferredList([defer.maybeDeferred(self.write, subid, obj)
+                                for subid, obj in reports.iteritems()],
+                               fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(self._written, self._failed, 
+                       callbackArgs=(seqs,), errbackArgs=(seqs,))
+
+    def _written(self, _, seqs):
+        self.active -= 1
+        self.writing.difference_update(self._subids(seqs))
+        if self.log.closed: return
+        self.written += len(seqs)
+        self.delay = 0
+        self._remove(seqs)
+        self.drain()
+
+    def _remove(self, seqs):
+        """Drop reports which are done with from the head of the log"""
+        for seq in seqs:
+            record = self.records.pop(seq)
+            if record != None:
+                self.held[record[0]] -= 1
+                if self.held[record[0]] == 0:
+                    del self.held[record[0]]
+        self.done.update(seqs)
+        head, tail = self.log.bounds()
+        end = head
+        while end in self.done:
+            self.done.discard(end)
+            end += 1
+        if end > head:
+            self.log.drop(end)
+        self._prune_times(end)
+
+    def _prune_times(self, head):
+        while len(self.times) > 1 and self.times[1][0] <= head:
+            self.times.popleft()
+
+    def _failed(self, fail, seqs):
+        self.active -= 1
+        self.writing.difference_update(self._subids(seqs))
+        if self.log.closed: return
+        if hasattr(fail.value, 'subFailure'):
+            fail = fail.value.subFailure
+        if not fail.check(*self.retry_on):
+            if len(seqs) > 1:
+                # find out which report can't be written
+                self.failed.extend([seq] for seq in seqs)
+            else:
+                log.err(fail, "Dropping queued report " + str(seqs[0]))
+                self.dropped += 1
+                self._remove(seqs)
+            self.drain()
+            return
+        log.err(fail)
+        self.retries += 1
+        self.failed.append(seqs)
+        if self.retry_call == None:
+            self.delay = min(max(self.delay * 2, self.retry_delay), 
+                             self.max_retry_delay)
+            self.retry_call = reactor.callLater(self.delay, self._retry)
+
+    def _retry(self):
+        self.retry_call = None
+        self.drain()
+
+    def close(self):
+        self.running = False
+        for call in [self.commit_call, self.retry_call]:
+            if call != None and call.active():
+                call.cancel()
+        self.commit_call = self.retry_call = None
+        self.log.close()
+        # the last commit was done when the log was closed
+        for d in self.waiting:
+            d.callback(None)
+        self.waiting = []
+
+    def stats(self):
+        """The number of reports queued, and how long the oldest has
+        been waiting"""
+        head, tail = self.log.bounds()
+        self._prune_times(head)
+        rv = {
+            'Depth' : tail - head,
+            'Uncommitted' : tail - self.committed,
+            'DrainLag' : time.time() - self.times[0][1]
+                if head < tail and self.times else 0,
+            'ActiveWorkers' : self.active,
+            'Written' : self.written,
+            'Retries' : self.retries,
+            'Dropped' : self.dropped,
+            }
+        rv['Log'] = self.log.stats()
+        return rv
@@ -185,9 +185,11 @@ def ext_non_null(x):
 
 def ext_deletor(x):
     data.del_streams(map(operator.itemgetter(0), x))
+    data.invalidate_streams(map(operator.itemgetter(1), x))
     return map(operator.itemgetter(1), x)
 
 def ext_tag_deletor(x):
+    data.invalidate_streams(map(operator.itemgetter(1), x))
     return map(operator.itemgetter(1), x)
 
 def ext_plural(tags, vals):
@@ -201,6 +203,7 @@ def ext_set(tag_list, x):
 
     Returns time series uuid and modified tags
     """
+    data.invalidate_streams(map(operator.itemgetter(0), x))
     rv = [{'uuid': v[0]} for v in x]
     for rv_i, v in itertools.izip(rv, x):
         rv_i.update(v[1])
@@ -0,0 +1,206 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+"""
+@author Stephen Dawson-Haggerty <stevedh@eecs.berkeley.edu>
+"""
+
+import time
+import threading
+import contextlib
+
+from twisted.python import log
+
+class ReadingdbPool:
+    """A bounded pool of connections to readingdb, shared by the
+    threads which talk to it.
+
+    :param rdb: the readingdb module (``readingdb``, or
+     :py:mod:`smap.iface.pgreadingdb`)
+    :param int max_connections: how many connections may be open at
+     once; threads asking for one past that wait until one is returned.
+     This should be the size of the threadpool using it.
+    :param int idle_timeout: connections idle longer than this are
+     reopened rather than reused, since the server may have dropped
+     them.  If the module has a ``db_check(conn)``, it is also used to
+     check connections before they are handed out.
+
+    If the module has a ``db_reset(conn)``, it is called as each
+    connection is returned, to end any transaction left open.  Only
+    errors in the module's ``CONNECTION_ERRORS`` (by default, IOError
+    and OSError) mark a connection as broken; it is kept after other
+    errors, such as bad data.
+    """
+    def __init__(self, rdb, host, port, max_connections=30, idle_timeout=60,
+                 clock=time.time):
+        self.rdb = rdb
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.connection_errors = getattr(rdb, 'CONNECTION_ERRORS',
+                                         EnvironmentError)
+        self.cond = threading.Condition()
+        # (connection, time it was returned), most recent last
+        self.idle = []
+        # connections open or being opened, and how many are in use
+        self.open = 0
+        self.active = 0
+
+        self.requests = self.waits = 0
+        self.wait_time = self.max_wait_time = 0
+        self.peak_active = 0
+        self.opened = self.failed = 0
+
+    def _healthy(self, conn, returned):
+        if self.clock() - returned > self.idle_timeout:
+            return False
+        check = getattr(self.rdb, 'db_check', None)
+        if check:
+            try:
+                return check(conn)
+            except Exception:
+                return False
+        return True
+
+    def _reset(self, conn):
+        reset = getattr(self.rdb, 'db_reset', None)
+        if reset:
+            try:
+                reset(conn)
+            except Exception:
+                return False
+        return True
+
+    def _close(self, conn):
+        try:
+            self.rdb.db_close(conn)
+        except Exception:
+            log.err()
+
+    def _release(self):
+        # give up a slot which never got, or no longer has, a connection
+        with self.cond:
+            self.open -= 1
+            self.active -= 1
+            self.cond.notify()
+
+    def get(self):
+        """Return a connection, opening one if none are idle.  Blocks
+        if there are already *max_connections* in use."""
+        tic = time.time()
+        with self.cond:
+            self.requests += 1
+            if not self.idle and self.open >= self.max_connections:
+                self.waits += 1
+                while not self.idle and self.open >= self.max_connections:
+                    self.cond.wait()
+            waited = time.time() - tic
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            if self.idle:
+                conn, returned = self.idle.pop()
+            else:
+                conn, returned = None, None
+                self.open += 1
+
+        if conn != None and not self._healthy(conn, returned):
+            self._close(conn)
+            conn = None
+        if conn == None:
+            try:
+                conn = self.rdb.db_open(host=self.host, port=self.port)
+            except:
+                self._release()
+                raise
+            if conn == None:
+                self._release()
+                raise IOError("Could not connect to readingdb at %s:%s" %
+                              (self.host, self.port))
+            self.opened += 1
+        return conn
+
+    def put(self, conn, healthy=True):
+        """Return a connection to the pool.  Connections which had an
+        error should be returned with *healthy* false, and are closed."""
+        if healthy:
+            healthy = self._reset(conn)
+        if not healthy:
+            self.failed += 1
+            self._close(conn)
+            self._release()
+        else:
+            with self.cond:
+                self.idle.append((conn, self.clock()))
+                self.active -= 1
+                self.cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Use a connection from the pool::
+
+          with pool.connection() as conn:
+              rdb.db_add(conn, ...)
+        """
+        conn = self.get()
+        try:
+            yield conn
+        except self.connection_errors:
+            self.put(conn, healthy=False)
+            raise
+        except:
+            self.put(conn)
+            raise
+        else:
+            self.put(conn)
+
+    def shutdown(self):
+        log.msg("ReadingdbPool shutting down:", len(self.idle))
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.open -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        return {
+            'Open' : self.open,
+            'Active' : self.active,
+            'Idle' : len(self.idle),
+            'Utilization' : float(self.active) / self.max_connections,
+            'PeakActive' : self.peak_active,
+            'Requests' : self.requests,
+            'Waits' : self.waits,
+            'WaitTime' : self.wait_time,
+            'MaxWaitTime' : self.max_wait_time,
+            'Opened' : self.opened,
+            'Failed' : self.failed,
+            }
@@ -0,0 +1,116 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+"""
+@author Stephen Dawson-Haggerty <stevedh@eecs.berkeley.edu>
+"""
+
+import heapq
+import numpy as np
+
+# how many rows to give readingdb in each db_add, if the module
+# doesn't say.  backends which can take more set BATCH_SIZE.
+BATCH_SIZE = 128
+
+def to_rows(readings, divisor):
+    """Convert sMAP readings to readingdb's (time, seqno, value) rows,
+    dropping readings without a time.  Times are divided by
+    *divisor*, and rounded down.
+    """
+    if hasattr(readings, 'columns'):
+        # a ReadingBuffer, from a columnar report
+        times, values = readings.columns()
+        times, values = times.astype(np.float64), values.astype(np.float64)
+    else:
+        a = np.fromiter((x for r in readings for x in r[:2]), np.float64,
+                        2 * len(readings)).reshape(-1, 2)
+        times, values = a[:, 0], a[:, 1]
+    keep = times > 0
+    times = np.floor_divide(times[keep], divisor).astype(np.int64)
+    return zip(times.tolist(), [0] * len(times), values[keep].tolist())
+
+def write_rows(rdb, conn, streamid, rows, batch=None):
+    """Add rows to one stream, *batch* at a time"""
+    batch = batch or getattr(rdb, 'BATCH_SIZE', BATCH_SIZE)
+    for i in xrange(0, len(rows), batch):
+        rdb.db_add(conn, streamid, rows[i:i + batch])
+
+def partition(items, n, size=len, min_size=BATCH_SIZE):
+    """Split *items* into at most *n* groups of about the same total
+    *size*, each (except for the only one) at least *min_size*.
+    Largest items are placed first, each in the smallest group.
+    """
+    if len(items) == 0:
+        return []
+    items = sorted(items, key=size, reverse=True)
+    total = sum(map(size, items))
+    n = max(1, min(n, len(items), total // max(1, min_size)))
+    # (total size, index, items); the index breaks ties, so the items
+    # themselves are never compared
+    groups = [(0, i, []) for i in xrange(0, n)]
+    for item in items:
+        total, i, group = groups[0]
+        group.append(item)
+        heapq.heapreplace(groups, (total + size(item), i, group))
+    return [g[2] for g in sorted(groups, key=lambda g: g[1])]
+
+
+if __name__ == '__main__':
+    import time
+    import types
+    from smap.util import ReadingBuffer
+
+    now = int(time.time()) * 1000
+    rdb = types.ModuleType('nullrdb')
+    rdb.db_add = lambda conn, streamid, data: len(data)
+
+    def legacy(readings, divisor):
+        # what SmapData._add_data_real used to do
+        data = [(int(x[0] / divisor), 0, float(x[1]))
+                for x in readings if x[0] > 0]
+        while len(data) > 128:
+            rdb.db_add(None, 1, data[:128])
+            del data[:128]
+        if len(data) > 0:
+            rdb.db_add(None, 1, data[:128])
+
+    def bulk(readings, divisor):
+        write_rows(rdb, None, 1, to_rows(readings, divisor), batch=128)
+
+    for n in [100, 10000, 100000, 1000000]:
+        readings = [[now + i * 1000, i * 0.5] for i in xrange(0, n)]
+        buf = ReadingBuffer()
+        buf.extend_columns(*zip(*readings))
+        for name, fn, data in [('legacy', legacy, readings),
+                               ('bulk', bulk, readings),
+                               ('columnar', bulk, buf)]:
+            start = time.time()
+            fn(data, 1000)
+            elapsed = time.time() - start
+            print '%-8s %8i readings: %8.03f msec, %10.0f points/sec' % \
+                (name, n, elapsed * 1000, n / max(elapsed, 1e-9))
@@ -32,16 +32,19 @@ OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import copy
 
+import psycopg2
 from twisted.internet import reactor, defer
 from twisted.web import resource, server, static
 from twisted.web.resource import NoResource
 from twisted.python import log
 
 from smap import subscriber
-from smap import util
+from smap import sjson as json
 from smap.server import RootResource, setResponseCode
 from smap.core import SmapException
 from smap.archiver import settings, data, api, republisher, transfer
+from smap.archiver.idcache import IdCache
+from smap.archiver.ingest import IngestQueue
 from smap.archiver.querygen import build_authcheck
 
 class DataResource(resource.Resource):
@@ -49,18 +52,42 @@ class DataResource(resource.Resource):
     which is how data is inserted into the system.  Data is POSTed to
     /add/[api key]; this resource checks that it is a valid key and
     then inserts it into the postgres and readingdb databases.
+
+    If there is an ingest queue, data is acknowledged once it is
+    queued on disk, and written to the databases in the background.
+    A GET shows the state of the queue.
     """
-    def __init__(self, db, republisher):
+    def __init__(self, db, republisher, queue=None):
         self.db = db
         self.republisher = republisher
         self.data = data.SmapData(db)
+        # api key -> (subscription id, public)
+        self.keys = IdCache(settings.conf['cache']['keys'],
+                            settings.conf['cache']['ttl'])
+        self.queue = queue
         resource.Resource.__init__(self)
 
     def _add_data(self, subid, obj):
         """Add the data using the data interface"""
         if len(obj) == 0: return True
+        if self.queue:
+            return self.queue.add(subid, obj).addCallback(lambda _: True)
         return self.data.add(subid, obj)
 
+    def _lookup_key(self, key):
+        """Find the subscription for an API key"""
+        cached = self.keys.get(key)
+        if cached:
+            return defer.succeed([cached])
+        d = self.db.runQuery("SELECT id, public FROM subscription WHERE key = %s",
+                             (key,))
+        def cache(rv):
+            if len(rv) == 1:
+                self.keys.put(key, tuple(rv[0]))
+            return rv
+        d.addCallback(cache)
+        return d
+
     def _check_subscriber(self, request, subid):
         """Check that there was an API key, and republish"""
         if len(subid) == 1:
@@ -68,11 +95,13 @@ class DataResource(resource.Resource):
             public = subid[0][1]
             subid = subid[0][0]
             obj = transfer.read(request)
+            # once it's queued we can't tell the source it was bad
+            data.check_report(obj)
 
-            # we want to republish the non-munged version of the data,
-            # but then if that fails it may kill further processing.
+            # we republish the data as it was sent; the metadata of
+            # its collections is pushed down into its streams when it
+            # is stored.
             d = self.republisher(request.prepath[-1], public, obj)
-            util.push_metadata(obj)
             d.addCallback(lambda _: (subid, obj))
 
             return d
@@ -82,11 +111,15 @@ class DataResource(resource.Resource):
     def getChild(self, name, request):
         return self
 
+    def render_GET(self, request):
+        request.setHeader('Content-type', 'application/json')
+        return json.dumps({'IngestQueue' : self.queue.stats() if self.queue
+                           else None})
+
     def render_POST(self, request):
         """Handle new data"""
         # first check if the api key is valid
-        d = self.db.runQuery("SELECT id, public FROM subscription WHERE key = %s", 
-                             (request.prepath[-1],))
+        d = self._lookup_key(request.prepath[-1])
         d.addCallback(lambda x: self._check_subscriber(request, x))
 
         # if so, add the data
@@ -111,9 +144,25 @@ class DataResource(resource.Resource):
         d.addErrback(add_error)
         return server.NOT_DONE_YET
 
+def getIngestQueue(db):
+    """Open the ingest queue, if it is enabled.  There should only be
+    one, shared by the add/ resource of every site."""
+    if not settings.conf['ingest']['enabled']:
+        return None
+    queue = IngestQueue(settings.conf['ingest']['dir'],
+                        data.SmapData(db).add,
+                        workers=settings.conf['ingest']['workers'],
+                        batch=settings.conf['ingest']['batch'],
+                        retry_on=IngestQueue.RETRY + (psycopg2.OperationalError,
+                                                      psycopg2.InterfaceError))
+    reactor.callWhenRunning(queue.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', queue.close)
+    return queue
+
 def getSite(db, 
             resources=['add', 'api', 'republish', 'wsrepublish', 'static'],
-            http_repub=None, websocket_repub=None, mongo_repub=None):
+            http_repub=None, websocket_repub=None, mongo_repub=None,
+            ingest_queue=None):
     """Get the twisted site for smap-archiver"""
     root = RootResource(value={'Contents': resources})
     if not http_repub:
@@ -136,7 +185,9 @@ def getSite(db,
     if 'wsrepublish' in resources:
         root.putChild('wsrepublish', websocket_repub)
     if 'add' in resources:
-        root.putChild('add', DataResource(db, repub_fn))
+        if not ingest_queue:
+            ingest_queue = getIngestQueue(db)
+        root.putChild('add', DataResource(db, repub_fn, ingest_queue))
     if 'api' in resources:
         root.putChild('api', api.Api(db))
     if 'static' in resources:
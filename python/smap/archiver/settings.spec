@@ -32,6 +32,18 @@ module = string(default="readingdb")
 host = string(default="localhost")
 port = integer(default=4242)
 divisor = integer(default=1000)
+writers = integer(default=4)
+
+[cache]
+keys = integer(default=10000)
+streams = integer(default=1000000)
+ttl = integer(default=300)
+
+[ingest]
+enabled = boolean(default=False)
+dir = string(default="/var/lib/smap/ingest")
+workers = integer(default=4)
+batch = integer(default=16)
 
 [mongo]
 enabled = boolean(default=False)
@@ -0,0 +1,225 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+try:
+    from smap.archiver import data
+except ImportError:
+    data = None
+
+class FakeDb:
+    """Records the statements sent to the database"""
+    def __init__(self):
+        self.operations = []
+        self.queries = []
+
+    def runOperation(self, query):
+        self.operations.append(query)
+        return defer.succeed(None)
+
+    def runQuery(self, query):
+        self.queries.append(query)
+        # add_stream returns a new stream id for each call
+        n = sum(q.count('add_stream') for q in self.queries)
+        ids = range(n - query.count('add_stream') + 1, n + 1)
+        return defer.succeed([tuple(ids)])
+
+def report(path, uid, **metadata):
+    return {path : {'uuid' : uid, 'Metadata' : metadata, 'Readings' : []}}
+
+class SmapMetadataTest(unittest.TestCase):
+    if data is None:
+        skip = "smap.archiver.data not importable"
+
+    def setUp(self):
+        data.metadata_digests.clear()
+        data.metadata_caches.clear()
+        self.addCleanup(data.metadata_digests.clear)
+        self.addCleanup(data.metadata_caches.clear)
+        self.db = FakeDb()
+        self.meta = data.SmapMetadata(self.db)
+
+    @defer.inlineCallbacks
+    def testUnchanged(self):
+        yield self.meta.add(1, None, report('/a', 'u1', Site='x'))
+        yield self.meta.add(1, None, report('/a', 'u1', Site='x'))
+        self.assertEqual(len(self.db.operations), 1)
+        self.assertEqual((self.meta.updated, self.meta.skipped), (1, 1))
+
+    @defer.inlineCallbacks
+    def testChanged(self):
+        yield self.meta.add(1, None, report('/a', 'u1', Site='x'))
+        yield self.meta.add(1, None, report('/a', 'u1', Site='y'))
+        self.assertEqual(len(self.db.operations), 2)
+        self.assertIn("'Metadata/Site', 'y'", self.db.operations[1])
+        self.assertEqual((self.meta.updated, self.meta.skipped), (2, 0))
+
+    @defer.inlineCallbacks
+    def testNotApplied(self):
+        def fail(query):
+            return defer.fail(IOError("database is down"))
+        self.db.runOperation = fail
+        yield self.assertFailure(self.meta.add(1, None, report('/a', 'u1', Site='x')),
+                                 IOError)
+        del self.db.runOperation
+        yield self.meta.add(1, None, report('/a', 'u1', Site='x'))
+        self.assertEqual(len(self.db.operations), 1)
+
+    @defer.inlineCallbacks
+    def testDuplicateUuid(self):
+        obj = report('/b', 'u1', Site='b')
+        obj.update(report('/a', 'u1', Site='a'))
+        yield self.meta.add(1, None, obj)
+        self.assertEqual(len(self.db.operations), 1)
+        query = self.db.operations[0]
+        # one row per stream, from the last path
+        self.assertEqual(query.count("'u1'"), 1)
+        self.assertIn("'Path', '/b'", query)
+        self.assertNotIn("'Path', '/a'", query)
+
+        # and it is remembered as such
+        yield self.meta.add(1, None, obj)
+        self.assertEqual(len(self.db.operations), 1)
+
+    def assertStored(self, query, uid, *pairs):
+        """*query* updates only *uid*, with each of *pairs*"""
+        self.assertEqual(query.count("hstore('Path'"), 1)
+        self.assertIn("(%s, hstore('Path'" % data.escape_string(uid), query)
+        for name, val in pairs:
+            self.assertIn("hstore(%s, %s)" % (data.escape_string(name),
+                                              data.escape_string(val)), query)
+
+    @defer.inlineCallbacks
+    def testInherited(self):
+        """Collections sent in earlier reports are pushed down"""
+        obj = {'/' : {'Contents' : ['a'], 'Metadata' : {'Site' : 'x'}}}
+        obj.update(report('/a', 'u1', Floor='4'))
+        self.meta.collections(1, obj)
+        self.assertEqual(obj.keys(), ['/a'])
+        yield self.meta.add(1, None, obj)
+        self.assertStored(self.db.operations[0], 'u1',
+                          ('Metadata/Site', 'x'), ('Metadata/Floor', '4'))
+
+        # the collection isn't sent again until it changes
+        yield self.meta.add(1, None, report('/a', 'u1', Floor='5'))
+        self.assertStored(self.db.operations[1], 'u1',
+                          ('Metadata/Site', 'x'), ('Metadata/Floor', '5'))
+
+    @defer.inlineCallbacks
+    def testInheritedChanged(self):
+        """Streams without metadata of their own are updated when a
+        collection above them changes"""
+        stream = lambda: {'/a' : {'uuid' : 'u1', 'Readings' : []}}
+        yield self.meta.add(1, None, stream())
+        self.assertEqual(len(self.db.operations), 0)
+
+        self.meta.collections(1, {'/' : {'Contents' : ['a'],
+                                         'Metadata' : {'Site' : 'x'}}})
+        yield self.meta.add(1, None, stream())
+        self.assertStored(self.db.operations[0], 'u1', ('Metadata/Site', 'x'))
+        yield self.meta.add(1, None, stream())
+        self.assertEqual(len(self.db.operations), 1)
+
+        self.meta.collections(1, {'/' : {'Contents' : ['a'],
+                                         'Metadata' : {'Site' : 'y'}}})
+        yield self.meta.add(1, None, stream())
+        self.assertEqual(len(self.db.operations), 2)
+        self.assertStored(self.db.operations[1], 'u1', ('Metadata/Site', 'y'))
+
+def readings(*uids):
+    return dict(('/' + uid, {'uuid' : uid, 'Readings' : []}) for uid in uids)
+
+class StreamIdTest(unittest.TestCase):
+    if data is None:
+        skip = "smap.archiver.data not importable"
+
+    def setUp(self):
+        data.stream_ids.clear()
+        self.addCleanup(data.stream_ids.clear)
+        self.db = FakeDb()
+        self.data = data.SmapData(self.db)
+
+    @defer.inlineCallbacks
+    def testCached(self):
+        ids = yield self.data._create_ids(1, readings('u1', 'u2'))
+        self.assertEqual(len(self.db.queries), 1)
+        self.assertEqual(sorted(ids), [1, 2])
+        again = yield self.data._create_ids(1, readings('u1', 'u2'))
+        self.assertEqual(len(self.db.queries), 1)
+        self.assertEqual(again, ids)
+
+    @defer.inlineCallbacks
+    def testPartlyCached(self):
+        yield self.data._create_ids(1, readings('u1'))
+        ids = yield self.data._create_ids(1, readings('u1', 'u2'))
+        self.assertEqual(len(self.db.queries), 2)
+        self.assertNotIn("'u1'", self.db.queries[1])
+        self.assertEqual(sorted(ids), [1, 2])
+
+    @defer.inlineCallbacks
+    def testInvalidated(self):
+        yield self.data._create_ids(1, readings('u1', 'u2'))
+        # deleted or retagged by a query
+        data.invalidate_streams(['u1'])
+        yield self.data._create_ids(1, readings('u1', 'u2'))
+        self.assertEqual(len(self.db.queries), 2)
+        self.assertIn("add_stream(1, 'u1')", self.db.queries[1])
+        self.assertNotIn("'u2'", self.db.queries[1])
+
+    @defer.inlineCallbacks
+    def testOtherKey(self):
+        yield self.data._create_ids(1, readings('u1'))
+        # a stream cached for one subscription is still checked by
+        # add_stream when it shows up under another
+        yield self.data._create_ids(2, readings('u1'))
+        self.assertEqual(len(self.db.queries), 2)
+        self.assertIn("add_stream(2, 'u1')", self.db.queries[1])
+        self.assertEqual(data.stream_ids.get('u1'), (2, 2))
+
+class CheckReportTest(unittest.TestCase):
+    if data is None:
+        skip = "smap.archiver.data not importable"
+
+    def assertInvalid(self, obj):
+        e = self.assertRaises(data.SmapException, data.check_report, obj)
+        self.assertEqual(e.http_code, 400)
+
+    def testValid(self):
+        data.check_report({'/' : {'Contents' : ['a']},
+                           '/a' : {'uuid' : u'u1', 'Readings' : [[1, 2]]}})
+
+    def testInvalid(self):
+        self.assertInvalid([])
+        self.assertInvalid({'/a' : []})
+        self.assertInvalid({'/a' : {'Readings' : [[1, 2]]}})
+        self.assertInvalid({'/a' : {'uuid' : 'u1', 'Readings' : [[1]]}})
+        self.assertInvalid({'/a' : {'uuid' : 'u1', 'Readings' : [[1, 'x']]}})
+        self.assertInvalid({'/a' : {'uuid' : 'u1', 'Readings' : 1}})
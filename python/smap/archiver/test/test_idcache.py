@@ -0,0 +1,68 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from smap.archiver.idcache import IdCache
+from twisted.trial import unittest
+
+class IdCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.c = IdCache(max_size=3, ttl=10, clock=lambda: self.now)
+
+    def testHitMiss(self):
+        self.assertEqual(self.c.get('a'), None)
+        self.c.put('a', 1)
+        self.assertEqual(self.c.get('a'), 1)
+        self.assertEqual(self.c.get('b', 2), 2)
+        self.assertEqual(self.c.stats()['Hits'], 1)
+        self.assertEqual(self.c.stats()['Misses'], 2)
+
+    def testEvict(self):
+        for k in 'abc':
+            self.c.put(k, k)
+        # a is now the most recently used
+        self.c.get('a')
+        self.c.put('d', 'd')
+        self.assertEqual(sorted(self.c.entries.keys()), ['a', 'c', 'd'])
+        self.assertEqual(self.c.stats()['Evictions'], 1)
+
+    def testExpire(self):
+        self.c.put('a', 1)
+        self.now = 5
+        self.assertEqual(self.c.get('a'), 1)
+        self.now = 11
+        self.assertEqual(self.c.get('a'), None)
+        self.assertFalse('a' in self.c)
+
+    def testInvalidate(self):
+        self.c.put('a', 1)
+        self.c.invalidate('a')
+        self.c.invalidate('b')
+        self.assertEqual(self.c.get('a'), None)
+        self.assertEqual(len(self.c), 0)
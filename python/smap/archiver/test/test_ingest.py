@@ -0,0 +1,197 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import shutil
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from smap.core import SmapException
+from smap.archiver.ingest import IngestQueue
+
+def report(path, *times):
+    return {path : {'uuid' : path, 'Readings' : [[t, t] for t in times]}}
+
+class IngestQueueTest(unittest.TestCase):
+    TEST_DIR = "testdir"
+
+    def setUp(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, self.TEST_DIR, True)
+        self.written = []
+        self.fail = 0
+
+    def write(self, subid, obj):
+        if self.fail:
+            self.fail -= 1
+            raise IOError("database is down")
+        if '/bad' in obj:
+            raise SmapException("Invalid readings", 400)
+        self.written.append((subid, obj))
+
+    def open(self, **kwargs):
+        q = IngestQueue(self.TEST_DIR, self.write, retry_delay=0.01, **kwargs)
+        self.addCleanup(q.close)
+        return q
+
+    def wait(self, q):
+        """Wait for the queue to empty"""
+        def check():
+            if q.stats()['Depth'] == 0:
+                loop.stop()
+        loop = task.LoopingCall(check)
+        return loop.start(0.01)
+
+    @defer.inlineCallbacks
+    def testWrite(self):
+        q = self.open(batch=1)
+        q.start()
+        yield defer.DeferredList([q.add(1, report('/a', 1)), 
+                                  q.add(2, report('/b', 2))])
+        yield self.wait(q)
+        self.assertEqual(sorted(self.written), 
+                         [(1, report('/a', 1)), (2, report('/b', 2))])
+        self.assertEqual(q.stats()['Written'], 2)
+        self.assertEqual(q.stats()['DrainLag'], 0)
+
+    @defer.inlineCallbacks
+    def testBatch(self):
+        q = self.open(batch=4)
+        yield defer.DeferredList([q.add(1, report('/a', 1)), 
+                                  q.add(1, report('/a', 2)),
+                                  q.add(1, report('/b', 3))])
+        self.assertEqual(q.stats()['Depth'], 3)
+        q.start()
+        yield self.wait(q)
+        expected = report('/a', 1, 2)
+        expected.update(report('/b', 3))
+        self.assertEqual(self.written, [(1, expected)])
+
+    @defer.inlineCallbacks
+    def testRetry(self):
+        q = self.open()
+        q.start()
+        self.fail = 2
+        yield q.add(1, report('/a', 1))
+        yield self.wait(q)
+        self.assertEqual(self.written, [(1, report('/a', 1))])
+        self.assertEqual(q.stats()['Retries'], 2)
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 2)
+
+    @defer.inlineCallbacks
+    def testRecover(self):
+        q = self.open()
+        yield q.add(1, report('/a', 1))
+        yield q.add(1, report('/a', 2))
+        # we never got to write them
+        q.close()
+        q = self.open()
+        self.assertEqual(q.stats()['Depth'], 2)
+        q.start()
+        yield self.wait(q)
+        self.assertEqual(self.written, [(1, report('/a', 1, 2))])
+
+    @defer.inlineCallbacks
+    def testDropped(self):
+        q = self.open(batch=4)
+        yield defer.DeferredList([q.add(1, report('/a', 1)),
+                                  q.add(1, report('/bad', 2)),
+                                  q.add(2, report('/b', 3))])
+        q.start()
+        yield self.wait(q)
+        # only the bad report is lost, and it isn't retried
+        self.assertIn((1, report('/a', 1)), self.written)
+        self.assertIn((2, report('/b', 3)), self.written)
+        self.assertEqual(q.stats()['Dropped'], 1)
+        self.assertEqual(q.stats()['Retries'], 0)
+        self.assertEqual(len(self.flushLoggedErrors(SmapException)), 1)
+
+    @defer.inlineCallbacks
+    def testDrainLag(self):
+        q = self.open()
+        yield q.add(1, report('/a', 1))
+        yield q.add(1, report('/a', 2))
+        q.close()
+
+        q = self.open()
+        queued = q.log.get(q.log.bounds()[0])[2]
+        # the head isn't read again for every call
+        q.log.get = None
+        self.assertTrue(q.stats()['DrainLag'] >= 0)
+        self.assertEqual(q.times[0][1], queued)
+        del q.log.get
+        q.start()
+        yield self.wait(q)
+        self.assertEqual(q.stats()['DrainLag'], 0)
+        self.assertEqual(len(q.times), 1)
+
+    @defer.inlineCallbacks
+    def testOrdered(self):
+        """A subscription's reports aren't written concurrently"""
+        pending = []
+        def write(subid, obj):
+            self.written.append((subid, obj))
+            pending.append(defer.Deferred())
+            return pending[-1]
+        q = IngestQueue(self.TEST_DIR, write, batch=1, workers=4)
+        self.addCleanup(q.close)
+        yield defer.DeferredList([q.add(1, report('/a', 1)),
+                                  q.add(2, report('/b', 2)),
+                                  q.add(1, report('/a', 3))])
+        q.start()
+        self.assertEqual(self.written, [(1, report('/a', 1)),
+                                        (2, report('/b', 2))])
+        pending[0].callback(None)
+        self.assertEqual(self.written[-1], (1, report('/a', 3)))
+        for d in pending[1:]:
+            d.callback(None)
+        self.assertEqual(q.stats()['Depth'], 0)
+
+    @defer.inlineCallbacks
+    def testRemoveAtOnce(self):
+        """Reports written out of order are dropped together"""
+        pending = []
+        def write(subid, obj):
+            pending.append(defer.Deferred())
+            return pending[-1]
+        q = IngestQueue(self.TEST_DIR, write, batch=1, workers=3)
+        self.addCleanup(q.close)
+        yield defer.DeferredList([q.add(i, report('/a', i)) for i in xrange(0, 3)])
+        drops, drop = [], q.log.drop
+        def record(seq):
+            drops.append(seq)
+            drop(seq)
+        q.log.drop = record
+        q.start()
+        pending[2].callback(None)
+        pending[1].callback(None)
+        self.assertEqual(q.stats()['Depth'], 3)
+        pending[0].callback(None)
+        self.assertEqual(drops, [3])
+        self.assertEqual(q.stats()['Depth'], 0)
@@ -0,0 +1,149 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import threading
+import types
+
+from smap.archiver.rdbpool import ReadingdbPool
+from twisted.trial import unittest
+
+def make_rdb():
+    """A fake readingdb module which stores data in memory"""
+    rdb = types.ModuleType('fakerdb')
+    rdb.data = {}
+    rdb.conns = []
+    rdb.down = False
+    class Connection:
+        def __init__(self):
+            self.closed = False
+            self.resets = 0
+    def db_open(host=None, port=None):
+        if rdb.down:
+            raise IOError("connection refused")
+        conn = Connection()
+        rdb.conns.append(conn)
+        return conn
+    def db_close(conn):
+        conn.closed = True
+    def db_check(conn):
+        return not conn.closed
+    def db_reset(conn):
+        conn.resets += 1
+    def db_add(conn, streamid, data):
+        if conn.closed:
+            raise IOError("connection closed")
+        rdb.data.setdefault(streamid, []).extend(data)
+    rdb.db_open, rdb.db_close, rdb.db_check, rdb.db_reset, rdb.db_add = \
+        db_open, db_close, db_check, db_reset, db_add
+    return rdb
+
+class ReadingdbPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.rdb = make_rdb()
+        self.pool = ReadingdbPool(self.rdb, 'localhost', 4242,
+                                  max_connections=2, idle_timeout=10,
+                                  clock=lambda: self.now)
+        self.addCleanup(self.pool.shutdown)
+
+    def testReuse(self):
+        for i in xrange(0, 5):
+            with self.pool.connection() as conn:
+                self.rdb.db_add(conn, 1, [(i, 0, i)])
+        self.assertEqual(len(self.rdb.conns), 1)
+        self.assertEqual(len(self.rdb.data[1]), 5)
+        stats = self.pool.stats()
+        self.assertEqual(stats['Requests'], 5)
+        self.assertEqual(stats['Open'], 1)
+        self.assertEqual(stats['Active'], 0)
+
+    def testReconnect(self):
+        with self.pool.connection() as conn:
+            pass
+        # the server went away; it is checked before it's reused
+        conn.closed = True
+        with self.pool.connection() as conn2:
+            self.rdb.db_add(conn2, 1, [(0, 0, 0)])
+        self.assertNotEqual(conn, conn2)
+        self.assertEqual(self.pool.stats()['Open'], 1)
+
+        # and connections which fail while in use are dropped
+        def fail():
+            with self.pool.connection() as conn:
+                raise IOError()
+        self.assertRaises(IOError, fail)
+        self.assertEqual(self.pool.stats()['Open'], 0)
+        self.assertEqual(self.pool.stats()['Failed'], 1)
+
+    def testReset(self):
+        with self.pool.connection() as conn:
+            self.assertEqual(conn.resets, 0)
+        # the transaction is ended before it goes back to the pool
+        self.assertEqual(conn.resets, 1)
+
+        # other errors, like bad data, don't close the connection
+        def fail():
+            with self.pool.connection() as conn:
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(conn.resets, 2)
+        self.assertFalse(conn.closed)
+        self.assertEqual(self.pool.stats()['Failed'], 0)
+
+    def testIdleTimeout(self):
+        with self.pool.connection() as conn:
+            pass
+        self.now = 11
+        with self.pool.connection() as conn2:
+            pass
+        self.assertTrue(conn.closed)
+        self.assertNotEqual(conn, conn2)
+
+    def testOpenFails(self):
+        self.rdb.down = True
+        self.assertRaises(IOError, self.pool.get)
+        self.assertEqual(self.pool.stats()['Open'], 0)
+        self.assertEqual(self.pool.stats()['Active'], 0)
+
+    def testBounded(self):
+        a, b = self.pool.get(), self.pool.get()
+        self.assertEqual(self.pool.stats()['Utilization'], 1.0)
+        got = []
+        t = threading.Thread(target=lambda: got.append(self.pool.get()))
+        t.start()
+        t.join(0.1)
+        # the third has to wait for one to be returned
+        self.assertEqual(got, [])
+        self.pool.put(a)
+        t.join()
+        self.assertEqual(got, [a])
+        self.assertEqual(len(self.rdb.conns), 2)
+        self.assertEqual(self.pool.stats()['Waits'], 1)
+        self.pool.put(b)
+        self.pool.put(a)
@@ -0,0 +1,79 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from smap.archiver import rdbwrite
+from smap.archiver.test.test_rdbpool import make_rdb
+from smap.util import ReadingBuffer
+from twisted.trial import unittest
+
+class RdbWriteTest(unittest.TestCase):
+    def testToRows(self):
+        readings = [[0, 1], [1500, 2.5], (2999, 3, 7), [3000L, 4]]
+        rows = [(1, 0, 2.5), (2, 0, 3.0), (3, 0, 4.0)]
+        self.assertEqual(rdbwrite.to_rows(readings, 1000), rows)
+        buf = ReadingBuffer()
+        buf.extend_columns([0, 1500, 2999, 3000], [1, 2.5, 3, 4])
+        self.assertEqual(rdbwrite.to_rows(buf, 1000), rows)
+        self.assertEqual(rdbwrite.to_rows([], 1000), [])
+
+    def testWriteRows(self):
+        rdb = make_rdb()
+        batches = []
+        add = rdb.db_add
+        def db_add(conn, streamid, data):
+            batches.append(len(data))
+            add(conn, streamid, data)
+        rdb.db_add = db_add
+        rows = rdbwrite.to_rows([[i * 1000, i] for i in xrange(1, 301)], 1000)
+        rdbwrite.write_rows(rdb, rdb.db_open(), 7, rows)
+        self.assertEqual(batches, [128, 128, 44])
+        self.assertEqual(rdb.data[7], rows)
+        rdb.BATCH_SIZE = 1000
+        rdbwrite.write_rows(rdb, rdb.db_open(), 7, rows)
+        self.assertEqual(batches[3:], [300])
+
+    def testPartition(self):
+        self.assertEqual(rdbwrite.partition([], 4), [])
+        # too small to be worth splitting up
+        self.assertEqual(rdbwrite.partition(['a', 'b'], 4), [['a', 'b']])
+        items = ['a' * n for n in [500, 400, 300, 200, 100]]
+        groups = rdbwrite.partition(items, 2, min_size=100)
+        self.assertEqual(sorted(len(''.join(g)) for g in groups),
+                         [700, 800])
+        self.assertEqual(len(rdbwrite.partition(items, 10, min_size=100)), 5)
+
+    def testPartitionTies(self):
+        """Groups of the same size don't compare their items"""
+        class Item(list):
+            def __cmp__(self, other):
+                raise AssertionError("compared items")
+            __eq__ = __lt__ = __gt__ = __cmp__
+        items = [Item([0] * 100) for i in xrange(0, 8)]
+        groups = rdbwrite.partition(items, 4, min_size=100)
+        self.assertEqual([len(g) for g in groups], [2, 2, 2, 2])
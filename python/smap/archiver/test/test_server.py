@@ -0,0 +1,121 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import StringIO
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from smap.archiver.idcache import IdCache
+try:
+    from smap.archiver import server
+except (ImportError, AttributeError), e:
+    # the server also needs scipy (for smap.ops) and autobahn
+    server, reason = None, str(e)
+
+class FakeDb:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def runQuery(self, query, args=()):
+        self.queries.append((query, args))
+        return defer.succeed(self.rows.get(args[0], []))
+
+class KeyCacheTest(unittest.TestCase):
+    if server is None:
+        skip = reason
+
+    def setUp(self):
+        self.now = 0
+        self.db = FakeDb({'key1' : [(1, False)]})
+        self.resource = server.DataResource(self.db, None)
+        self.resource.keys = IdCache(ttl=10, clock=lambda: self.now)
+
+    @defer.inlineCallbacks
+    def testCached(self):
+        rv = yield self.resource._lookup_key('key1')
+        self.assertEqual(list(rv), [(1, False)])
+        rv = yield self.resource._lookup_key('key1')
+        self.assertEqual(list(rv), [(1, False)])
+        self.assertEqual(len(self.db.queries), 1)
+
+    @defer.inlineCallbacks
+    def testUnknown(self):
+        # so a new key works as soon as it is created
+        rv = yield self.resource._lookup_key('key2')
+        self.assertEqual(list(rv), [])
+        self.db.rows['key2'] = [(2, True)]
+        rv = yield self.resource._lookup_key('key2')
+        self.assertEqual(list(rv), [(2, True)])
+        self.assertEqual(len(self.db.queries), 2)
+
+    @defer.inlineCallbacks
+    def testRevoked(self):
+        yield self.resource._lookup_key('key1')
+        del self.db.rows['key1']
+        # a deleted key is remembered until the ttl runs out
+        self.now = 11
+        rv = yield self.resource._lookup_key('key1')
+        self.assertEqual(list(rv), [])
+        self.assertEqual(len(self.db.queries), 2)
+
+    def testInvalidKey(self):
+        self.assertRaises(server.SmapException,
+                          self.resource._check_subscriber, None, [])
+
+    def testInvalidReport(self):
+        republished = []
+        self.resource.republisher = lambda *args: republished.append(args)
+        request = FakeRequest('{"/a" : {"uuid" : "u1", "Readings" : [[1]]}}')
+        e = self.assertRaises(server.SmapException,
+                              self.resource._check_subscriber, request,
+                              [(1, False)])
+        self.assertEqual(e.http_code, 400)
+        self.assertEqual(republished, [])
+
+class FakeRequest:
+    def __init__(self, content):
+        self.content = StringIO.StringIO(content)
+        self.prepath = ['add', 'key1']
+
+    def getHeader(self, name):
+        return None
+
+class SiteTest(unittest.TestCase):
+    if server is None:
+        skip = reason
+
+    def testSharedQueue(self):
+        queue = object()
+        sites = [server.getSite(None, resources=['add'], http_repub=object(),
+                                websocket_repub=object(), ingest_queue=queue)
+                 for port in xrange(0, 2)]
+        for site in sites:
+            self.assertIdentical(site.resource.children['add'].queue, queue)
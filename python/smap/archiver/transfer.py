@@ -34,7 +34,7 @@ import zlib
 
 import smap.sjson as json
 from smap.schema import load_report
-from smap.formatters import load_csv
+from smap.formatters import load_csv, load_columnar
 from smap.core import SmapException
 
 def read(request):
@@ -48,6 +48,8 @@ def read(request):
         obj = load_csv(content)
     elif request.getHeader("Content-Type") in ["avro/binary"]:
         obj = load_report(content)
+    elif request.getHeader("Content-Type") in ["application/x-smap-columnar"]:
+        obj = load_columnar(content)
     else:
         raise SmapException("Invalid Content-Type\n", 400)
     return obj
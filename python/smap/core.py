@@ -34,10 +34,12 @@ import os
 import uuid
 from zope.interface import implements
 from twisted.web import resource
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
+from twisted.python import log
 import sys
 import operator
 import time 
+import threading
 
 from smap import schema
 from smap import util
@@ -50,6 +52,23 @@ from smap.checkers import datacheck
 from util import SmapException, SmapSchemaException
 
 
+class Generation(object):
+    """A global counter of changes to sMAP resources.
+
+    Each Timeseries and Collection records the generation of its last
+    change; a Timeseries also records the generation at which it last
+    published its metadata.  A timeseries is dirty if it or any of
+    its ancestors has changed since then, so marking a collection
+    dirty is a constant-time operation.
+    """
+    current = 0
+
+    @classmethod
+    def next(cls):
+        cls.current += 1
+        return cls.current
+
+
 class Timeseries(dict):
     """Represent a single Timeseries.  A Timeseries is a single stream of
     scalars, with associated units.
@@ -63,6 +82,14 @@ class Timeseries(dict):
     FIELDS = ["Readings", "Description", "Metadata", 
               "Properties", "uuid"]
 
+    # large instances have many timeseries, so keep the common
+    # attributes in slots; anything else still goes in a __dict__,
+    # which is only created when first used.
+    __slots__ = ['inst', 'path', 'key', 'milliseconds', 'impl', 'autoadd',
+                 'generation', 'published', '_ancestor_cache', 
+                 '_read_limit', '_write_limit', '_reader', '_writer',
+                 '__dict__']
+
     # default values for the initializer  
     # these are used both here and when the loader module creates a
     # sMAP instance from a config file
@@ -102,6 +129,11 @@ class Timeseries(dict):
         if not buffersz:
             buffersz = self.DEFAULTS['BufferSize']
 
+        # the generation of the last change to this object, and of the
+        # last time its metadata was published
+        self.generation = 0
+        self.published = 0
+
         if isinstance(new_uuid, dict):
             if not schema.validate('Timeseries', new_uuid):
                 raise SmapSchemaException("Initializing timeseries failed -- invalid object")
@@ -118,19 +150,50 @@ class Timeseries(dict):
             reading_init = []
         self.dirty = True
         self.milliseconds = milliseconds
-        self.__setitem__("Readings", util.FixedSizeList(buffersz, init=reading_init))
+        self.__setitem__("Readings", self._make_readings(buffersz, reading_init))
 
         self.impl = impl
         self.autoadd = autoadd
-        if self.impl:
-            self.reader = util.RateLimiter(read_limit, 
-                                      lambda req: util.syncMaybeDeferred(self.impl.get_state, req),
-                                      lambda req: self)
-            self.writer = util.RateLimiter(write_limit, 
-                                      lambda req, state: util.syncMaybeDeferred(self.impl.set_state, req, state))
+        # the rate limiters are only created once they are needed
+        self._read_limit = read_limit
+        self._write_limit = write_limit
+        self._reader = None
+        self._writer = None
+
+    @property
+    def reader(self):
+        if not self.impl:
+            return self._read_cached
+        elif self._reader is None:
+            self._reader = util.RateLimiter(self._read_limit, 
+                                            lambda req: util.syncMaybeDeferred(self.impl.get_state, req),
+                                            lambda req: self)
+        return self._reader
+
+    @property
+    def writer(self):
+        if not self.impl:
+            return None
+        elif self._writer is None:
+            self._writer = util.RateLimiter(self._write_limit, 
+                                            lambda req, state: util.syncMaybeDeferred(self.impl.set_state, req, state))
+        return self._writer
+
+    def _read_cached(self, request):
+        return True, self
+
+    def _make_readings(self, buffersz, init):
+        """Create the buffer holding the most recent readings.  This
+        is a column-oriented :py:class:`~smap.util.ReadingBuffer` when
+        numpy is available."""
+        if util.np is None:
+            return util.FixedSizeList(buffersz, init=init)
+        props = self.get('Properties') or {}
+        if props.get('ReadingType') == 'double':
+            dtype = util.np.float64
         else:
-            self.reader = lambda req: (True, self)
-            self.writer = None
+            dtype = util.np.int64
+        return util.ReadingBuffer(buffersz, init=init, dtype=dtype)
 
     def _check_type(self, value):
         type_ = self.__getitem__('Properties')['ReadingType']
@@ -186,26 +249,135 @@ Can be called with 1, 2, or 3 arguments.  The forms are
         else: reading = time, value
         self["Readings"].append(reading)
         if not hasattr(self, 'inst'): return
+        self._publish([reading])
 
-        # if a timeseries is dirty, we need to republish all of its
-        # metadata before we publish it so stream is right. some of
-        # this may have already been published, in which case it won't
-        # actually do anything.
-        if self.dirty:
-            split_path = util.split_path(getattr(self, 'path'))
+    def _ancestors(self):
+        """Return a list of (path, Collection) tuples for the
+        collections containing this timeseries, starting at the root.
+        Collections are never replaced, so the list is cached until
+        the timeseries is moved to a new path.
+        """
+        path = getattr(self, 'path')
+        cached = getattr(self, '_ancestor_cache', None)
+        if cached is None or cached[0] != path:
+            split_path = util.split_path(path)
+            ancestors = []
             for i in xrange(0, len(split_path)):
                 path_seg = util.join_path(split_path[:i])
-                self.inst.reports.publish(path_seg, 
-                                          self.inst.get_collection(path_seg))
+                coll = self.inst.get_collection(path_seg)
+                if coll is not None:
+                    ancestors.append((path_seg, coll))
+            cached = (path, ancestors)
+            self._ancestor_cache = cached
+        return cached[1]
+
+    @property
+    def dirty(self):
+        """True if this timeseries or any of its ancestors has changed
+        since the timeseries last published its metadata."""
+        if self.generation > self.published:
+            return True
+        elif Generation.current <= self.published or \
+                not hasattr(self, 'inst'):
+            # nothing has changed anywhere since we last published
+            return False
+        for _, coll in self._ancestors():
+            if coll.generation > self.published:
+                return True
+        return False
+
+    @dirty.setter
+    def dirty(self, value):
+        if value:
+            self.generation = Generation.next()
+        else:
+            self.published = Generation.current
+
+    def _publish(self, readings):
+        """Send new readings to the reporting subsystem"""
+        # if a timeseries is dirty, we need to republish its metadata
+        # and that of any ancestors which have changed since we last
+        # published so the stream is right.  some of this may have
+        # already been published, in which case it won't actually do
+        # anything.
+        if self.dirty:
+            for path_seg, coll in self._ancestors():
+                if coll.generation > self.published:
+                    self.inst.reports.publish(path_seg, coll)
             rpt = dict(self)
-            rpt['Readings'] = [reading]
+            rpt['Readings'] = readings
             self.inst.reports.publish(getattr(self, 'path'), rpt)
             self.dirty = False
         else:
             # publish a stripped-down Timeseries object
             self.inst.reports.publish(getattr(self, 'path'),
                                       {'uuid' : self['uuid'],
-                                       'Readings' : [reading]})
+                                       'Readings' : readings})
+
+    def _convert_many(self, times, values):
+        """Check and convert a batch of readings for
+        :py:meth:`_add_many`.  Times are converted to integer
+        milliseconds; the type check is done once over the whole batch
+        rather than once per value.
+
+        :rtype: a (times, values) tuple, as numpy arrays if numpy is
+         available and lists otherwise.
+        :raises SmapException: if the batch is malformed or the values
+         do not match the stream type.
+        """
+        if len(times) != len(values):
+            raise SmapException("add_many: times and values must have the same length")
+        type_ = self.__getitem__('Properties')['ReadingType']
+        if util.np is None:
+            if not all(map(self._check_type, values)):
+                raise SmapException("Attempted to add non-%s values to "
+                                    "Timeseries" % type_)
+            scale = 1 if self.milliseconds else 1000
+            return [int(t) * scale for t in times], list(values)
+
+        np = util.np
+        times, values = np.asarray(times), np.asarray(values)
+        if len(times) and times.dtype.kind not in 'iuf':
+            raise SmapException("add_many: times must be numeric")
+        # a mix of ints and floats is upcast to float, which a double
+        # stream accepts; a long stream only accepts integer arrays.
+        if len(values) and not ((type_ == 'long' and values.dtype.kind in 'biu') or
+                                 (type_ == 'double' and values.dtype.kind == 'f')):
+            raise SmapException("Attempted to add values of type " + 
+                                str(values.dtype) + " to Timeseries, but " +
+                                "the timeseries type is " + type_)
+        times = times.astype(np.int64)
+        if not self.milliseconds:
+            times *= 1000
+        return times, values
+
+    def _add_many(self, times, values):
+        """Add a batch of readings to this timeseries.  Like
+:py:meth:`_add`, this must only be called from the :py:mod:`twisted`
+main loop.  The readings are published to subscribers as a single
+report object.
+
+:param times: a sequence of timestamps
+:param values: a sequence of values, the same length as *times*
+:raises SmapException: if the values' type does not match the stream
+ type.
+        """
+        self._append_many(*self._convert_many(times, values))
+
+    def _append_many(self, times, values):
+        if not len(times): return
+        if hasattr(self, 'inst'):
+            self.inst.statslog.mark()
+
+        if isinstance(self['Readings'], util.ReadingBuffer):
+            self['Readings'].extend_columns(times, values)
+            readings = zip(times.tolist(), values.tolist())
+        else:
+            readings = zip(times, values)
+            self['Readings'].extend(readings)
+
+        if not hasattr(self, 'inst'): return
+        self._publish(readings)
 
     def add(self, *args):
         """A version of :py:meth:`~Timeseries._add` which can be called from any thread.
@@ -213,16 +385,27 @@ Can be called with 1, 2, or 3 arguments.  The forms are
         # SDH : thread-safe
         # this way the real add is always done in the main loop,
         # even if it was called by another threadpool or something.
-        reactor.callFromThread(lambda: self._add(*args))
+        if hasattr(self, 'inst') and self.inst.ingest.running:
+            # queue it up so the main loop picks up many readings at once
+            self.inst.ingest.push(self, args)
+        else:
+            reactor.callFromThread(lambda: self._add(*args))
+
+    def add_many(self, times, values):
+        """A version of :py:meth:`~Timeseries._add_many` which can be
+        called from any thread.  The whole batch is handed to the main
+        loop at once.
+        """
+        reactor.callFromThread(self._add_many, times, values)
 
     def __setitem__(self, attr, value):
         if attr in self.FIELDS:
+            # the rest of the object has already been checked
+            if not schema.validate_field("Timeseries", attr, value):
+                raise SmapSchemaException("Invalid schema in " 
+                                          "Timeseries for " + 
+                                          attr)
             dict.__setitem__(self, attr, value)
-            if attr != 'uuid':
-                if not schema.validate("Timeseries", self):
-                    raise SmapSchemaException("Invalid schema in " 
-                                              "Timeseries for " + 
-                                              attr)
             # time series start dirty so when we publish them the
             # first time we send all their metadata.
             self.dirty = True
@@ -299,6 +482,9 @@ Can be called with 1, 2, or 3 arguments.  The forms are
 class Collection(dict):
     """Represent a collection of sMAP resources"""
     implements(ICollection)
+
+    __slots__ = ['inst', 'path', 'generation', '__dict__']
+
     def __init__(self, path, inst=None, description=None, *args):
         """
         :param string path: the path where the collection will be added
@@ -307,6 +493,8 @@ class Collection(dict):
         :raise SmapSchemaException: if the resulting object does not validate
         """
         self.inst = inst
+        # the generation of the last change to this collection
+        self.generation = Generation.next()
         setattr(self, 'path', util.norm_path(path))
         if len(args) == 1 and isinstance(args[0], dict):
             dict.__init__(self, args[0])
@@ -323,24 +511,16 @@ class Collection(dict):
         self["Contents"].append(name)
 
     def dirty_children(self):
-        """Recursively mark all timeseries contained in this collection as dirty
+        """Mark all timeseries contained in this collection as dirty.
+        This only advances the collection's generation; descendants
+        notice the change the next time they publish.
         """
-        def explore(item, path):
-            if not 'Contents' in item:
-                item.dirty = True
-            else:
-                for ps in item['Contents']:
-                    newpath = path + [ps]
-                    explore(self.inst.lookup(util.join_path(newpath)), 
-                            newpath)
-        if hasattr(self, 'path'):
-            explore(self, util.split_path(getattr(self, 'path')))
+        self.generation = Generation.next()
 
     def __setitem__(self, attr, value):
         if not attr in ['Contents', 'Metadata', 'Proxy']:
             raise SmapException("Key " + attr + " cannot be set on a Collection!")
         elif not attr in self or value != dict.__getitem__(self, attr):
-            self.dirty_children()
             dict.__setitem__(self, attr, value)
             self.dirty_children()
 
@@ -348,6 +528,7 @@ class Collection(dict):
         if 'Contents' in val:
             del val['Contents']
         dict.update(self, val)
+        self.dirty_children()
 
     def set_metadata(self, metadata):
         metadata = util.build_recursive(metadata)
@@ -355,7 +536,6 @@ class Collection(dict):
             metadata = metadata['Metadata']
         self['Metadata'] = util.dict_merge(self.get('Metadata', {}),
                                            metadata)
-        self.dirty_children()
 
     def render(self, request):
         return self
@@ -370,6 +550,121 @@ class LoggingTimeseries(object):
     def latest(self):
         return self.last
 
+class IngestQueue:
+    """Queue of readings added from outside the main loop.
+
+    Adding a reading with ``reactor.callFromThread`` takes the reactor
+    lock and writes to its wakeup pipe, once per reading.  Instead,
+    :py:meth:`push` just appends to a list, and the main loop drains
+    everything queued since the last pass every *interval* seconds, or
+    as soon as *high_water* readings are waiting.  Readings for the
+    same stream are added together with
+    :py:meth:`~Timeseries._add_many`.
+    """
+    def __init__(self, interval=0.1, high_water=10000):
+        self.interval = interval
+        self.high_water = high_water
+        self.running = False
+        self.lock = threading.Lock()
+        self.queue = []
+        self.first = None
+        self.wakeup = False
+
+        # counters
+        self.max_depth = 0
+        self.enqueued = 0
+        self.drains = 0
+        self.last_latency = 0
+        self.max_latency = 0
+
+    def start(self):
+        if self.interval:
+            self.t = task.LoopingCall(self.drain)
+            self.t.start(self.interval)
+            self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.t.stop()
+        self.drain()
+
+    def push(self, ts, args):
+        """Queue a reading for :py:meth:`Timeseries._add`.  Thread-safe."""
+        if len(args) == 1:
+            # timestamp now, not when the queue is drained
+            now = util.now()
+            if ts.milliseconds: now *= 1000
+            args = (now, args[0])
+        with self.lock:
+            if not self.queue:
+                self.first = time.time()
+            self.queue.append((ts, args))
+            depth = len(self.queue)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            self.enqueued += 1
+            wakeup = depth >= self.high_water and not self.wakeup
+            if wakeup:
+                self.wakeup = True
+        if wakeup:
+            reactor.callFromThread(self.drain)
+
+    def drain(self):
+        """Add everything in the queue.  Must be called from the main loop."""
+        with self.lock:
+            items, self.queue = self.queue, []
+            first, self.first = self.first, None
+            self.wakeup = False
+        if not items: return
+
+        self.drains += 1
+        self.last_latency = time.time() - first
+        self.max_latency = max(self.max_latency, self.last_latency)
+
+        # coalesce the readings for each stream, preserving their order
+        streams = {}
+        for ts, args in items:
+            if not id(ts) in streams:
+                streams[id(ts)] = (ts, [])
+            streams[id(ts)][1].append(args)
+
+        # an error in one stream mustn't lose the others, or escape
+        # and stop the LoopingCall
+        for ts, readings in streams.itervalues():
+            batch = None
+            if all((len(r) == 2 for r in readings)):
+                try:
+                    batch = ts._convert_many(*zip(*readings))
+                except Exception:
+                    # add them one at a time so only the bad readings
+                    # are lost
+                    pass
+            if batch != None:
+                try:
+                    ts._append_many(*batch)
+                except:
+                    # they may have been stored already, so adding
+                    # them again could duplicate them
+                    log.err()
+                continue
+            for r in readings:
+                try:
+                    ts._add(*r)
+                except:
+                    log.err()
+
+    def stats(self):
+        """Return the queue counters, for sizing the queue"""
+        return {
+            'depth': len(self.queue),
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'drains': self.drains,
+            'last_drain_latency': self.last_latency,
+            'max_drain_latency': self.max_latency,
+            }
+
 class SmapInstance:
     """A sMAP instance is a tree of :py:class:`Collections` and
 :py:class:`Timeseries`.  A :py:class:`SmapInstance` allows lookups
@@ -381,9 +676,18 @@ sMAP reporting functionality."""
         if not isinstance(root_uuid, uuid.UUID):
             root_uuid = uuid.UUID(root_uuid)
 
-        self.OBJS_PATH = {}
+        self.OBJS_PATH = util.PathTrie()
         self.OBJS_UUID = {}
+        # in compact mode, timeseries with the same Properties share
+        # a single read-only copy of them
+        self.compact = util.to_bool(kwargs.pop('compact', 
+                                               smapconf.SERVER.get('compact', False)))
+        self.properties = {}
         self.drivers = {}
+        # readings added from other threads are queued up here until
+        # the main loop picks them up
+        self.ingest = IngestQueue(kwargs.pop('ingest_interval', 0.1),
+                                  kwargs.pop('ingest_high_water', 10000))
         # this contains elements of the form [function, timebetweenruns] to
         # allow loader to hook in checking functions.
         self.checkers = []
@@ -415,6 +719,7 @@ sMAP reporting functionality."""
     def start(self):
         """Causes the reporting subsystem and any drivers to be started
         """
+        self.ingest.start()
         map(lambda x: x.start(), self.drivers.itervalues())
 
         # set all checkers that loader has hooked in to be run on the
@@ -426,8 +731,12 @@ sMAP reporting functionality."""
             reactor.callLater(2, checkstarter, *args)
 
     def stop(self):
-        return defer.DeferredList(map(lambda x: defer.maybeDeferred(x.stop),
-                                      self.drivers.itervalues()))
+        d = defer.DeferredList(map(lambda x: defer.maybeDeferred(x.stop),
+                                   self.drivers.itervalues()))
+        d.addCallback(lambda x: self.ingest.stop() or x)
+        # once nothing more can be published
+        d.addCallback(lambda x: self.reports.close())
+        return d
 
     def uuid(self, key, namespace=None):
         if not namespace:
@@ -461,11 +770,11 @@ sMAP reporting functionality."""
         the result.
         """
         if util.is_string(id):
-            path = util.split_path(id)
+            path = self.OBJS_PATH.split(id)
             if len(path) > 0 and path[-1][0] == "+":
-                return self._lookup_r(util.join_path(path[:-1]), pred=pred)
+                return self._lookup_r(path[:-1], pred=pred)
             else:
-                obj = self.OBJS_PATH.get(util.join_path(path), None)
+                obj = self.OBJS_PATH.get(path, None)
         elif isinstance(id, uuid.UUID):
             return self.OBJS_UUID.get(id, None)
         else:
@@ -480,19 +789,27 @@ sMAP reporting functionality."""
         resource identifed by "id".  Returns a list of elements for which
         "pred" returns True"""
         rv = {}
-        q = [id]
-        root_path = getattr(self.lookup(id), 'path')
-
-        while len(q) > 0:
-            cur = self.lookup(q.pop(0))
-            if ICollection.providedBy(cur):
-                for child in cur['Contents']:
-                    q.append(getattr(cur, 'path') + '/' + child)
-            if cur and (not pred or pred(cur)):
-                rvpath = util.norm_path(getattr(cur, 'path')[len(root_path):])
+        root_path = util.join_path(self.OBJS_PATH.split(id))
+        for path, cur in self.OBJS_PATH.walk(id):
+            if not pred or pred(cur):
+                rvpath = util.norm_path(path[len(root_path):])
                 rv[rvpath] = cur
         return rv
 
+    def lookup_paths(self, id):
+        """Return the set of paths a resource identifier refers to.
+        For recursive identifiers (ending in ``+``) this is a cached
+        set which is kept up to date as resources are added, and must
+        not be modified.
+        """
+        path = self.OBJS_PATH.split(id)
+        if len(path) > 0 and path[-1][0] == "+":
+            return self.OBJS_PATH.subtree(path[:-1])
+        elif path in self.OBJS_PATH:
+            return set([util.join_path(path)])
+        else:
+            return set()
+
     @staticmethod
     def render_lookup(request, val):
         """Render a return value of lookup, by calling render()
@@ -559,6 +876,34 @@ sMAP reporting functionality."""
         except AttributeError, e:
             raise SmapException("add failed: no such path: %s" % path)
 
+    def _add_batch(self, data):
+        """Add readings to several timeseries at once.  Must be
+        called from the main loop; see :py:meth:`add_batch`.
+        """
+        batch = []
+        # check everything before adding anything, so a bad stream
+        # doesn't leave the batch half-applied
+        for path, readings in data.iteritems():
+            ts = self.get_timeseries(path)
+            if not ts:
+                raise SmapException("add_batch failed: no such path: %s" % path)
+            if len(readings):
+                times, values = zip(*readings)
+            else:
+                times, values = [], []
+            batch.append((ts, ts._convert_many(times, values)))
+        for ts, (times, values) in batch:
+            ts._append_many(times, values)
+
+    def add_batch(self, data):
+        """Add readings to many timeseries with a single trip into the
+        main loop.  May be called from any thread.
+
+        :param dict data: maps paths (or uuids) to lists of ``(time,
+         value)`` tuples.
+        """
+        reactor.callFromThread(self._add_batch, data)
+
     def _add_parents(self, path):
         for i in xrange(0, len(path)):
             if not self.get_collection(util.join_path(path[:i])):
@@ -610,20 +955,42 @@ sMAP reporting functionality."""
         if recurse: self._add_parents(path)
         parent = self.get_collection(util.join_path(path[:-1]))
 
-        if not replace and util.join_path(path) in self.OBJS_PATH:
+        exists = path in self.OBJS_PATH
+        if not replace and exists:
             raise SmapException("add_timeseries: path " + str(path) + " exists!")
         if not parent:
             raise SmapException("add_timeseries: parent is not a collection!")
-        parent.add_child(path[-1])
+        if not exists:
+            parent.add_child(path[-1])
+
+        if self.compact: self._intern_properties(timeseries)
 
         # place the new timeseries into the uuid and path tables
         self.OBJS_UUID[timeseries['uuid']] = timeseries
-        self.OBJS_PATH[util.join_path(path)] = timeseries
+        self.OBJS_PATH[path] = timeseries
         timeseries.inst = self
         setattr(timeseries, 'path', util.join_path(path))
-        if not self.loading: self.reports.update_subscriptions()
+        if not self.loading: self.reports.update_subscriptions(util.join_path(path))
         return timeseries
 
+    def _intern_properties(self, timeseries):
+        """Replace the Properties of *timeseries* with a shared,
+        read-only copy.  They may still be replaced, but not modified
+        in place.
+        """
+        props = timeseries.get('Properties')
+        if props is None: return
+        key = tuple(sorted(props.iteritems()))
+        try:
+            shared = self.properties.get(key)
+        except TypeError:
+            # not hashable, so can't be shared
+            return
+        if shared is None:
+            shared = self.properties[key] = util.FrozenDict(props)
+        # same value, so this isn't a change
+        dict.__setitem__(timeseries, 'Properties', shared)
+
     def add_collection(self, path, *args): 
         """Add collection to the namespace.  For instance::
 
@@ -648,12 +1015,12 @@ sMAP reporting functionality."""
             if not parent:
                 raise SmapException("add_collection: parent is not collection!")
             parent.add_child(path[-1])
-        if util.join_path(path) in self.OBJS_PATH:
+        if path in self.OBJS_PATH:
             raise SmapException("add_timeseries: path " + str(path) + 
                                 " exists!")
 
-        self.OBJS_PATH[util.join_path(path)] = collection
-        if not self.loading: self.reports.update_subscriptions()
+        self.OBJS_PATH[path] = collection
+        if not self.loading: self.reports.update_subscriptions(util.join_path(path))
         return collection
 
     def add_actuator(self, path, unit, impl, **kwargs):
@@ -684,7 +1051,36 @@ sMAP reporting functionality."""
     def unpause_reporting(self):
         return self.reports.unpause()
 
-if __name__ == '__main__':
+def _memory_benchmark(n, compact):
+    """Print the resident memory used per stream by an instance with
+    *n* timeseries.  Linux only."""
+    import gc
+    def rss():
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    s = SmapInstance(uuid.uuid1(), reportfile=None, autoflush=None,
+                     compact=compact)
+    s.loading = True
+    ids = [uuid.uuid1() for i in xrange(0, n)]
+    gc.collect()
+    before = rss()
+    for i in xrange(0, n):
+        s.add_timeseries('/dev%i/point%i' % (i / 100, i), ids[i], 'kW')
+    gc.collect()
+    print "%s: %i streams, %i bytes/stream" % \
+        ('compact' if compact else 'default', n, (rss() - before) / n)
+
+if __name__ == '__main__' and sys.argv[1:2] == ['memory']:
+    # python core.py memory [n]: compare bytes per stream with and
+    # without compact mode, each in a fresh process
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    for compact in [False, True]:
+        pid = os.fork()
+        if pid == 0:
+            _memory_benchmark(n, compact)
+            os._exit(0)
+        os.waitpid(pid, 0)
+elif __name__ == '__main__':
     ROOT_UUID = uuid.uuid1()
     s = SmapInstance(ROOT_UUID)
     s.add_collection("/steve")
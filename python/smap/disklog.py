@@ -33,6 +33,13 @@ OF THE POSSIBILITY OF SUCH DAMAGE.
 import os
 import util
 import time
+import zlib
+import struct
+import threading
+import collections
+import cPickle as pickle
+from Queue import Queue
+from twisted.internet import reactor, defer
 from twisted.python import log
 
 def snp(s):
@@ -41,10 +48,13 @@ def snp(s):
 class DiskLog:
     """Class which keeps an on-disk log of records
     """
+    # sequence number, time of a record's newest data
+    AGE = struct.Struct('<Qd')
+
     def _blank_meta(self):
         self.meta = {
                 'head' : 0,
-                'tail' : 0
+                'tail' : 0,
                 }
 
 
@@ -54,6 +64,56 @@ class DiskLog:
     def _read_meta(self):
         self.meta = util.pickle_load(os.path.join(self.dirname, 'META'))
         if self.meta == None: self._blank_meta()
+        self.meta.pop('ctimes', None)
+
+    def _read_ages(self):
+        """Load when the newest data in each record before the tail
+        was written.  AGES is only appended to, as records stop being
+        the tail; records missing from it use their modification time.
+        """
+        ages = {}
+        try:
+            with open(os.path.join(self.dirname, 'AGES'), 'rb') as fp:
+                data = fp.read()
+        except IOError:
+            data = ''
+        self.ages_written = len(data) // self.AGE.size
+        for i in xrange(0, self.ages_written):
+            seq, t = self.AGE.unpack_from(data, i * self.AGE.size)
+            ages[seq] = t
+
+        now = time.time()
+        self.ctimes = collections.deque()
+        for seqno in xrange(self.meta['head'], self.meta['tail'] - 1):
+            if seqno in ages:
+                self.ctimes.append(ages[seqno])
+                continue
+            try:
+                self.ctimes.append(os.path.getmtime(
+                        os.path.join(self.dirname, snp(seqno))))
+            except OSError:
+                self.ctimes.append(now)
+
+    def _seal_age(self):
+        """Record the age of the tail, which is about to stop being it"""
+        seq, t = self.meta['tail'] - 1, self.tail_time
+        self.ctimes.append(t)
+        path = os.path.join(self.dirname, 'AGES')
+        try:
+            if self.ages_written > 2 * len(self.ctimes) + 1024:
+                # most of it is for records which are gone
+                first = self.meta['head']
+                with open(path + '.tmp', 'wb') as fp:
+                    for i, t in enumerate(self.ctimes):
+                        fp.write(self.AGE.pack(first + i, t))
+                os.rename(path + '.tmp', path)
+                self.ages_written = len(self.ctimes)
+            else:
+                with open(path, 'ab') as fp:
+                    fp.write(self.AGE.pack(seq, t))
+                self.ages_written += 1
+        except (IOError, OSError):
+            log.err()
 
     def _write_tail(self):
         util.pickle_dump(os.path.join(self.dirname, snp(self.meta['tail'] - 1)), self._tail)
@@ -74,6 +134,8 @@ class DiskLog:
             self._blank_meta()
             self._write_meta()
             self._head = self._tail = None
+            self.ctimes = collections.deque()
+            self.ages_written = 0
         else:
             # read the head and tail off disk for an existing log
             self._read_meta()
@@ -83,10 +145,21 @@ class DiskLog:
                 self._tail = None
 
             self._head = self._read_seqno(self.meta['head'])
+            self._read_ages()
 
+        self.tail_time = time.time()
         self.max_age = max_age
+        # called after records are expired by max_age
+        self.expired = None
         self.dirty = False
             
+    def __setstate__(self, state):
+        # logs pickled by an older version don't have the age index
+        self.__dict__.update(state)
+        self.meta.pop('ctimes', None)
+        if not hasattr(self, 'ctimes'): self._read_ages()
+        if not hasattr(self, 'tail_time'): self.tail_time = time.time()
+
     def __len__(self):
         return self.meta['tail'] - self.meta['head']
 
@@ -98,6 +171,22 @@ class DiskLog:
         if self._head == None: self.pop()
         return self._head
 
+    def bounds(self):
+        """Return the sequence number of the head, and one past the
+        sequence number of the tail"""
+        return self.meta['head'], self.meta['tail']
+
+    def get(self, seq):
+        """Return the record with sequence number *seq*"""
+        if seq == self.meta['tail'] - 1:
+            return self._tail
+        elif seq == self.meta['head'] and self._head != None:
+            return self._head
+        elif self.meta['head'] <= seq < self.meta['tail']:
+            return self._read_seqno(seq)
+        else:
+            return None
+
     def update_tail(self, obj):
         # change the value of the tail
         self._tail = obj
@@ -107,17 +196,36 @@ class DiskLog:
             self._head = obj
 
         # need to sync
+        self.tail_time = time.time()
+        self.dirty = True
+
+    def extend_tail(self, items):
+        """Add *items* to the end of the tail, which is a list"""
+        self._tail.extend(items)
+        self.tail_time = time.time()
         self.dirty = True
+
+    def replace(self, seq, obj):
+        """Change the value of the record with sequence number *seq*"""
+        if seq == self.meta['tail'] - 1:
+            self.update_tail(obj)
+        elif self.meta['head'] <= seq < self.meta['tail']:
+            if seq == self.meta['head']:
+                self._head = obj
+            util.pickle_dump(os.path.join(self.dirname, snp(seq)), obj)
     
     def append(self, obj):
         # flush the current tail to disk
         self.sync()
+        if self.meta['tail'] > self.meta['head']:
+            self._seal_age()
 
         # add the new tail (and head if we were empty)
         self._tail = obj
         if self.meta['tail'] == self.meta['head']:
             self._head = obj
         self.meta['tail'] += 1
+        self.tail_time = time.time()
 
         # need a flush
         self.dirty = True
@@ -129,7 +237,12 @@ class DiskLog:
             self._write_meta()
             self._age_buffers()
 
-    close = sync
+    def close(self, wait=True):
+        self.sync()
+        return defer.succeed(None)
+
+    def backlogged(self):
+        return False
 
     def pop(self):
         """Remove the head of the queue from disk"""
@@ -142,17 +255,33 @@ class DiskLog:
                 log.err("WARN: disappeared log entry:" +
                         str(self.meta['head'] - 1))
 
-    def _pop(self):
+    def drop(self, seq):
+        """Remove every record before *seq* at once"""
         self.sync()
+        if self._drop(seq):
+            self._write_meta()
 
-        try:
-            os.remove(os.path.join(self.dirname, snp(self.meta['head'])))
-        except OSError:
-            pass
+    def _pop(self):
+        self.sync()
+        self._drop(self.meta['head'] + 1)
 
-        if self.meta['tail'] > self.meta['head']:
+    def _drop(self, seq):
+        seq = min(seq, self.meta['tail'])
+        if seq <= self.meta['head']:
+            return False
+        while self.meta['head'] < seq:
+            try:
+                os.remove(os.path.join(self.dirname, snp(self.meta['head'])))
+            except OSError:
+                pass
+            # only records before the tail have an age
+            if self.meta['head'] < self.meta['tail'] - 1:
+                self.ctimes.popleft()
             self.meta['head'] += 1
+        self._reload_head()
+        return True
 
+    def _reload_head(self):
         if self.meta['tail'] == self.meta['head']:
             # q is now empty
             self._head = self._tail = None
@@ -164,21 +293,666 @@ class DiskLog:
             self._head = self._read_seqno(self.meta['head'])
 
     def _age_buffers(self):
-        """Remove buffers which have been on disk for longer than max_age"""
-        if not hasattr(self, 'max_age') or self.max_age == None: return
-        seqno = self.meta['head']
-        now = time.time()
-        for seqno in xrange(self.meta['head'], self.meta['tail'] + 1):
-            try:
-                mtime = os.path.getmtime(os.path.join(self.dirname, 
-                                                      snp(self.meta['head'])))
-            except OSError:
-                break
-            if now - mtime > self._total_seconds(self.max_age):
-                self.pop()
-
+        """Remove records whose newest data is older than max_age, all
+        at once.  The tail is never expired, since data is still being
+        added to it."""
+        if getattr(self, 'max_age', None) == None: return
+        cutoff = time.time() - self._total_seconds(self.max_age)
+        seq = self.meta['head']
+        for t in self.ctimes:
+            if t >= cutoff: break
+            seq += 1
+        if self._drop(seq):
+            self._write_meta()
+            if getattr(self, 'expired', None): self.expired()
 
     @staticmethod
     def _total_seconds(td):
+        if not hasattr(td, 'days'):
+            return float(td)
         # timedelta.total_seconds is only available in python2.7
         return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 1e6) / 1e6
+
+
+class SegmentedLog(object):
+    """An append-only log of records stored in large segment files.
+
+    Each record is written to the current segment as a length-prefixed,
+    checksummed pickle; once a segment reaches :py:attr:`SEGMENT_SIZE`
+    bytes a new one is started, and segments are deleted once every
+    record in them has been popped.  Records are only written when
+    they stop being the tail or when the log is committed, and the
+    head and tail sequence numbers are kept by small marker records in
+    the same stream, so there is no separate metadata file to rewrite.
+    A list tail grown with :py:meth:`extend_tail` is committed by
+    writing just the new items, and written out whole once it stops
+    being the tail.
+
+    If a write fails, nothing more is written to that segment: it is
+    truncated back to the last good record, and at the next sync every
+    record which didn't make it to disk is written again to a new one.
+
+    Writes are committed (fsynced) in groups: after
+    :py:attr:`COMMIT_BYTES` bytes have been written, or at most
+    :py:attr:`COMMIT_INTERVAL` seconds after the first uncommitted
+    change.  :py:meth:`sync` commits immediately.  On startup, a torn
+    or corrupt record at the end of a segment is truncated away.
+
+    With *threaded*, all file writes, fsyncs and segment removals
+    are done in order by a :py:class:`LogWriter` thread, so the caller
+    only pickles records; :py:meth:`backlogged` says when the disk
+    isn't keeping up, so callers can stop adding data rather than
+    wait for it.  Setting :py:attr:`fsync` to False
+    leaves flushing the segments to the operating system.
+
+    It has the same interface as :py:class:`DiskLog`.
+    """
+    SEGMENT_SIZE = 16 * 1024 * 1024
+    COMMIT_BYTES = 1024 * 1024
+    COMMIT_INTERVAL = 1.
+    MAX_STAGED = 32 * 1024 * 1024
+
+    # length, checksum, kind, sequence number, append time
+    HEADER = struct.Struct('<IIBQd')
+    RECORD, MARKER, EXTEND = 0, 1, 2
+    MARKER_BODY = struct.Struct('<QQ')
+
+    def __init__(self, dirname, max_age=None, segment_size=None,
+                 commit_bytes=None, commit_interval=None, threaded=False,
+                 max_staged=None):
+        self.dirname = dirname
+        self.max_age = max_age
+        # called after records are expired by max_age
+        self.expired = None
+        self.fsync = True
+        if segment_size: self.SEGMENT_SIZE = segment_size
+        if commit_bytes != None: self.COMMIT_BYTES = commit_bytes
+        if commit_interval != None: self.COMMIT_INTERVAL = commit_interval
+
+        # where the latest copy of each record is: seqno -> (segment,
+        # offset, length, time its newest data was written)
+        self.index = {}
+        # seqno -> [(segment, offset, length, time)] for items added
+        # to a record by extend_tail since it was last written whole
+        self.extents = {}
+        # how many items of the tail are on disk, or None if it has
+        # to be written whole
+        self.tail_written = None
+        # [segment number, highest seqno written to it]
+        self.segments = []
+        self.head_seq = self.tail_seq = 0
+        self._head = self._tail = None
+        self.fp = None
+        self.seg_size = 0
+        self.dirty = self.moved = self.closed = False
+        self.unsynced = 0
+        self.last_commit = time.time()
+        self._timer = None
+        # (seqno, piece) -> body for records not written yet; piece
+        # is 0 for the whole record, or n for its nth extent
+        self.unwritten = {}
+        # the last segment a write failed on, and where its last good
+        # record ends
+        self.failed = None
+        self.good_offset = 0
+        self.write_errors = 0
+        # name -> (count, total time, max time) for each kind of write
+        self.latency = {}
+        self.lock = threading.Lock()
+        if threaded:
+            self.writer = LogWriter(max_staged or self.MAX_STAGED)
+            self.writer.start()
+        else:
+            self.writer = None
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._recover()
+
+        if self.tail_seq > self.head_seq:
+            self._tail = self._read_seqno(self.tail_seq - 1)
+            self._head = self._read_seqno(self.head_seq)
+            if isinstance(self._tail, list):
+                self.tail_written = len(self._tail)
+        self._open_segment()
+
+    def _segment_path(self, segno):
+        return os.path.join(self.dirname, 'segment-' + snp(segno))
+
+    def _recover(self):
+        segnos = sorted((int(f[8:]) for f in os.listdir(self.dirname)
+                         if f.startswith('segment-') and f[8:].isdigit()))
+        for segno in segnos:
+            maxseq = 0
+            with open(self._segment_path(segno), 'r+b') as fp:
+                for kind, seq, offset, length, t in self._scan(fp):
+                    maxseq = max(maxseq, seq)
+                    if kind == self.MARKER:
+                        fp.seek(offset)
+                        head, tail = self.MARKER_BODY.unpack(fp.read(length))
+                        self.head_seq = max(self.head_seq, head)
+                        self.tail_seq = max(self.tail_seq, tail)
+                    elif kind == self.EXTEND:
+                        if seq in self.index:
+                            self.extents.setdefault(seq, []).append(
+                                (segno, offset, length, t))
+                    else:
+                        self.index[seq] = (segno, offset, length, t)
+                        self.extents.pop(seq, None)
+                        self.tail_seq = max(self.tail_seq, seq + 1)
+            self.segments.append([segno, maxseq])
+
+        for seq in [s for s in self.index if s < self.head_seq]:
+            del self.index[seq]
+            self.extents.pop(seq, None)
+
+    def _scan(self, fp):
+        """Iterate over the valid records in a segment, truncating
+        the file at the first torn or corrupt one"""
+        pos = 0
+        size = os.fstat(fp.fileno()).st_size
+        while True:
+            fp.seek(pos)
+            header = fp.read(self.HEADER.size)
+            if not header:
+                return
+            elif len(header) == self.HEADER.size:
+                length, crc, kind, seq, t = self.HEADER.unpack(header)
+                # don't trust a torn length enough to read it
+                if pos + self.HEADER.size + length > size:
+                    break
+                body = fp.read(length)
+                if len(body) == length and \
+                        self._checksum(kind, seq, t, body) == crc:
+                    yield kind, seq, pos + self.HEADER.size, length, t
+                    pos += self.HEADER.size + length
+                    continue
+            break
+        log.err("WARN: truncating torn write in %s at offset %i" % 
+                (fp.name, pos))
+        fp.truncate(pos)
+
+    @staticmethod
+    def _checksum(kind, seq, t, body):
+        return zlib.crc32(body, zlib.crc32(struct.pack('<BQd', kind, seq, t))) \
+            & 0xffffffff
+
+    def _open_segment(self):
+        if self.segments:
+            segno = self.segments[-1][0]
+            self.seg_size = os.path.getsize(self._segment_path(segno))
+        if not self.segments or self.seg_size >= self.SEGMENT_SIZE:
+            self._next_segment()
+        else:
+            self._do_roll(segno)
+
+    def _next_segment(self):
+        segno = self.segments[-1][0] + 1 if self.segments else 0
+        self.segments.append([segno, 0])
+        self.seg_size = 0
+        self._io('roll', self._do_roll, segno)
+
+    # the _do_ methods run on the writer thread, if there is one
+    def _do_roll(self, segno):
+        if self.fp: self.fp.close()
+        self.fp = None
+        try:
+            self.fp = open(self._segment_path(segno), 'ab')
+            self.good_offset = os.fstat(self.fp.fileno()).st_size
+        except (IOError, OSError):
+            log.err()
+            self.failed = segno
+
+    def _do_write(self, segno, data, key, body):
+        if segno == self.failed:
+            # the offsets of everything after a failed write are
+            # wrong, so it is written again to the next segment
+            return
+        try:
+            self.fp.write(data)
+            self.fp.flush()
+        except (IOError, OSError):
+            log.err()
+            self._do_truncate(segno)
+            return
+        self.good_offset += len(data)
+        if key != None:
+            with self.lock:
+                if self.unwritten.get(key) is body:
+                    del self.unwritten[key]
+
+    def _do_truncate(self, segno):
+        """Cut a segment back to its last good record after a failed
+        write"""
+        self.failed = segno
+        with self.lock:
+            self.write_errors += 1
+        try:
+            self.fp.close()
+        except (IOError, OSError):
+            pass
+        self.fp = None
+        try:
+            with open(self._segment_path(segno), 'r+b') as fp:
+                fp.truncate(self.good_offset)
+        except (IOError, OSError):
+            log.err()
+
+    def _do_commit(self):
+        if self.fp: os.fsync(self.fp.fileno())
+
+    def _do_close(self):
+        if self.fp: self.fp.close()
+
+    def _timed(self, name, fn, *args):
+        tic = time.time()
+        try:
+            fn(*args)
+        except (IOError, OSError):
+            log.err()
+        latency = time.time() - tic
+        with self.lock:
+            count, total, peak = self.latency.get(name, (0, 0., 0.))
+            self.latency[name] = (count + 1, total + latency, max(peak, latency))
+
+    def _io(self, name, fn, *args, **kwargs):
+        """Run a file operation, on the writer thread if there is one"""
+        if self.writer:
+            self.writer.submit(kwargs.get('nbytes', 0), 
+                               self._timed, name, fn, *args)
+        else:
+            self._timed(name, fn, *args)
+
+    def _write(self, kind, seq, body, t=None, piece=0):
+        if t == None: t = time.time()
+        segno = self.segments[-1][0]
+        offset = self.seg_size + self.HEADER.size
+        data = self.HEADER.pack(len(body), self._checksum(kind, seq, t, body), 
+                                kind, seq, t) + body
+        key = (seq, piece) if kind != self.MARKER else None
+        if key != None:
+            with self.lock:
+                self.unwritten[key] = body
+        self._io('write', self._do_write, segno, data, key, body,
+                 nbytes=len(data))
+        self.segments[-1][1] = max(self.segments[-1][1], seq)
+        self.seg_size += len(data)
+        self.unsynced += len(data)
+        return (segno, offset, len(body), t)
+
+    def _write_record(self, seq, body, t=None):
+        """Write a whole record, replacing any earlier copy"""
+        self.index[seq] = self._write(self.RECORD, seq, body, t)
+        if self.extents.pop(seq, None):
+            with self.lock:
+                for key in [k for k in self.unwritten
+                            if k[0] == seq and k[1] > 0]:
+                    del self.unwritten[key]
+
+    def _write_tail(self):
+        seq = self.tail_seq - 1
+        try:
+            if self.tail_written != None and seq in self.index:
+                # only the items added since it was last written
+                if len(self._tail) > self.tail_written:
+                    extents = self.extents.setdefault(seq, [])
+                    extents.append(self._write(
+                            self.EXTEND, seq,
+                            pickle.dumps(self._tail[self.tail_written:], 2),
+                            piece=len(extents) + 1))
+            else:
+                self._write_record(seq, pickle.dumps(self._tail, 2))
+            if isinstance(self._tail, list):
+                self.tail_written = len(self._tail)
+        except (pickle.PickleError, TypeError):
+            log.err()
+
+    def _repair(self):
+        """Start a new segment after a write failed, and write out
+        again every record that didn't make it to disk"""
+        log.msg("Rewriting records after a failed write to " + 
+                self._segment_path(self.failed))
+        self._next_segment()
+        with self.lock:
+            unwritten = sorted(self.unwritten.items())
+        for (seq, piece), body in unwritten:
+            if piece == 0 and seq in self.index:
+                self.index[seq] = self._write(self.RECORD, seq, body,
+                                              self.index[seq][3])
+            elif piece > 0 and len(self.extents.get(seq, ())) >= piece:
+                t = self.extents[seq][piece - 1][3]
+                self.extents[seq][piece - 1] = \
+                    self._write(self.EXTEND, seq, body, t, piece)
+            else:
+                with self.lock:
+                    if self.unwritten.get((seq, piece)) is body:
+                        del self.unwritten[seq, piece]
+        # the head marker may have been lost too
+        self.moved = True
+
+    def _read_seqno(self, seq):
+        if not seq in self.index:
+            return None
+        pieces = [self.index[seq]] + self.extents.get(seq, [])
+        files = {}
+        try:
+            rv = None
+            for piece, (segno, offset, length, _) in enumerate(pieces):
+                with self.lock:
+                    body = self.unwritten.get((seq, piece))
+                if body == None:
+                    if not segno in files:
+                        files[segno] = open(self._segment_path(segno), 'rb')
+                    files[segno].seek(offset)
+                    body = files[segno].read(length)
+                if piece == 0:
+                    rv = pickle.loads(body)
+                else:
+                    rv.extend(pickle.loads(body))
+            return rv
+        except (IOError, EOFError, pickle.UnpicklingError), e:
+            log.err("Warning: got exception reading sequence number: " + str(e))
+            return None
+        finally:
+            for fp in files.itervalues():
+                fp.close()
+
+    def __len__(self):
+        return self.tail_seq - self.head_seq
+
+    def tail(self):
+        """Return the tail of the log"""
+        return self._tail
+
+    def head(self):
+        if self._head == None: self.pop()
+        return self._head
+
+    def bounds(self):
+        """Return the sequence number of the head, and one past the
+        sequence number of the tail"""
+        return self.head_seq, self.tail_seq
+
+    def get(self, seq):
+        """Return the record with sequence number *seq*"""
+        if seq == self.tail_seq - 1:
+            return self._tail
+        elif seq == self.head_seq and self._head != None:
+            return self._head
+        elif self.head_seq <= seq < self.tail_seq:
+            return self._read_seqno(seq)
+        else:
+            return None
+
+    def update_tail(self, obj):
+        self._tail = obj
+        if self.tail_seq == self.head_seq + 1:
+            self._head = obj
+        self.tail_written = None
+        self.dirty = True
+        self._schedule()
+
+    def extend_tail(self, items):
+        """Add *items* to the end of the tail, which is a list.  Only
+        the new items are written when the log is next committed."""
+        self._tail.extend(items)
+        self.dirty = True
+        self._schedule()
+
+    def replace(self, seq, obj):
+        """Change the value of the record with sequence number *seq*,
+        by writing a new copy of it"""
+        if seq == self.tail_seq - 1:
+            return self.update_tail(obj)
+        elif not self.head_seq <= seq < self.tail_seq:
+            return
+        if seq == self.head_seq:
+            self._head = obj
+        t = self.index[seq][3] if seq in self.index else None
+        self._write_record(seq, pickle.dumps(obj, 2), t)
+        self._group_commit()
+
+    def append(self, obj):
+        # the old tail won't change any more, so it can be written out
+        # in one piece
+        seq = self.tail_seq - 1
+        if self.tail_seq > self.head_seq and \
+                (self.dirty or self.extents.get(seq)):
+            self.tail_written = None
+            self._write_tail()
+
+        self._tail = obj
+        self.tail_written = None
+        if self.tail_seq == self.head_seq:
+            self._head = obj
+        self.tail_seq += 1
+        self.dirty = True
+        self._group_commit()
+
+    def pop(self):
+        """Remove the head of the log"""
+        readback = None
+        while self.tail_seq > self.head_seq and readback == None:
+            self._pop()
+            readback = self._head
+            if readback == None and self.tail_seq > self.head_seq:
+                log.err("WARN: disappeared log entry:" +
+                        str(self.head_seq - 1))
+        self._group_commit()
+
+    def drop(self, seq):
+        """Remove every record before *seq* at once"""
+        self._drop(seq)
+        self._group_commit()
+
+    def _pop(self):
+        self._drop(self.head_seq + 1)
+
+    def _drop(self, seq):
+        seq = min(seq, self.tail_seq)
+        if seq <= self.head_seq:
+            return
+        for s in xrange(self.head_seq, seq):
+            self.index.pop(s, None)
+            self.extents.pop(s, None)
+        self.head_seq = seq
+        self.moved = True
+
+        if self.tail_seq == self.head_seq:
+            self._head = self._tail = None
+            self.dirty = False
+        elif self.tail_seq == self.head_seq + 1:
+            self._head = self._tail
+        else:
+            self._head = self._read_seqno(self.head_seq)
+
+    def _schedule(self):
+        if self._timer == None or not self._timer.active():
+            delay = self.last_commit + self.COMMIT_INTERVAL - time.time()
+            self._timer = reactor.callLater(max(delay, 0), self.sync)
+
+    def _group_commit(self):
+        """Commit if enough has been written or enough time has
+        passed since the last commit; otherwise make sure a commit is
+        scheduled"""
+        if self.unsynced >= self.COMMIT_BYTES or \
+                time.time() - self.last_commit >= self.COMMIT_INTERVAL:
+            self.sync()
+        elif self.unsynced or self.dirty or self.moved:
+            self._schedule()
+
+    def sync(self, committed=None):
+        """Write out the tail and head, and commit everything written
+        so far to disk.  *committed* is called once the commit is
+        done; with a writer thread, it is called from that thread."""
+        if self._timer != None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+        if self.failed != None and self.failed == self.segments[-1][0]:
+            self._repair()
+        self._age_buffers()
+        if self.dirty and self.tail_seq > self.head_seq:
+            self._write_tail()
+        self.dirty = False
+        if self.moved:
+            self._write(self.MARKER, self.head_seq,
+                        self.MARKER_BODY.pack(self.head_seq, self.tail_seq))
+            self.moved = False
+        if self.unsynced and self.fsync:
+            self._io('commit', self._do_commit)
+        if committed:
+            if self.writer:
+                self.writer.submit(0, committed)
+            else:
+                committed()
+        self.unsynced = 0
+        self.last_commit = time.time()
+        self._collect()
+
+        if self.seg_size >= self.SEGMENT_SIZE:
+            self._next_segment()
+
+    def close(self, wait=True):
+        """Write out and commit everything, and stop the writer
+        thread.  Returns a Deferred which fires once it has stopped;
+        unless *wait*, that is later, so the reactor isn't held up
+        while the thread finishes writing."""
+        if self.closed: return defer.succeed(None)
+        self.sync()
+        self._io('close', self._do_close)
+        self.closed = True
+        if self.writer:
+            return self.writer.stop(wait)
+        return defer.succeed(None)
+
+    def backlogged(self):
+        """Whether the writer thread has more than *max_staged* bytes
+        waiting to be written"""
+        return self.writer != None and self.writer.backlogged
+
+    def stats(self):
+        """Return the number and latency of writes and commits, how
+        many writes failed, and how far behind the writer thread is"""
+        rv = self.writer.stats() if self.writer else {}
+        with self.lock:
+            for key, name in [('Write', 'write'), ('Commit', 'commit')]:
+                count, total, peak = self.latency.get(name, (0, 0., 0.))
+                rv[key + 's'] = count
+                rv[key + 'Latency'] = total / count if count else 0.
+                rv['Max' + key + 'Latency'] = peak
+            rv['WriteErrors'] = self.write_errors
+        return rv
+
+    def _collect(self):
+        """Remove segments all of whose records have been popped"""
+        # the current segment is never removed, since it has the
+        # latest head marker
+        for seg in self.segments[:-1]:
+            if seg[1] < self.head_seq:
+                self.segments.remove(seg)
+                self._io('remove', os.remove, self._segment_path(seg[0]))
+
+    def _data_time(self, seq):
+        """When the newest data in record *seq* was written"""
+        if seq in self.extents:
+            return self.extents[seq][-1][3]
+        elif seq in self.index:
+            return self.index[seq][3]
+        else:
+            return 0
+
+    def _age_buffers(self):
+        """Remove records whose newest data is older than max_age,
+        all at once.  The tail is never expired, since data is still
+        being added to it."""
+        if self.max_age == None: return
+        cutoff = time.time() - DiskLog._total_seconds(self.max_age)
+        seq = self.head_seq
+        while seq < self.tail_seq - 1 and self._data_time(seq) < cutoff:
+            seq += 1
+        if seq != self.head_seq:
+            self._drop(seq)
+            if self.expired: self.expired()
+
+
+class LogWriter(threading.Thread):
+    """Run file operations for a :py:class:`SegmentedLog` in order,
+    on a thread of their own.
+
+    Data waiting to be written is held in memory.  :py:meth:`submit`
+    never waits for the thread; once more than *max_staged* bytes are
+    waiting, :py:attr:`backlogged` is set until it catches up, so the
+    caller can stop adding data.  How often and for how long that
+    happens is included in :py:meth:`stats`.
+    """
+    def __init__(self, max_staged):
+        threading.Thread.__init__(self, name='LogWriter')
+        self.daemon = True
+        self.max_staged = max_staged
+        self.staged = 0
+        self.backlogged = False
+        self.lock = threading.Lock()
+        self.q = Queue()
+        self.backlogs = 0
+        self.backlog_time = 0.
+        self.backlog_start = None
+
+    def submit(self, nbytes, fn, *args):
+        with self.lock:
+            self.staged += nbytes
+            if not self.backlogged and self.staged > self.max_staged:
+                self.backlogged = True
+                self.backlogs += 1
+                self.backlog_start = time.time()
+        self.q.put((nbytes, fn, args))
+
+    def run(self):
+        while True:
+            item = self.q.get()
+            if item == None: break
+            nbytes, fn, args = item
+            try:
+                fn(*args)
+            except:
+                log.err()
+            with self.lock:
+                self.staged -= nbytes
+                if self.backlogged and self.staged <= self.max_staged:
+                    self.backlogged = False
+                    self.backlog_time += time.time() - self.backlog_start
+
+    def stop(self, wait=True):
+        """Finish the queued operations and stop the thread.  Returns
+        a Deferred which fires once it has; unless *wait*, it fires
+        later, in the reactor thread."""
+        d = defer.Deferred()
+        if wait:
+            self.q.put(None)
+            self.join()
+            d.callback(None)
+        else:
+            self.submit(0, reactor.callFromThread, d.callback, None)
+            self.q.put(None)
+        return d
+
+    def stats(self):
+        with self.lock:
+            return {
+                'Staged' : self.staged,
+                'Backlogged' : self.backlogged,
+                'Backlogs' : self.backlogs,
+                'BacklogTime' : self.backlog_time,
+                }
+
+
+def open_log(dirname, max_age=None, **kwargs):
+    """Open the log in *dirname*.  Logs written by :py:class:`DiskLog`
+    are opened with it; anything else gets a :py:class:`SegmentedLog`,
+    created with *kwargs*.
+    """
+    if os.path.exists(os.path.join(dirname, 'META')):
+        return DiskLog(dirname, max_age)
+    else:
+        return SegmentedLog(dirname, max_age, **kwargs)
+
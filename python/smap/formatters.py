@@ -32,14 +32,15 @@ OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import re
 import zlib
+import struct
 
 from zope.interface import implements
 from twisted.internet.task import cooperate
 from twisted.web import iweb
 
-from smap import schema
-from smap.sjson import AsyncJSON, dumps
-from smap.util import push_metadata, join_path, split_path
+from smap import schema, smapconf
+from smap.sjson import AsyncJSON, SmapEncoder, dumps, loads
+from smap.util import push_metadata, join_path, split_path, np, ReadingBuffer
 from smap.contrib import dtutil
 # from smap.core import SmapException
 
@@ -79,27 +80,68 @@ class StaticProducer(AsyncFormatter):
             self._consumer.write(self._value[i:i+self.BLKSZ])
             yield None
 
-class GzipJson(StaticProducer):
-    content_type = 'application/json'
+class GzipFormatter(AsyncFormatter):
+    """Encode and compress a report incrementally.
+
+    *encoder* is called with the report and returns an iterator over
+    the uncompressed body in pieces; these are fed through a single
+    zlib stream as they are produced, so neither the full encoding nor
+    the full compressed body is ever held in memory.  That also means
+    the length isn't known up front, so the body is sent chunked.  The
+    compression level defaults to the ``CompressionLevel`` server
+    option.
+    """
     content_encoding = 'gzip'
+    BLKSZ = 16384
+    level = 6
 
-    def __init__(self, value):
-        value = dumps(value)
-        self._value = zlib.compress(value)
-        print "%i -> %i" % (len(value), len(self._value))
-        self.length = len(self._value)
+    def __init__(self, value, encoder, level=None):
+        AsyncFormatter.__init__(self, value)
+        self.encoder = encoder
+        if level is None:
+            level = smapconf.SERVER.get('compressionlevel', self.level)
+        self.level = int(level)
+
+    def _produce(self):
+        compressor = zlib.compressobj(self.level)
+        pending, size = [], 0
+        for chunk in self.encoder(self._value):
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= self.BLKSZ:
+                data = compressor.compress(''.join(pending))
+                pending, size = [], 0
+                if data: self._consumer.write(data)
+                yield None
+        self._consumer.write(compressor.compress(''.join(pending)) + 
+                             compressor.flush())
 
-class GzipAvro(StaticProducer):
+class GzipJson(GzipFormatter):
+    content_type = 'application/json'
+
+    def __init__(self, value, level=None):
+        GzipFormatter.__init__(self, value, SmapEncoder().iterencode, level)
+
+class GzipAvro(GzipFormatter):
     content_type = 'avro/binary'
-    content_encoding = 'gzip'
 
-    def __init__(self, value):
-        json = dumps(value)
-        avro = schema.dump_report(value)
-        self._value = zlib.compress(avro)
-        print "json: %i gzip-json: %i avro: %i gzip-avro: %i" % (
-            len(json), len(zlib.compress(json)), len(avro), len(self._value))
-        self.length = len(self._value)
+    def __init__(self, value, level=None):
+        GzipFormatter.__init__(self, value, schema.iter_report, level)
+
+class GzipColumnar(GzipFormatter):
+    content_type = 'application/x-smap-columnar'
+
+    def __init__(self, value, level=None):
+        GzipFormatter.__init__(self, value, iter_columnar, level)
+
+class AsyncColumnar(AsyncFormatter):
+    """Send a report in the columnar format of :py:func:`iter_columnar`"""
+    content_type = 'application/x-smap-columnar'
+
+    def _produce(self):
+        for chunk in iter_columnar(self._value):
+            self._consumer.write(chunk)
+            yield None
 
 class AsyncSmapToCsv(AsyncFormatter):
     """Convert a sMAP report to a simplified CSV format for dumb clients"""
@@ -123,6 +165,8 @@ __FORMATTERS__ = {
     'gzip-json': GzipJson,
     'gzip-avro': GzipAvro,
     'csv': AsyncSmapToCsv,
+    'columnar': AsyncColumnar,
+    'gzip-columnar': GzipColumnar,
     }
 
 def get_formatter(format):
@@ -146,3 +190,180 @@ def load_csv(data):
         obj[path]['Readings'].append([int(ts) * 1000, float(val)])
 
     return obj
+
+
+# columnar reports.  The body starts with COLUMNAR_MAGIC, and then
+# has one entry per path:
+#
+#   varint   header length (never zero)
+#   bytes    json header: [path, object without Readings, count, type]
+#   varint   length of the time column, in bytes
+#   varints  zigzag-encoded differences between successive timestamps
+#   bytes    count values, as little-endian float64 ('d') or int64 ('q')
+#
+# The column fields are only present if count is nonzero, and the
+# body ends with a zero header length.  Sequence numbers are not sent.
+COLUMNAR_MAGIC = 'sMC\x01'
+
+def _write_varint(out, v):
+    while v >= 0x80:
+        out.append((v & 0x7f) | 0x80)
+        v >>= 7
+    out.append(v)
+
+def _read_varint(data, pos):
+    shift = rv = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated columnar report")
+        b = ord(data[pos])
+        rv |= (b & 0x7f) << shift
+        pos += 1
+        if b < 0x80: return rv, pos
+        shift += 7
+
+def _encode_times(times):
+    out, last = bytearray(), 0
+    for t in times:
+        t = int(t)
+        d, last = t - last, t
+        _write_varint(out, (d << 1) ^ (d >> 63))
+    return str(out)
+
+def _decode_times(data, count):
+    """Decode count zigzag delta varints into an int64 array, without
+    looking at each byte in python"""
+    b = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(b < 0x80)
+    if len(ends) != count:
+        raise ValueError("Invalid time column")
+    starts = np.empty(count, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # the position of every byte within its varint
+    shifts = np.arange(len(b)) - np.repeat(starts, ends - starts + 1)
+    parts = (b & 0x7f).astype(np.uint64) << (7 * shifts).astype(np.uint64)
+    v = np.add.reduceat(parts, starts)
+    deltas = (v >> np.uint64(1)).astype(np.int64) ^ \
+        -(v & np.uint64(1)).astype(np.int64)
+    return np.cumsum(deltas)
+
+def _columns(readings):
+    if isinstance(readings, ReadingBuffer):
+        times, values = readings.columns()
+        return times.tolist(), values.tolist()
+    return [r[0] for r in readings], [r[1] for r in readings]
+
+def iter_columnar(report):
+    """Encode a report with each stream's readings stored as columns,
+    yielding one path at a time"""
+    yield COLUMNAR_MAGIC
+    for path, obj in report.iteritems():
+        readings = obj.get('Readings', None) or []
+        times, values = _columns(readings)
+        if all(isinstance(v, (int, long)) and not isinstance(v, bool) 
+               for v in values):
+            vtype = 'q'
+        else:
+            vtype = 'd'
+            values = [float('nan') if v is None else v for v in values]
+        header = dict((k, v) for k, v in obj.iteritems() if k != 'Readings')
+        header = dumps([path, header, len(times), vtype])
+
+        out = bytearray()
+        _write_varint(out, len(header))
+        out.extend(header)
+        if len(times):
+            tcol = _encode_times(times)
+            _write_varint(out, len(tcol))
+            out.extend(tcol)
+            out.extend(struct.pack('<%i%s' % (len(values), vtype), *values))
+        yield str(out)
+    yield '\0'
+
+def dump_columnar(report):
+    return ''.join(iter_columnar(report))
+
+def load_columnar(data):
+    """Load a columnar report.  With numpy, each stream's readings are
+    a :py:class:`~smap.util.ReadingBuffer` filled straight from the
+    columns; otherwise they are lists of ``[time, value]``.
+    """
+    if not data.startswith(COLUMNAR_MAGIC):
+        raise ValueError("Not a columnar report")
+    obj, pos = {}, len(COLUMNAR_MAGIC)
+    while True:
+        hlen, pos = _read_varint(data, pos)
+        if hlen == 0: break
+        path, val, count, vtype = loads(data[pos:pos+hlen])
+        pos += hlen
+        if count:
+            tlen, pos = _read_varint(data, pos)
+            tcol = data[pos:pos+tlen]
+            pos += tlen
+            vlen = 8 * count
+            vcol = data[pos:pos+vlen]
+            pos += vlen
+            if len(vcol) != vlen:
+                raise ValueError("Truncated columnar report")
+            if np is not None:
+                readings = ReadingBuffer(dtype=np.int64 if vtype == 'q' 
+                                         else np.float64)
+                readings.extend_columns(_decode_times(tcol, count),
+                                        np.frombuffer(vcol, '<' + vtype))
+            else:
+                times, tpos, last = [], 0, 0
+                for i in xrange(0, count):
+                    d, tpos = _read_varint(tcol, tpos)
+                    last += (d >> 1) ^ -(d & 1)
+                    times.append(last)
+                values = struct.unpack('<%i%s' % (count, vtype), vcol)
+                readings = map(list, zip(times, values))
+            val['Readings'] = readings
+        obj[path] = val
+    return obj
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import uuid
+
+    class NullConsumer(object):
+        def __init__(self):
+            self.written = 0
+        def write(self, data):
+            self.written += len(data)
+
+    def make_report(streams, readings):
+        now = int(time.time()) * 1000
+        return dict(('/sensor%i' % i, {
+                        'uuid': str(uuid.uuid1()),
+                        'Readings': [[now + j * 1000, j * 0.5]
+                                     for j in xrange(0, readings)]})
+                    for i in xrange(0, streams))
+
+    def timed(fn, n=5):
+        start = time.time()
+        for i in xrange(0, n): rv = fn()
+        return rv, 1000 * (time.time() - start) / n
+
+    def stream(cls, report):
+        f = cls(report)
+        f._consumer = NullConsumer()
+        for x in f._produce(): pass
+        return f._consumer.written
+
+    # compare against encoding the whole report and compressing it in
+    # one go, which is what the formatters used to do
+    for streams, readings in [(1, 100), (10, 1000), (1, 10000), (100, 100)]:
+        report = make_report(streams, readings)
+        for name, cls, encode in [
+            ('gzip-json', GzipJson, dumps),
+            ('gzip-avro', GzipAvro, schema.dump_report),
+            ('gzip-col', GzipColumnar, dump_columnar)]:
+            size, tstatic = timed(lambda: len(zlib.compress(encode(report))))
+            ssize, tstream = timed(lambda: stream(cls, report))
+            print '%-9s %3i x %5i: static %8.03f msec (%i bytes) ' \
+                'streaming %8.03f msec (%i bytes)' % \
+                (name, streams, readings, tstatic, size, tstream, ssize)
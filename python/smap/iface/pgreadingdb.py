@@ -7,6 +7,13 @@ import traceback
 import psycopg2
 import smap.archiver.settings as settings
 
+# rows to pass to each db_add; they are inserted 1000 at a time, but
+# committed together
+BATCH_SIZE = 10000
+
+# errors after which a pooled connection is closed instead of reused
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
 def db_open(host=None, port=None):
     db = psycopg2.connect(host=host,
                           database=settings.DB_DB,
@@ -80,9 +87,29 @@ def db_del(dbp, streamid, starttime, endtime):
           DELETE FROM tsdata
           WHERE streamid = %i AND time >= %i AND time < %i
     """ % (streamid, starttime, endtime))
+        dbp.commit()
     finally:
         cursor.close()
 
+def db_check(dbp):
+    """Check that a connection is still usable before reusing it"""
+    if dbp.closed:
+        return False
+    cursor = dbp.cursor()
+    try:
+        cursor.execute("SELECT 1")
+        dbp.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+    finally:
+        cursor.close()
+
+def db_reset(dbp):
+    """End the transaction left open by a query, so the connection
+    doesn't sit idle in it while it waits in the pool"""
+    dbp.rollback()
+
 def db_close(dbp):
     try:
         dbp.close()
@@ -128,7 +128,7 @@ class IReporting(Interface):
     def update_report(self, rpt):
         pass
 
-    def update_subscriptions(self):
+    def update_subscriptions(self, path=None):
         pass
 
     def publish(self):
@@ -170,9 +170,14 @@ contain a ``uuid`` key to set the root identifier for the source.
                 'uuid' : inst.uuid(s),
                 'MaxAge' : max_age,
                 }
-            for o in ['MinPeriod', 'MaxPeriod', 'MongoDatabaseName', 'MongoCollectionName']:
+            for o in ['MinPeriod', 'MaxPeriod', 'MongoDatabaseName', 'MongoCollectionName',
+                      'Durability', 'OverflowPolicy']:
                 if o in conf[s]:
                     reportinst[o] = conf[s][o]
+            for o in ['MaxInFlight', 'MaxConnections', 'IdleTimeout',
+                      'TargetBytes', 'MaxDelay', 'MaxRecords', 'MaxBytes']:
+                if o in conf[s]:
+                    reportinst[o] = int(conf[s][o])
             for o in ['ClientCertificateFile', 'ClientPrivateKeyFile', 'CAFile']:
                 if o in conf[s]:
                     reportinst[i] = os.path.expanduser(conf[s][o])
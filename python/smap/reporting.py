@@ -31,12 +31,17 @@ OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import os
+import time
+import copy
+import urllib
 import urlparse
 
 from twisted.internet import reactor, task, defer, threads
 from twisted.internet.endpoints import TCP6ClientEndpoint
 from twisted.web.error import SchemeNotSupported
-from twisted.web.client import Agent
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web import iweb
+from zope.interface import implements
 from twisted.web.http_headers import Headers
 from twisted.python import log
 import logging
@@ -60,6 +65,28 @@ BUFSIZE_LIMIT = 100000
 # the most records to pack into a single log entry/message to the server
 REPORT_RECORD_LIMIT = 10000
 
+# how often, in seconds, the positions reports have reached in the log
+# are saved
+CHECKPOINT_INTERVAL = 10
+
+# how carefully a report's pending data is written to disk: ``none``
+# leaves flushing it to the operating system, ``group`` commits it
+# along with other recent writes, about once a second, and ``sync``
+# commits it as soon as it is added.  Disk writes are always done off
+# the main loop.
+DURABILITY = ['none', 'group', 'sync']
+
+# what to do when a report has more data waiting than its
+# ``MaxRecords`` or ``MaxBytes``: skip the oldest segments of the log,
+# stop adding new data until some is delivered, or thin out the
+# readings in the oldest segments by half.
+OVERFLOW_POLICIES = ['drop-oldest', 'drop-newest', 'downsample']
+
+# the estimated size on disk of an entry in the report log, and of
+# each reading in it
+ENTRY_BYTES = 64
+READING_BYTES = 24
+
 def reporting_copy(obj):
     if isinstance(obj, dict):
         rv = dict(obj)
@@ -71,6 +98,8 @@ def reporting_copy(obj):
         for i in xrange(0, len(rv)):
             rv[i] = reporting_copy(rv[i])
         return rv
+    elif isinstance(obj, util.ReadingBuffer):
+        return obj.tolist()
     else:
         return obj
 
@@ -101,15 +130,77 @@ def is_https_url(url):
     return urlparse.urlparse(url).scheme == 'https'
 
 class Agent6(Agent):
-    def _getEndpoint(self, scheme, host, port):
+    def _getEndpoint(self, *args):
+        # newer versions of twisted pass the parsed URI instead of
+        # its parts
+        if len(args) == 1:
+            scheme, host, port = args[0].scheme, args[0].host, args[0].port
+        else:
+            scheme, host, port = args
         try:
-            return super(Agent6, self)._getEndpoint(scheme, host, port)
+            return super(Agent6, self)._getEndpoint(*args)
         except SchemeNotSupported:
             if scheme == 'http6':
                 return TCP6ClientEndpoint(self._reactor, host, port)
             else:
                 raise
 
+class ReportConnectionPool(HTTPConnectionPool):
+    """A pool of persistent connections to report destinations, which
+    limits how many requests are made to each destination at once and
+    keeps count of how many connections it opens and reuses.
+    """
+    def __init__(self, reactor, max_per_host=2, idle_timeout=240):
+        """
+        :param int max_per_host: the most requests to have open to
+         each destination at once; as many idle connections to it
+         are kept
+        :param int idle_timeout: how long to keep idle connections open,
+         in seconds
+        """
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = max_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        # (scheme, host, port) -> DeferredSemaphore
+        self.limits = {}
+        self.requests = self.connections = self.reused = self.handshakes = 0
+        self.waits = 0
+
+    def request(self, agent, method, url, *args):
+        """Make a request with *agent*, once fewer than *max_per_host*
+        requests to the same destination are open"""
+        u = urlparse.urlparse(url)
+        key = (u.scheme, u.hostname, u.port)
+        if not key in self.limits:
+            self.limits[key] = defer.DeferredSemaphore(self.maxPersistentPerHost)
+        limit = self.limits[key]
+        if limit.tokens == 0:
+            self.waits += 1
+        return limit.run(agent.request, method, url, *args)
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        connections = self.connections
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if self.connections == connections:
+            self.reused += 1
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.connections += 1
+        if key[0] == 'https':
+            self.handshakes += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def stats(self):
+        return {
+            'Requests' : self.requests,
+            'Connections' : self.connections,
+            'Reused' : self.reused,
+            'Handshakes' : self.handshakes,
+            'ConnectionWaits' : self.waits,
+            }
+
 class DataBuffer:
     """Buffer outgoing data.
 
@@ -142,7 +233,8 @@ class DataBuffer:
     def sync(self):
         self.data.sync()
 
-    def metric(self, val):
+    @staticmethod
+    def metric(val):
         if hasattr(val, '__iter__'):
             if 'Readings' in val:
                 val_metric = len(val['Readings'])
@@ -215,10 +307,810 @@ class DataBuffer:
             raise util.SmapException("No Pending Data!")
 
 
+class ReportLog:
+    """A log of published data shared by all the subscribers of a
+    :py:class:`Reporting` instance.
+
+    Each published value is copied and written to disk once, along
+    with the ids of the subscribers it is for.  Subscribers read it
+    back through their own :py:class:`ReportCursor`; the log is made
+    of segments of about :py:data:`REPORT_RECORD_LIMIT` readings,
+    which are removed once every cursor has passed them.
+    """
+    # how many segments read back from disk to keep in memory
+    SEGMENT_CACHE = 4
+
+    def __init__(self, datadir):
+        log.msg("Create report log " + datadir)
+        self.data = disklog.open_log(datadir, threaded=True)
+        self.data.expired = self._expired
+        self.cursors = {}
+        # subscribers who want every entry committed as it is added
+        self.durability = {}
+        self.sync_ids = set()
+        self.max_ages = {}
+        # cursors moved forward because their data expired
+        self.expired_ids = set()
+        # id -> (max readings, max bytes, overflow policy)
+        self.limits = {}
+        # subscribers not being sent new data because they're full
+        self.full = set()
+        # id -> tail seq, for subscribers still over their limits once
+        # the policy has done all it can before the tail is sealed
+        self.stuck = {}
+        # seq -> {id -> [entries, readings, bytes]} for each segment
+        self.usage = {}
+        # id -> [readings, bytes] in the segments from settled[id] on,
+        # kept up to date as data is added and delivered
+        self.totals = {}
+        self.settled = {}
+        self.dropped = {}
+        self.thinned = {}
+        # id -> readings not logged because the writer was behind, and
+        # the readings dropped since it fell behind (None if it isn't)
+        self.backlog_dropped = {}
+        self.shedding = None
+        # the number of entries past each cursor
+        self.pending = {}
+        self.segments = {}
+        tail = self.data.tail()
+        self.tail_metric = sum((DataBuffer.metric(v) for _, v, _ in tail)) \
+            if tail else 0
+
+    def __len__(self):
+        head, tail = self.data.bounds()
+        return tail - head
+
+    def end(self):
+        """The position just past the last entry in the log"""
+        head, tail = self.data.bounds()
+        if head == tail:
+            return (tail, 0)
+        else:
+            return (tail - 1, len(self.data.tail()))
+
+    def cursor(self, id, position=None):
+        """Return the cursor for subscriber *id*, creating one at the
+        end of the log if it doesn't exist"""
+        if not id in self.cursors:
+            self.attach(ReportCursor(id, position or self.end()))
+        return self.cursors[id]
+
+    def attach(self, cursor, pending=None, end=None):
+        """Add an existing cursor (for instance, one loaded from disk).
+
+        :param int pending: the number of entries past the cursor when
+         the log ended at position *end*, saved by
+         :py:meth:`checkpoint`.  Only what was added since then is
+         counted; otherwise everything past the cursor is.
+        """
+        head, tail = self.data.bounds()
+        if cursor.position < (head, 0):
+            # segments are only removed once every cursor is past
+            # them, so this data has been delivered.
+            cursor.position = (head, 0)
+            pending = None
+        cursor.log = self
+        self.cursors[cursor.id] = cursor
+        if pending != None and end != None and \
+                cursor.position <= end <= self.end():
+            self.pending[cursor.id] = pending + self.count(cursor.id, end)
+        else:
+            self.pending[cursor.id] = self.count(cursor.id, cursor.position)
+        self._total(cursor.id)
+
+    def checkpoint(self):
+        """The position and pending count of every cursor, and the
+        usage of each segment before the tail, to be saved so they
+        don't have to be rebuilt by reading the log back"""
+        head, tail = self.data.bounds()
+        return {
+            'positions' : dict((id, cursor.position)
+                               for id, cursor in self.cursors.iteritems()),
+            'pending' : dict(self.pending),
+            'end' : self.end(),
+            'usage' : dict((seq, usage) for seq, usage in self.usage.iteritems()
+                           if seq < tail - 1),
+            }
+
+    def restore(self, state):
+        """Reload the segment usage saved by :py:meth:`checkpoint`.
+        Call it before attaching the saved cursors."""
+        head, tail = self.data.bounds()
+        for seq, usage in state.get('usage', {}).iteritems():
+            if head <= seq < tail - 1 and not seq in self.usage:
+                self.usage[seq] = usage
+
+    def remove(self, id):
+        """Remove the cursor for subscriber *id*"""
+        if id in self.cursors:
+            del self.cursors[id]
+            del self.pending[id]
+            del self.totals[id]
+            del self.settled[id]
+            self.durability.pop(id, None)
+            self.max_ages.pop(id, None)
+            self.limits.pop(id, None)
+            self.full.discard(id)
+            self.stuck.pop(id, None)
+            self._update_durability()
+            self._update_max_age()
+            self.collect()
+
+    def configure(self, rpt, max_records=None):
+        """Apply the log settings from a report.  *max_records* is
+        used if it doesn't have a ``MaxRecords``."""
+        self.set_durability(rpt['uuid'], rpt.get('Durability'))
+        self.set_max_age(rpt['uuid'], rpt.get('MaxAge'))
+        self.set_limits(rpt['uuid'], rpt.get('MaxRecords', max_records),
+                        rpt.get('MaxBytes'), rpt.get('OverflowPolicy'))
+
+    def set_limits(self, id, max_records=None, max_bytes=None, policy=None):
+        """Limit how many readings, and how many bytes (estimated),
+        may wait to be delivered to subscriber *id*.  Limits are
+        checked as data is added; *policy* is one of
+        :py:data:`OVERFLOW_POLICIES` and says what to do when they are
+        exceeded."""
+        policy = policy or 'drop-oldest'
+        if not policy in OVERFLOW_POLICIES:
+            raise util.SmapException("Invalid OverflowPolicy: " + str(policy), 400)
+        self.stuck.pop(id, None)
+        if max_records == None and max_bytes == None:
+            self.limits.pop(id, None)
+            self.full.discard(id)
+        else:
+            self.limits[id] = (max_records, max_bytes, policy)
+            if policy != 'drop-newest':
+                self.full.discard(id)
+
+    def overflow_stats(self, id):
+        """How much data is waiting for subscriber *id*, and how much
+        has been lost to its limits"""
+        readings, nbytes = self._pending_usage(id)
+        return {
+            'PendingRecords' : readings,
+            'PendingBytes' : nbytes,
+            'Dropped' : self.dropped.get(id, 0),
+            'Thinned' : self.thinned.get(id, 0),
+            'BacklogDropped' : self.backlog_dropped.get(id, 0),
+            }
+
+    def pending_readings(self, id):
+        """How many readings are waiting for subscriber *id*"""
+        return self._pending_usage(id)[0]
+
+    @staticmethod
+    def _entry_usage(key, val):
+        readings = DataBuffer.metric(val)
+        return readings, ENTRY_BYTES + len(key) + READING_BYTES * readings
+
+    def _usage(self, seq):
+        """Usage of segment *seq* by each subscriber"""
+        if not seq in self.usage:
+            usage = self.usage[seq] = {}
+            for key, val, ids in self._segment(seq):
+                readings, nbytes = self._entry_usage(key, val)
+                for id in ids:
+                    u = usage.setdefault(id, [0, 0, 0])
+                    u[0] += 1; u[1] += readings; u[2] += nbytes
+        return self.usage[seq]
+
+    def _pending_usage(self, id):
+        """The readings and bytes in segments the cursor for *id*
+        hasn't passed"""
+        if not id in self.cursors:
+            return 0, 0
+        self._settle(id)
+        return tuple(self.totals[id])
+
+    def _total(self, id):
+        """Add up the usage of the segments the cursor for *id* hasn't
+        passed"""
+        head, tail = self.data.bounds()
+        start = max(head, self.cursors[id].position[0])
+        total = [0, 0]
+        for seq in xrange(start, tail):
+            u = self._usage(seq).get(id)
+            if u:
+                total[0] += u[1]
+                total[1] += u[2]
+        self.totals[id], self.settled[id] = total, start
+
+    def _settle(self, id):
+        """Take the segments the cursor for *id* has moved past out of
+        its running total"""
+        head, tail = self.data.bounds()
+        start, end = self.settled[id], max(head, self.cursors[id].position[0])
+        if end <= start:
+            return
+        elif start < head and \
+                not all((seq in self.usage for seq in xrange(start, head))):
+            # expired before we could count it
+            return self._total(id)
+        total = self.totals[id]
+        for seq in xrange(start, end):
+            u = self._usage(seq).get(id)
+            if u:
+                total[0] -= u[1]
+                total[1] -= u[2]
+        self.settled[id] = end
+
+    @staticmethod
+    def _over(limits, readings, nbytes):
+        max_records, max_bytes, _ = limits
+        return (max_records != None and readings > max_records) or \
+            (max_bytes != None and nbytes > max_bytes)
+
+    def _enforce(self, ids):
+        """Apply the overflow policy of each subscriber in *ids* which
+        is over its limits"""
+        tail = self.data.bounds()[1]
+        dropped = False
+        for id in ids:
+            limits = self.limits.get(id)
+            if not limits or self.stuck.get(id) == tail:
+                continue
+            readings, nbytes = self._pending_usage(id)
+            if not self._over(limits, readings, nbytes):
+                continue
+            elif limits[2] == 'drop-newest':
+                self.full.add(id)
+                continue
+            elif limits[2] == 'downsample':
+                self._downsample(id, limits, readings, nbytes)
+            else:
+                self._drop_oldest(id, limits, readings, nbytes)
+                dropped = True
+            if self._over(limits, *self._pending_usage(id)):
+                # the tail can't be touched, so wait until it's sealed
+                self.stuck[id] = tail
+        if dropped:
+            self.collect()
+
+    def _drop_oldest(self, id, limits, readings, nbytes):
+        """Move the cursor for *id* past whole segments until it is
+        within its limits"""
+        cursor = self.cursors[id]
+        head, tail = self.data.bounds()
+        (seq, off), skipped, dropped = cursor.position, 0, 0
+        seq = max(seq, head)
+        # never skip the tail, since we're still adding to it
+        while seq < tail - 1 and self._over(limits, readings, nbytes):
+            u = self._usage(seq).get(id, [0, 0, 0])
+            readings -= u[1]
+            nbytes -= u[2]
+            for key, val, ids in self._segment(seq)[off:]:
+                if id in ids:
+                    skipped += 1
+                    dropped += DataBuffer.metric(val)
+            seq, off = seq + 1, 0
+        if skipped:
+            cursor.position = (seq, 0)
+            self._settle(id)
+            self.pending[id] -= skipped
+            self.dropped[id] = self.dropped.get(id, 0) + dropped
+            # in case some of it was being delivered
+            self.expired_ids.add(id)
+
+    def _downsample(self, id, limits, readings, nbytes):
+        """Halve the resolution of the oldest segments waiting for
+        *id* until it is within its limits.  Entries also waiting for
+        subscribers which don't downsample are left alone."""
+        head, tail = self.data.bounds()
+        seq = max(head, self.cursors[id].position[0])
+        while seq < tail - 1 and self._over(limits, readings, nbytes):
+            segment, changed = [], False
+            for key, val, ids in self._segment(seq):
+                if 'Readings' in val and len(val['Readings']) > 1 and \
+                        all((self.limits.get(i, (0, 0, None))[2] == 'downsample'
+                             for i in ids)):
+                    kept = val['Readings'][::2]
+                    thinned = len(val['Readings']) - len(kept)
+                    for i in ids:
+                        self.thinned[i] = self.thinned.get(i, 0) + thinned
+                    val = dict(val)
+                    val['Readings'] = kept
+                    changed = True
+                segment.append((key, val, ids))
+            if changed:
+                before = self._usage(seq)
+                self.data.replace(seq, segment)
+                self.segments[seq] = segment
+                del self.usage[seq]
+                after = self._usage(seq)
+                for i, u in before.iteritems():
+                    if i in self.totals and self.settled[i] <= seq:
+                        self.totals[i][0] -= u[1] - after[i][1]
+                        self.totals[i][1] -= u[2] - after[i][2]
+                u = before.get(id, [0, 0, 0])
+                readings -= u[1] - after.get(id, u)[1]
+                nbytes -= u[2] - after.get(id, u)[2]
+            seq += 1
+
+    def set_max_age(self, id, max_age):
+        """Set how many seconds subscriber *id* wants data kept for.
+        Since the log is shared, data is only expired once it is older
+        than every subscriber's ``MaxAge``."""
+        self.max_ages[id] = max_age
+        self._update_max_age()
+
+    def _update_max_age(self):
+        ages = [self.max_ages.get(id) for id in self.cursors]
+        if len(ages) and not None in ages:
+            self.data.max_age = max(ages)
+        else:
+            self.data.max_age = None
+
+    def _expired(self):
+        """Move cursors past records removed by ``MaxAge``"""
+        head, tail = self.data.bounds()
+        for seq in [seq for seq in self.segments if seq < head]:
+            del self.segments[seq]
+        for id, cursor in self.cursors.iteritems():
+            if cursor.position < (head, 0):
+                cursor.position = (head, 0)
+                self.pending[id] = self.count(id, cursor.position)
+                self._settle(id)
+                self.expired_ids.add(id)
+        for seq in [seq for seq in self.usage if seq < head]:
+            del self.usage[seq]
+
+    def set_durability(self, id, level=None):
+        """Set how carefully the data for subscriber *id* is written
+        to disk.  The level is one of :py:data:`DURABILITY`; the log
+        is committed as carefully as its most demanding subscriber
+        asks for.
+        """
+        level = level or 'group'
+        if not level in DURABILITY:
+            raise util.SmapException("Invalid Durability: " + str(level), 400)
+        self.durability[id] = level
+        self._update_durability()
+
+    def _update_durability(self):
+        levels = set(self.durability.itervalues())
+        self.sync_ids = set((id for id, level in self.durability.iteritems() 
+                             if level == 'sync'))
+        self.data.fsync = levels != set(['none'])
+
+    def _segment(self, seq):
+        head, tail = self.data.bounds()
+        if seq == tail - 1:
+            return self.data.tail()
+        elif not seq in self.segments:
+            if len(self.segments) >= self.SEGMENT_CACHE:
+                del self.segments[min(self.segments)]
+            self.segments[seq] = self.data.get(seq) or []
+        return self.segments[seq]
+
+    def _entries(self, position):
+        """Iterate over (position, entry) tuples starting at *position*"""
+        seq, off = position
+        head, tail = self.data.bounds()
+        while seq < tail:
+            segment = self._segment(seq)
+            while off < len(segment):
+                yield (seq, off), segment[off]
+                off += 1
+            seq, off = seq + 1, 0
+
+    def count(self, id, position):
+        """Count the entries for *id* after *position*.  Only the
+        segment *position* is in has to be read; the rest are counted
+        from their usage."""
+        head, tail = self.data.bounds()
+        seq, off = max(position, (head, 0))
+        count = 0
+        if off > 0 and seq < tail:
+            count += sum((1 for _, _, ids in self._segment(seq)[off:]
+                          if id in ids))
+            seq += 1
+        for seq in xrange(seq, tail):
+            count += self._usage(seq).get(id, [0])[0]
+        return count
+
+    def add(self, key, val, ids):
+        """Append a value for the subscribers in *ids*
+
+        :param string key: The key for the data stream
+        :param val: The new value for the object.  Copied.
+        :param ids: the ids of the subscribers to deliver it to
+        """
+        ids = tuple((id for id in ids if id in self.cursors))
+        if len(ids) == 0:
+            return
+        val_metric = DataBuffer.metric(val)
+        readings, nbytes = self._entry_usage(key, val)
+        tail = self.data.tail()
+        roll = tail == None or self.tail_metric >= REPORT_RECORD_LIMIT
+        if self.full:
+            for id in self.full.intersection(ids):
+                self.dropped[id] = self.dropped.get(id, 0) + val_metric
+            ids = tuple((id for id in ids if not id in self.full))
+            if len(ids) == 0:
+                return
+        if self.data.backlogged():
+            # the disk isn't keeping up.  What is already waiting to
+            # be written can't be taken back, so the only way to shed
+            # load without blocking the reactor is to drop new data;
+            # reports which asked for sync durability still get theirs.
+            if self.shedding == None:
+                log.msg("Report log writer is behind; dropping new data "
+                        "for reports without sync Durability")
+                self.shedding = 0
+            kept = tuple((id for id in ids if id in self.sync_ids))
+            for id in ids:
+                if not id in self.sync_ids:
+                    self.backlog_dropped[id] = \
+                        self.backlog_dropped.get(id, 0) + val_metric
+            if len(kept) < len(ids):
+                self.shedding += val_metric
+            ids = kept
+            if len(ids) == 0:
+                return
+        elif self.shedding != None:
+            log.msg("Report log writer caught up; %i readings were dropped" %
+                    self.shedding)
+            self.shedding = None
+        entry = (key, reporting_copy(val), ids)
+
+        if roll:
+            self.data.append([entry])
+            self.tail_metric = val_metric
+            usage = self.usage[self.data.bounds()[1] - 1] = {}
+        else:
+            usage = self._usage(self.data.bounds()[1] - 1)
+            self.data.extend_tail([entry])
+            self.tail_metric += val_metric
+        for id in ids:
+            u = usage.setdefault(id, [0, 0, 0])
+            u[0] += 1; u[1] += readings; u[2] += nbytes
+            self.totals[id][0] += readings
+            self.totals[id][1] += nbytes
+            self.pending[id] += 1
+        if self.limits:
+            self._enforce([id for id in ids if id in self.limits])
+        if self.sync_ids and not self.sync_ids.isdisjoint(ids):
+            self.data.sync()
+
+    @staticmethod
+    def _merge(rv, key, val):
+        """Add an entry to a report object being read back, following
+        the same rules as :py:meth:`DataBuffer.add`.  Returns False if
+        the entry must go in the next report."""
+        if 'Contents' in val and len(val['Contents']) == 0:
+            pass
+        elif key in rv and len(val) == 2 and \
+                'Readings' in val and 'uuid' in val:
+            rv[key].setdefault('Readings', []).extend(val['Readings'])
+        elif key in rv and val == rv[key]:
+            pass
+        elif not key in rv:
+            rv[key] = dict(val)
+            if 'Readings' in val:
+                rv[key]['Readings'] = list(val['Readings'])
+        else:
+            return False
+        return True
+
+    def read(self, id, position, limit=None):
+        """Read back a report object for subscriber *id* starting at
+        *position*.
+
+        :param int limit: the most readings to put in the report;
+         :py:data:`REPORT_RECORD_LIMIT` by default.
+        :rvalue: report, end, count.  ``end`` is the position after
+         the last entry in the report and ``count`` is the number of
+         entries for *id* it contains.
+        """
+        limit = limit or REPORT_RECORD_LIMIT
+        rv, metric, count = {}, 0, 0
+        end = position
+        for pos, (key, val, ids) in self._entries(position):
+            if id in ids:
+                if not self._merge(rv, key, val):
+                    return rv, pos, count
+                count += 1
+                metric += DataBuffer.metric(val)
+            end = (pos[0], pos[1] + 1)
+            if metric >= limit:
+                break
+        return rv, end, count
+
+    def consumed(self, id, position, count):
+        """Move the cursor for subscriber *id* past data it has
+        delivered"""
+        if not id in self.cursors:
+            # removed while the data was being delivered
+            return
+        if id in self.expired_ids:
+            # some of what was delivered may have expired already
+            self.expired_ids.discard(id)
+            self.pending[id] = self.count(id, self.cursors[id].position)
+        else:
+            self.pending[id] -= count
+        self._settle(id)
+        if id in self.full and \
+                not self._over(self.limits[id], *self._pending_usage(id)):
+            self.full.discard(id)
+        self.collect()
+
+    def collect(self):
+        """Remove segments which every cursor has passed"""
+        head, tail = self.data.bounds()
+        if len(self.cursors):
+            oldest = min((c.position[0] for c in self.cursors.itervalues()))
+        else:
+            oldest = tail
+        # never remove the tail, since we are still adding to it
+        end = min(oldest, tail - 1)
+        if head < end:
+            for seq in xrange(head, end):
+                self.segments.pop(seq, None)
+                self.usage.pop(seq, None)
+            self.data.drop(end)
+
+    def sync(self):
+        self.data.sync()
+
+    def close(self, wait=True):
+        """Close the log.  Returns a Deferred which fires once it is
+        all on disk; see :py:meth:`~smap.disklog.SegmentedLog.close`."""
+        return self.data.close(wait)
+
+    def stats(self):
+        """Statistics about writing the log to disk"""
+        if hasattr(self.data, 'stats'):
+            return self.data.stats()
+        return {}
+
+
+class ReportStore:
+    """Saved report definitions, and the positions of their cursors
+    in the :py:class:`ReportLog`.
+
+    Each report is pickled to its own file, so adding or changing one
+    only rewrites that report; the cursor positions are kept together
+    in one small file, since they all change as data is delivered,
+    along with the counts needed to attach them to the log again.
+    Neither contains any of the pending data, which stays in the log.
+    """
+    PREFIX = 'report-'
+    # fields which are recomputed when a report is loaded
+    TRANSIENT = ['PendingData', 'Topics']
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def _filename(self, id):
+        return os.path.join(self.dirname,
+                            self.PREFIX + urllib.quote(str(id), safe=''))
+
+    def save(self, rpt):
+        """Save the definition of one report"""
+        rpt = copy.copy(rpt)
+        for k in self.TRANSIENT:
+            rpt.pop(k, None)
+        util.pickle_dump(self._filename(rpt['uuid']), rpt)
+
+    def remove(self, id):
+        try:
+            os.remove(self._filename(id))
+        except OSError:
+            pass
+
+    def load(self):
+        """Return all of the saved reports, without their cursors"""
+        rv = []
+        for name in sorted(os.listdir(self.dirname)):
+            if name.startswith(self.PREFIX) and not name.endswith('.tmp'):
+                rpt = util.pickle_load(os.path.join(self.dirname, name))
+                if rpt != None:
+                    rv.append(rpt)
+                else:
+                    log.msg("Could not load saved report " + name)
+        return rv
+
+    def save_positions(self, state):
+        """Save the cursor state from :py:meth:`ReportLog.checkpoint`"""
+        util.pickle_dump(os.path.join(self.dirname, 'cursors'), state)
+
+    def positions(self):
+        """The saved cursor state; ``positions`` has the position of
+        each cursor by report id"""
+        state = util.pickle_load(os.path.join(self.dirname, 'cursors')) or {}
+        if not isinstance(state.get('positions'), dict):
+            # older versions only saved the positions
+            state = {'positions' : state}
+        return state
+
+
+class ReportCursor(object):
+    """A subscriber's position in a :py:class:`ReportLog`.  Has the
+    same interface as :py:class:`DataBuffer`, so it can be used as a
+    report's ``PendingData``.
+    """
+    def __init__(self, id, position):
+        self.id = id
+        self.position = position
+        self.read_position = None
+        self.log = None
+
+    def __getstate__(self):
+        # the log is shared, so we only save our position in it
+        return {'id' : self.id, 'position' : self.position}
+
+    def __setstate__(self, state):
+        self.__init__(state['id'], state['position'])
+
+    def __str__(self):
+        return "ReportCursor len: %i" % len(self)
+
+    def __len__(self):
+        return self.log.pending[self.id]
+
+    def sync(self):
+        self.log.sync()
+
+    def readings(self):
+        """The number of readings waiting to be delivered, as opposed
+        to the number of entries, which may hold many readings each"""
+        return self.log.pending_readings(self.id)
+
+    def add(self, key, val):
+        """Enqueue a new object for delivery to only this subscriber"""
+        self.log.add(key, val, [self.id])
+
+    def read(self):
+        """Read back a report object starting at the cursor.  Reading
+        does not move the cursor; :py:meth:`truncate` removes the data
+        which was read."""
+        rv, end, count = self.read_from(self.position)
+        self.read_position = end, count
+        return rv
+
+    def read_from(self, position, skip=0, limit=None):
+        """Read a report object starting at *position*, which may be
+        past the cursor if earlier data is still being delivered.
+
+        :param int skip: the number of entries for this subscriber
+         between the cursor and *position*.
+        :param int limit: the most readings to return
+        :rvalue: report, end, count as for :py:meth:`ReportLog.read`
+        """
+        if len(self) - skip <= 0:
+            raise util.SmapException("No Pending Data!")
+        return self.log.read(self.id, position, limit)
+
+    def truncate(self):
+        """Move the cursor past the data returned by the last read"""
+        if self.read_position == None: return
+        end, count = self.read_position
+        self.advance(end, count)
+
+    def advance(self, position, count):
+        """Move the cursor to *position*, past *count* entries for
+        this subscriber which have been delivered"""
+        # the cursor may have been moved further by expiry
+        self.position = max(self.position, position)
+        self.read_position = None
+        self.log.consumed(self.id, position, count)
+
+
+class BatchPolicy(object):
+    """Choose how many readings to send to a report destination at
+    once.
+
+    If a target size in bytes is given, the batch size is adapted to
+    the destination: it is capped by the target size using the
+    observed bytes per reading, grows while full batches are delivered
+    within the target latency, and is halved when a delivery is slow
+    or fails.  Otherwise it stays at :py:data:`REPORT_RECORD_LIMIT`.
+    """
+    MIN_SIZE = 10
+    MAX_SIZE = BUFSIZE_LIMIT
+
+    def __init__(self, target_bytes=None, target_latency=10):
+        """
+        :param int target_bytes: the desired size of a report body
+        :param float target_latency: the longest a delivery should take, in seconds
+        """
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.size = REPORT_RECORD_LIMIT
+        self.bytes_per_reading = None
+        self.failure_rate = 0.
+        self.started = None
+        self.delivered = self.delivered_bytes = self.failures = 0
+
+    def _clamp(self, size):
+        if self.bytes_per_reading:
+            size = min(size, self.target_bytes / self.bytes_per_reading)
+        return int(max(self.MIN_SIZE, min(self.MAX_SIZE, size)))
+
+    def success(self, readings, nbytes, latency):
+        """Record a successful delivery of *readings* readings in a
+        body of *nbytes* bytes, which took *latency* seconds"""
+        if self.started == None:
+            self.started = time.time() - latency
+        self.delivered += readings
+        self.delivered_bytes += nbytes
+        self.failure_rate *= 0.9
+        if readings > 0 and nbytes > 0:
+            bpr = float(nbytes) / readings
+            if self.bytes_per_reading == None:
+                self.bytes_per_reading = bpr
+            else:
+                self.bytes_per_reading = 0.8 * self.bytes_per_reading + 0.2 * bpr
+
+        if not self.target_bytes: return
+        if latency > self.target_latency:
+            self.size = self._clamp(self.size / 2)
+        elif readings >= self.size:
+            # only grow if the batch size was what limited us
+            self.size = self._clamp(self.size * 1.5)
+        else:
+            self.size = self._clamp(self.size)
+
+    def failure(self):
+        """Record a failed delivery"""
+        self.failures += 1
+        self.failure_rate = 0.9 * self.failure_rate + 0.1
+        if self.target_bytes:
+            self.size = self._clamp(self.size / 2)
+
+    def stats(self):
+        elapsed = time.time() - self.started if self.started != None else 0
+        return {
+            'BatchSize' : self.size,
+            'Delivered' : self.delivered,
+            'DeliveredBytes' : self.delivered_bytes,
+            'Failures' : self.failures,
+            'FailureRate' : self.failure_rate,
+            'Throughput' : self.delivered / elapsed if elapsed > 0 else 0.,
+            'ByteThroughput' : self.delivered_bytes / elapsed if elapsed > 0 else 0.,
+            }
+
+
+class CountingProducer(object):
+    """Wrap a body producer to count the bytes it writes"""
+    implements(iweb.IBodyProducer)
+
+    def __init__(self, producer):
+        self.producer = producer
+        self.length = producer.length
+        self.written = 0
+
+    def startProducing(self, consumer):
+        self.consumer = consumer
+        return self.producer.startProducing(self)
+
+    def write(self, data):
+        self.written += len(data)
+        self.consumer.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self.consumer.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self.consumer.unregisterProducer()
+
+    def pauseProducing(self):
+        self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.producer.resumeProducing()
+
+    def stopProducing(self):
+        self.producer.stopProducing()
+
+
 class MongoReportInstance(dict):
     """Publish latest data to Mongo store
     """
-    def __init__(self, datadir, *args):
+    def __init__(self, pending, *args):
         from pymongo import MongoClient
         dict.__init__(self, *args)
         u = urlparse.urlparse(self['ReportDeliveryLocation'][0])
@@ -229,8 +1121,7 @@ class MongoReportInstance(dict):
         if 'MongoCollectionName' not in self:
             self['MongoCollectionName'] = 'points'
         self['MongoDatabase'] = getattr(self['MongoClient'], self['MongoDatabaseName'])
-        self['DataDir'] = datadir
-        self['PendingData'] = DataBuffer(datadir)
+        self['PendingData'] = pending
 
     @staticmethod
     def accepts(dests):
@@ -271,18 +1162,76 @@ class MongoReportInstance(dict):
 class HttpReportInstance(dict):
     """Represent the stored state pending for one report destination
     """
-    def __init__(self, datadir, *args):
+    def __init__(self, pending, *args):
         dict.__init__(self, *args)
         if not 'MinPeriod' in self:
             self['MinPeriod'] = 0
         if not 'MaxPeriod' in self:
             self['MaxPeriod'] = 2 ** 31 - 1
-        self['DataDir'] = datadir
-        self['PendingData'] = DataBuffer(datadir)
+        if not 'MaxInFlight' in self:
+            self['MaxInFlight'] = 1
+        self['PendingData'] = pending
         self['ReportDeliveryIdx'] = 0
         self['LastAttempt'] = 0
         self['LastSuccess'] = 0
         self['Busy'] = False
+        self.reset()
+
+    def __getstate__(self):
+        # open connections can't be saved
+        return dict((k, v) for (k, v) in self.__dict__.iteritems()
+                    if not k in ['pool', 'agents'])
+
+    def get_policy(self):
+        if getattr(self, 'policy', None) == None:
+            self.policy = BatchPolicy()
+        self.policy.target_bytes = self.get('TargetBytes')
+        return self.policy
+
+    def get_pool(self):
+        if getattr(self, 'pool', None) == None:
+            self.pool = ReportConnectionPool(reactor, 
+                self.get('MaxConnections') or self.get('MaxInFlight', 1),
+                self.get('IdleTimeout') or ReportConnectionPool.cachedConnectionTimeout)
+            self.agents = {}
+        return self.pool
+
+    def get_agent(self, url):
+        """Return an agent for delivering to *url*.  Connections are
+        kept open and reused between deliveries.
+        """
+        self.get_pool()
+        https = is_https_url(url)
+        if not https in self.agents:
+            if https:
+                self.agents[https] = Agent6(reactor, SslClientContextFactory(self),
+                                            pool=self.pool)
+            else:
+                self.agents[https] = Agent6(reactor, pool=self.pool)
+        return self.agents[https]
+
+    def close(self):
+        """Close any idle connections"""
+        if getattr(self, 'pool', None) != None:
+            pool, self.pool = self.pool, None
+            return pool.closeCachedConnections()
+
+    def stats(self):
+        """Return statistics about deliveries to this destination"""
+        rv = self.get_policy().stats()
+        rv.update(self.get_pool().stats())
+        pending = self['PendingData']
+        if hasattr(pending, 'log'):
+            rv['Log'] = pending.log.stats()
+            rv.update(pending.log.overflow_stats(pending.id))
+        return rv
+
+    def reset(self):
+        """Forget about any deliveries in progress"""
+        # the chunks of the log which have been sent, in order
+        self['InFlight'] = []
+        self['Failed'] = False
+        self['Busy'] = False
 
     @staticmethod
     def accepts(dests):
@@ -297,8 +1246,15 @@ class HttpReportInstance(dict):
         """
         now = util.now()
         if self.get('Paused', False): return False
+        pending = len(self['PendingData'])
+        # the batch size is in readings, and each entry may hold many
+        if self.get('MaxDelay') != None and pending > 0 and \
+                self['PendingData'].readings() < self.get_policy().size and \
+                now - self['LastSuccess'] < self['MaxDelay']:
+            # wait for a full batch, or until the data is too old
+            pending = 0
         return (now - self['LastSuccess'] > self['MaxPeriod']) or \
-            (len(self['PendingData']) > 0 and \
+            (pending > 0 and \
                  (now - self['LastSuccess']) > self['MinPeriod'])
 
     def _log_response(self, resp, url):
@@ -309,100 +1265,157 @@ class HttpReportInstance(dict):
         done.addCallback(response_printer)
         return done
 
-    def _success(self, resp):
-        self['Busy'] = False
+    def _settle(self):
+        """Move the cursor past the acknowledged chunks at the front
+        of the pipeline.  Once everything sent before a failure has
+        finished, start over from the cursor."""
+        inflight = self['InFlight']
+        while len(inflight) and inflight[0]['State'] == 'acked':
+            chunk = inflight.pop(0)
+            self['PendingData'].advance(chunk['End'], chunk['Count'])
+        if self['Failed'] and \
+                not util.find(lambda c: c['State'] == 'sent', inflight):
+            # chunks which were acknowledged after the failure are
+            # sent again
+            del inflight[:]
+            self['Failed'] = False
+        self['Busy'] = self['Failed'] or \
+            len(inflight) >= self.get('MaxInFlight', 1)
+
+    def _next_location(self, chunk):
+        chunk['State'] = 'failed'
+        self.get_policy().failure()
+        # only move on once for all of the chunks in flight to a
+        # failed location
+        if not self['Failed']:
+            self['Failed'] = True
+            self['ReportDeliveryIdx'] = ((self['ReportDeliveryIdx'] + 1) %
+                                         len(self['ReportDeliveryLocation']))
+
+    def _success(self, resp, chunk, body):
         if resp.code in [200, 201, 204]:
             # on success record the time and remove the data
             self['LastSuccess'] = util.now()
-            self['PendingData'].truncate()
-            if len(self['PendingData']) > 0:
+            chunk['State'] = 'acked'
+            self.get_policy().success(chunk['Readings'], body.written,
+                                      time.time() - chunk['Sent'])
+            # after a failure, wait for the next flush to try again
+            failed = self['Failed']
+            self._settle()
+            if not failed and len(self['PendingData']) > 0:
                 # this causes a new deferred to get added to
                 # the chain, so we continue immediately at the
                 # next log position if this one worked.
-                return self.attempt()
+                return self.attempt() or resp
             else:
                 return resp
         else:
             # but most HTTP codes indicate a failure
             log.msg("Report delivery to %s returned %i" % (
-                    self['ReportDeliveryLocation'][self['ReportDeliveryIdx']],
-                    resp.code))
-            response = self._log_response(resp, 
-                     self['ReportDeliveryLocation'][self['ReportDeliveryIdx']])
-            self['ReportDeliveryIdx'] = ((self['ReportDeliveryIdx'] + 1) %
-                                         len(self['ReportDeliveryLocation']))
+                    chunk['Location'], resp.code))
+            response = self._log_response(resp, chunk['Location'])
+            self._next_location(chunk)
+            self._settle()
             return response
 
-    def _failure(self, fail):
-        self['Busy'] = False
+    def _failure(self, fail, chunk):
         try:
             log.msg("Report delivery to %s failed: %s" %
-                    (self['ReportDeliveryLocation'][self['ReportDeliveryIdx']],
-                     str(fail.value)))
-            self['ReportDeliveryIdx'] = ((self['ReportDeliveryIdx'] + 1) %
-                                         len(self['ReportDeliveryLocation']))
+                    (chunk['Location'], str(fail.value)))
+            self._next_location(chunk)
+            self._settle()
         except:
             log.err()
         return fail
 
     def attempt(self):
-        """Try to make a delivery
+        """Try to make a delivery.  Up to ``MaxInFlight`` consecutive
+        chunks of the log are sent at once; the log is only truncated
+        up to the last chunk for which it and all earlier chunks were
+        acknowledged.
+
         :rvalue: a :py:class:`Deferred` of the attempt
         """
-        if ('Busy' in self and self['Busy']) or \
-                ('Paused' in self and self['Paused']):
+        if not 'InFlight' in self:
+            # loaded from a report saved before pipelining
+            self.reset()
+        if self['Busy'] or self.get('Paused', False):
+            return
+
+        deliveries = []
+        while len(self['InFlight']) < self.get('MaxInFlight', 1):
+            d = self._send()
+            if d == None: break
+            deliveries.append(d)
+
+        self['Busy'] = len(self['InFlight']) >= self.get('MaxInFlight', 1)
+        if len(deliveries) == 0:
+            return
+        elif len(deliveries) == 1:
+            return deliveries[0]
+        else:
+            return defer.DeferredList(deliveries, fireOnOneErrback=True, 
+                                      consumeErrors=True)
+
+    def _send(self):
+        """Send the next chunk of the log
+        :rvalue: a :py:class:`Deferred` of the delivery, or None
+        """
+        inflight = self['InFlight']
+        if len(inflight):
+            position = inflight[-1]['End']
+        else:
+            position = self['PendingData'].position
+        if len(inflight) and \
+                len(self['PendingData']) <= sum((c['Count'] for c in inflight)):
+            # everything is already on its way
             return
 
         try:
-            data = self['PendingData'].read()
-            if data == None:
-                self['PendingData'].truncate()
-                return
+            data, end, count = self['PendingData'].read_from(
+                position, sum((c['Count'] for c in inflight)),
+                self.get_policy().size)
         except:
             log.err()
             return
 
         self['LastAttempt'] = util.now()
+        dest_url = self['ReportDeliveryLocation'][self['ReportDeliveryIdx']]
+        readings = [len(x['Readings']) 
+                    for x in data.itervalues() 
+                    if 'Readings' in x]
         log.msg("publishing to %s: %i %s" % 
-                (self['ReportDeliveryLocation'][self['ReportDeliveryIdx']],
-                 len(data), 
-                 str([len(x['Readings']) 
-                      for x in data.itervalues() 
-                      if 'Readings' in x])),
+                (dest_url, len(data), str(readings)),
                 logLevel=logging.DEBUG)
-        # set up an agent to push the data to the consumer
-
-        dest_url = self['ReportDeliveryLocation'][self['ReportDeliveryIdx']]
-        if is_https_url(dest_url):
-            agent = Agent6(reactor, SslClientContextFactory(self))
-        else:
-            agent = Agent6(reactor)
-
         try:
+            # set up an agent to push the data to the consumer
+            agent = self.get_agent(dest_url)
             formatter = get_formatter(self.get('Format', 'json'))
             headers = {'Content-type' : [formatter.content_type]}
             if formatter.content_encoding:
                 headers['Content-encoding'] = [formatter.content_encoding]
-            d = agent.request('POST',
-                              dest_url,
-                              Headers(headers),
-                              formatter(data))
+            body = CountingProducer(formatter(data))
+            d = self.get_pool().request(agent, 'POST', dest_url,
+                                        Headers(headers), body)
         except:
             log.err()
             return
 
-        self['Busy'] = True
-        d.addCallback(self._success)
-        d.addErrback(self._failure)
+        chunk = {'End' : end, 'Count' : count, 
+                 'Location' : dest_url, 'State' : 'sent',
+                 'Readings' : sum(readings), 'Sent' : time.time()}
+        inflight.append(chunk)
+        d.addCallback(self._success, chunk, body)
+        d.addErrback(self._failure, chunk)
         return d
 # default for backwards compatibility
 ReportInstance = HttpReportInstance
 
 
 class PlotlyReportInstance(dict):
-    def __init__(self, datadir, *args):
+    def __init__(self, pending, *args):
         dict.__init__(self, *args)
-        self['PendingData'] = DataBuffer(datadir)
+        self['PendingData'] = pending
         u = urlparse.urlparse(self['ReportDeliveryLocation'][0])
         uri = "http://" + u.netloc 
         streamid = u.path.lstrip('/')
@@ -443,10 +1456,11 @@ def get_report_class(deliver_locations):
 
 
 class Reporting:
-    def __init__(self, inst, autoflush=1.0, reportfile=None, max_size=BUFSIZE_LIMIT):
+    def __init__(self, inst, autoflush=1.0, reportfile=None,
+                 max_size=BUFSIZE_LIMIT):
         """Create a new report manager, responsible for delivering
         data to subscribers.  Buffers data on disk until it can be
-        delivered, storing up to *max_size* points per timeseries.
+        delivered, storing up to *max_size* points per subscriber.
 
         :param inst: the :py:class:`~smap.core.SmapInstance` we'll be
          delivering reports for.
@@ -454,15 +1468,27 @@ class Reporting:
          to deliver all data.
         :param string reportfile: backing store for reporting instances
          and data which hasn't been delivered yet.
-        :param int max_size: the maximum number of points we will buffer for 
-         any stream.
+        :param int max_size: the maximum number of points we will buffer for
+         a report without its own ``MaxRecords``; ``None`` for no limit.
+         :py:data:`BUFSIZE_LIMIT` by default.
         """
         self.inst = inst
         self.subscribers = []
+        # path -> [subscribers] for every path with a subscriber, and
+        # resource -> [subscribers] so we can find the subscribers to
+        # a new path without looking at all of them.
+        self.topics = {}
+        self.resources = {}
         self.reportfile = reportfile
         self.max_size = max_size
         self.autoflush = autoflush
+        # all subscribers share one log of pending data
+        self.log = None
+        self.store = None
+        self.ids = {}
         if self.reportfile:
+            self.log = ReportLog(self.reportfile + '-log')
+            self.store = ReportStore(self.reportfile + '-reports')
             self.load_reports()
 
         if autoflush != None:
@@ -472,18 +1498,16 @@ class Reporting:
                 if d: d.addBoth(lambda _ : None)
             self.t = task.LoopingCall(flush)
             reactor.callLater(autoflush, self.t.start, autoflush)
-
-        # add a shutdown handler so we save the final reports after exiting
-        if reportfile:
-            reactor.addSystemEventTrigger('after', 'shutdown', 
-                                          self.save_reports)
+            if reportfile:
+                # so not much is delivered twice after a crash
+                self.checkpoints = task.LoopingCall(self.save_reports)
+                reactor.callLater(CHECKPOINT_INTERVAL, self.checkpoints.start,
+                                  CHECKPOINT_INTERVAL)
 
     def get_report(self, id):
         return util.find(lambda item: item['uuid'] == id, self.subscribers)
 
     def add_report(self, rpt):
-        dir = os.path.join(self.reportfile + '-reports',
-                           str(rpt['uuid']))
         rpt['ReportDeliveryLocation'] = map(str, rpt['ReportDeliveryLocation'])
 
         report_class = get_report_class(rpt['ReportDeliveryLocation'])
@@ -491,22 +1515,28 @@ class Reporting:
             print "No report deliverer found for " + str(rpt['ReportDeliveryLocation'])
             return 
         else:
-            report_instance = report_class(dir, rpt)
+            report_instance = report_class(self.log.cursor(rpt['uuid']), rpt)
+            self.log.configure(rpt, self.max_size)
 
         log.msg("Creating report -- dest is %s" % str(rpt['ReportDeliveryLocation']))
-        self._update_subscriptions(report_instance)
         self.subscribers.append(report_instance)
+        self._update_subscriptions(report_instance)
+        if self.store: self.store.save(report_instance)
 
         # publish the full data set when we add a subscription so we
         # can compress from here
-        for k, v in self.inst.lookup(report_instance['ReportResource']).iteritems():
-            self.publish(k, v)
+        for k in list(report_instance['Topics']):
+            report_instance['PendingData'].add(k, self.inst.lookup(k))
 
     def del_report(self, id):
         rpt = self.get_report(id)
         if rpt:
             log.msg("removing report " + str(id))
+            self._unindex(rpt)
             del self.subscribers[self.subscribers.index(rpt)]
+            self.log.remove(rpt['uuid'])
+            if self.store: self.store.remove(rpt['uuid'])
+            if hasattr(rpt, 'close'): rpt.close()
         return rpt
 
     def update_report(self, rpt):
@@ -517,27 +1547,77 @@ class Reporting:
                 str(rpt['uuid']),
                 str(rpt['ReportDeliveryLocation'])))
         if cur:
+            self._unindex(cur)
             cur.update(rpt)
+            self.log.configure(cur, self.max_size)
             self._update_subscriptions(cur)
+            if self.store: self.store.save(cur)
             return True
         return False
 
-    def _update_subscriptions(self, sub):
-        result = self.inst.lookup(sub['ReportResource'])
-        if isinstance(result, dict) and 'uuid' in result:
-            # is a single time series
-            sub['Topics'] = set([getattr(result, 'path')])
-        elif isinstance(result, dict):
-            # is a dict of {path: value}
-            sub['Topics'] = set(result.iterkeys())
+    @staticmethod
+    def _resource_key(resource):
+        """The key for a report resource in the resource index: the
+        path to its root, and if it is recursive."""
+        path = util.split_path(resource)
+        if len(path) > 0 and path[-1][0] == '+':
+            return tuple(path[:-1]), True
         else:
-            # is nothing
-            sub['Topics'] = set()
+            return tuple(path), False
+
+    @staticmethod
+    def _remove(index, key, sub):
+        subs = [s for s in index.get(key, []) if s is not sub]
+        if len(subs): index[key] = subs
+        elif key in index: del index[key]
+
+    def _add_topic(self, path, sub):
+        subs = self.topics.setdefault(path, [])
+        if not util.find(lambda s: s is sub, subs):
+            subs.append(sub)
+
+    def _unindex(self, sub):
+        """Remove a subscriber from the topic and resource indexes"""
+        for path in sub.get('Topics', []):
+            self._remove(self.topics, path, sub)
+        if 'ReportResource' in sub:
+            self._remove(self.resources, 
+                         self._resource_key(sub['ReportResource']), sub)
 
-    def update_subscriptions(self):
+    def _update_subscriptions(self, sub):
+        self._unindex(sub)
+        # for recursive resources this is the instance's cached set of
+        # paths, so it stays current as the instance grows
+        sub['Topics'] = self.inst.lookup_paths(sub['ReportResource'])
+        self.resources.setdefault(self._resource_key(sub['ReportResource']), 
+                                  []).append(sub)
+        for path in sub['Topics']:
+            self._add_topic(path, sub)
+
+    def update_subscriptions(self, path=None):
         """Should be called whenever the set of resources changes so we can
-        update the list of uuids for each subscriber."""
-        map(self._update_subscriptions, self.subscribers)
+        update the list of paths for each subscriber.
+
+        :param string path: if given, the path of a single resource which
+         was added; only the subscribers which match it are updated.
+         Otherwise all subscriptions are recomputed.
+        """
+        if path is None:
+            self.topics, self.resources = {}, {}
+            map(self._update_subscriptions, self.subscribers)
+            return
+
+        path = util.split_path(path)
+        subs = list(self.resources.get((tuple(path), False), []))
+        for i in xrange(0, len(path) + 1):
+            subs.extend(self.resources.get((tuple(path[:i]), True), []))
+
+        path = util.join_path(path)
+        for sub in subs:
+            if not path in sub['Topics']:
+                # a resource which didn't exist when we subscribed
+                sub['Topics'] = self.inst.lookup_paths(sub['ReportResource'])
+            self._add_topic(path, sub)
 
     def publish(self, path, val, prepend=False):
         """Publish a new reading to the stream identified by a path.
@@ -545,32 +1625,90 @@ class Reporting:
         Not thread safe.
         """
         path = util.norm_path(path)
-        for sub in self.subscribers:
-            if path in sub['Topics']:
-                sub['PendingData'].add(path, val)
+        subs = self.topics.get(path)
+        if subs:
+            # share one tuple of ids between entries for the same
+            # subscribers so they are only pickled once per segment
+            ids = tuple((sub['uuid'] for sub in subs))
+            self.log.add(path, val, self.ids.setdefault(ids, ids))
+
+    def _load_report(self, s):
+        s['Busy'] = False
+        s['Paused'] = False
+        if hasattr(s, 'reset'): s.reset()
+        if not 'Format' in s:
+            s['Format'] = 'json'
+        self.log.configure(s, self.max_size)
+        self.subscribers.append(s)
 
     def load_reports(self):
-        self.subscribers = util.pickle_load(self.reportfile)
-        if self.subscribers == None:
-            self.subscribers = []
-        for s in self.subscribers:
-            s['Busy'] = False
-            s['Paused'] = False
-            if not 'Format' in s:
-                s['Format'] = 'json'
+        """Load the saved reports, and attach them to the log at the
+        positions they had reached"""
+        self.subscribers = []
+        state = self.store.positions()
+        self.log.restore(state)
+        positions, pending = state['positions'], state.get('pending', {})
+        for s in self.store.load():
+            # reports without a saved position (added since the last
+            # save) start from the oldest data we still have
+            cursor = ReportCursor(s['uuid'], positions.get(s['uuid'], (0, 0)))
+            self.log.attach(cursor, pending.get(s['uuid']), state.get('end'))
+            s['PendingData'] = cursor
+            self._load_report(s)
+
+        # older versions saved every report together in the reportfile
+        legacy = util.pickle_load(self.reportfile) \
+            if os.path.isfile(self.reportfile) else None
+        for s in legacy or []:
+            if isinstance(s['PendingData'], ReportCursor):
+                self.log.attach(s['PendingData'])
+            else:
+                # reports saved before the log was shared have their
+                # own DataBuffer; move their pending data into the log
+                buf, s['PendingData'] = s['PendingData'], self.log.cursor(s['uuid'])
+                while len(buf) > 0:
+                    data = buf.read()
+                    for k, v in (data or {}).iteritems():
+                        s['PendingData'].add(k, v)
+                    buf.truncate()
+                s.pop('DataDir', None)
+            self._load_report(s)
+            self.store.save(s)
+        if legacy != None:
+            self.store.save_positions(self.log.checkpoint())
+            os.remove(self.reportfile)
+        self.update_subscriptions()
 
     def save_reports(self, *args):
-        """Save reports while holding the filesystem lock.
+        """Save the positions reports have reached in the log.  Their
+        definitions are saved as they are added or changed.
         """
-        util.pickle_dump(self.reportfile, self.subscribers)
-        for s in self.subscribers:
-            s['PendingData'].sync()
+        if self.store:
+            self.log.sync()
+            self.store.save_positions(self.log.checkpoint())
 
         if len(args) == 1:
             return args[0]
         else:
             return 
 
+    def close(self):
+        """Write out the rest of the log and wait for it to reach the
+        disk, then save the positions of the reports.  Saving them
+        first could leave them pointing past data which was lost.
+
+        The writer thread is waited for without blocking the reactor,
+        so this returns a Deferred; it is called by
+        :py:meth:`smap.core.SmapInstance.stop`.
+        """
+        if self.store:
+            if getattr(self, 'checkpoints', None) and self.checkpoints.running:
+                self.checkpoints.stop()
+            d = self.log.close(wait=False)
+            d.addCallback(lambda _: self.store.save_positions(self.log.checkpoint()))
+            return d
+        return defer.succeed(None)
+
     def _flush(self, force=False):
         """Send out json-packed report objects to registered listeners. 
         
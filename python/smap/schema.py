@@ -113,6 +113,119 @@ def remove_none(obj):
     for k in dellist:
         del obj[k]
 
+# compiled checkers, by schema name
+CHECKERS = {}
+# checkers for each field of a record schema, by schema name
+FIELD_CHECKERS = {}
+# record types whose validation results are cached, since the same
+# objects are set on many streams
+MEMOIZED = ['Metadata', 'Properties']
+MEMO_SIZE = 10000
+
+def _freeze(obj):
+    """Build a hashable key for a json-like object.  The type is part
+    of the key since True == 1, but they validate differently."""
+    if isinstance(obj, dict):
+        return frozenset(((k, _freeze(v)) for k, v in obj.iteritems()))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(map(_freeze, obj))
+    else:
+        return (type(obj), obj)
+
+def _memoize(check):
+    cache = {}
+    def memo_check(datum):
+        try:
+            key = _freeze(datum)
+            return cache[key]
+        except TypeError:
+            return check(datum)
+        except KeyError:
+            pass
+        rv = check(datum)
+        if len(cache) >= MEMO_SIZE:
+            cache.clear()
+        cache[key] = rv
+        return rv
+    return memo_check
+
+def _check_uuid(datum):
+    if isinstance(datum, uuid.UUID):
+        return True
+    try:
+        uuid.UUID(datum)
+        return True
+    except:
+        return False
+
+def _check_readings(check):
+    # reading buffers are typed by construction
+    return lambda datum: isinstance(datum, util.ReadingBuffer) or check(datum)
+
+def _compile(s):
+    """Compile an avro schema into a function checking if a python
+    object is an instance of the schema.  This has the same semantics
+    as :py:func:`avro.io.validate`, except that tuples are accepted as
+    arrays, and uuids need not be converted to bytes first.
+    """
+    if isinstance(s, schema.NamedSchema) and s.fullname in CHECKERS:
+        return CHECKERS[s.fullname]
+
+    t = s.type
+    if t == 'null':
+        check = lambda d: d is None
+    elif t == 'boolean':
+        check = lambda d: isinstance(d, bool)
+    elif t == 'string':
+        check = lambda d: isinstance(d, basestring)
+    elif t == 'bytes':
+        check = lambda d: isinstance(d, str)
+    elif t == 'int':
+        check = lambda d: util.is_integer(d) and io.INT_MIN_VALUE <= d <= io.INT_MAX_VALUE
+    elif t == 'long':
+        check = lambda d: util.is_integer(d) and io.LONG_MIN_VALUE <= d <= io.LONG_MAX_VALUE
+    elif t in ['float', 'double']:
+        check = lambda d: isinstance(d, (int, long, float))
+    elif t == 'fixed' and s.name == 'uuid':
+        check = _check_uuid
+    elif t == 'fixed':
+        check = lambda d: isinstance(d, str) and len(d) == s.size
+    elif t == 'enum':
+        symbols = frozenset(s.symbols)
+        check = lambda d: util.is_string(d) and d in symbols
+    elif t == 'array':
+        items = _compile(s.items)
+        check = lambda d: isinstance(d, (list, tuple)) and all((items(x) for x in d))
+    elif t == 'map':
+        values = _compile(s.values)
+        check = lambda d: isinstance(d, dict) and \
+            all((isinstance(k, basestring) and values(v) for k, v in d.iteritems()))
+    elif t in ['union', 'error_union']:
+        branches = map(_compile, s.schemas)
+        check = lambda d: any((b(d) for b in branches))
+    elif t in ['record', 'error', 'request']:
+        fields = [(f.name, _compile(f.type)) for f in s.fields]
+        fields = [(name, _check_readings(c) if name == 'Readings' else c)
+                  for name, c in fields]
+        FIELD_CHECKERS[s.fullname] = dict(fields)
+        check = lambda d: isinstance(d, dict) and \
+            all((c(d.get(name)) for name, c in fields))
+    else:
+        raise Exception("Cannot compile schema type: " + t)
+
+    if isinstance(s, schema.NamedSchema):
+        if s.name in MEMOIZED:
+            check = _memoize(check)
+        CHECKERS[s.fullname] = check
+    return check
+
+def get_checker(name):
+    """Return the compiled checker for a schema, or None if there is
+    no schema by that name"""
+    s = SCHEMA_NAMES.get_name(name, None)
+    if s is None: return None
+    return _compile(s)
+
 def validate(schema, obj):
     """Validate an object against its schema.
 
@@ -125,13 +238,24 @@ def validate(schema, obj):
     elif schema == 'Readings':
         return True
 
+    check = get_checker(schema)
+    try:
+        return check(obj)
+    except:
+        return False
+
+def validate_field(schema, field, value):
+    """Validate the new value of one field of a record, without
+    re-checking the rest of the object.  Fields not in the schema are
+    ignored, as they are when validating the whole object.
+    """
     s = SCHEMA_NAMES.get_name(schema, None)
-    # swap the uuid for the byte-packed encoding we use with avro
+    if s is None: return False
+    _compile(s)
+    check = FIELD_CHECKERS.get(s.fullname, {}).get(field, None)
+    if check == None: return True
     try:
-        id = convert_uuids(obj)
-        rv = io.validate(s, obj)
-        if id: obj['uuid'] = id
-        return rv
+        return check(value)
     except:
         return False
 
@@ -163,6 +287,35 @@ def dump_report(datum):
 
     return out.getvalue()
 
+def iter_report(datum):
+    """Encode a report like :py:func:`dump_report`, but one path at a
+    time.
+
+    Yields the avro encoding in pieces; concatenated, they are
+    identical to the output of :py:func:`dump_report`.
+    """
+    out = StringIO()
+    encoder = io.BinaryEncoder(out)
+    dwriter = io.DatumWriter(writers_schema=REPORT_SCHEMA)
+
+    # a single map block, followed by the terminating empty block
+    if len(datum) > 0:
+        encoder.write_long(len(datum))
+        for path, obj in datum.iteritems():
+            id = obj.get('uuid', None)
+            convert_uuids(obj)
+            convert_readings(obj)
+            try:
+                encoder.write_utf8(path)
+                dwriter.write_data(REPORT_SCHEMA.values, obj, encoder)
+            finally:
+                if id: obj['uuid'] = id
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    encoder.write_long(0)
+    yield out.getvalue()
+
 def load_report(data):
     input = StringIO(data)
     dreader = io.DatumReader(writers_schema=REPORT_SCHEMA, 
@@ -144,6 +144,8 @@ class ReportingInstanceResource(resource.Resource):
         if self.inst:
             request.setHeader('Content-type', 'application/json')
             obj = schema.filter_fields('Reporting', self.inst)
+            if hasattr(self.inst, 'stats'):
+                obj['Stats'] = self.inst.stats()
             # print schema.validate('Reporting', obj)
             d = json.AsyncJSON(obj).startProducing(request)
             d.addBoth(lambda _: request.finish())
@@ -328,6 +330,7 @@ def run(inst, port=None, logdir=None):
     log.startLogging(observer)
     # Start server
     inst.start()
+    reactor.addSystemEventTrigger('before', 'shutdown', inst.stop)
     reactor.listenTCP(port, getSite(inst))
     reactor.run()
 
@@ -39,6 +39,8 @@ from zope.interface import implements
 from twisted.internet.task import cooperate
 from twisted.web import iweb
 
+from smap.util import ReadingBuffer
+
 try:
     import simplejson as json
 except ImportError:
@@ -53,6 +55,8 @@ class SmapEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, uuid.UUID):
             return str(obj)
+        elif isinstance(obj, ReadingBuffer):
+            return obj.tolist()
         return json.JSONEncoder.default(self, obj)
 
 
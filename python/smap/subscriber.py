@@ -49,11 +49,14 @@ import sjson
 class SmapConsumer(resource.Resource):
     def __init__(self):
         self.streams = {}
+        # the collections we have been sent
+        self.metadata = util.MetadataCache()
         resource.Resource.__init__(self)
 
     def add(self, report):
         try:
-            util.push_metadata(report)
+            for path in [p for p, v in report.iteritems() if not 'Readings' in v]:
+                self.metadata.update(path, report.pop(path))
         except Exception, e:
             traceback.print_exc()
         for path, val in report.iteritems():
@@ -61,7 +64,8 @@ class SmapConsumer(resource.Resource):
                 readings = val.pop('Readings')
                 if len(readings) == 0: continue
                 val.pop('uuid')
-                for k, v in util.buildkv('', val):
+                for k, v in self.metadata.tags(path, val).iteritems():
+                    if k == 'uuid': continue
                     print >>fp, "# %s = %s" % (k[1:], v)
                 for rv in readings:
                     print >>fp, rv['ReadingTime'], rv['Reading']
@@ -31,6 +31,7 @@ import uuid
 from twisted.trial import unittest
 
 from smap import core, util
+from smap.interface import ICollection
 
 class TestTimeseries(unittest.TestCase):
     def test_init(self):
@@ -72,3 +73,202 @@ class TestTimeseries(unittest.TestCase):
         self.assertEqual(ts['Metadata'], test_1)
         
         
+
+    def test_readings(self):
+        id = str(uuid.uuid1())
+        inst = core.SmapInstance(uuid.uuid1(), reportfile=None, autoflush=None)
+        ts = inst.add_timeseries('/ts', id, 'kW', buffersz=2)
+        for i in xrange(0, 3):
+            ts._add(i, i)
+        self.assertEqual(list(ts['Readings']), [(1000, 1), (2000, 2)])
+        self.assertEqual(ts['Readings'].size, 2)
+
+        # further changes still validate with readings present
+        ts.set_metadata({'Extra': {'Test': 'Foo'}})
+
+class TestBatchAdd(unittest.TestCase):
+    def setUp(self):
+        self.inst = core.SmapInstance(uuid.uuid1(), reportfile=None, autoflush=None)
+        self.published = []
+        self.inst.reports.publish = lambda path, val: \
+            self.published.append((path, val))
+        self.inst.add_timeseries('/a', 'a', 'kW', buffersz=10)
+        self.inst.add_timeseries('/b', 'b', 'kW', data_type='double', buffersz=10)
+
+    def test_add_many(self):
+        ts = self.inst.get_timeseries('/a')
+        ts._add_many([1, 2, 3], [10, 20, 30])
+        self.assertEqual(list(ts['Readings']), [(1000, 10), (2000, 20), (3000, 30)])
+        # one report for the stream, after the parent collection
+        self.assertEqual(self.published[-1][0], '/a')
+        self.assertEqual(self.published[-1][1]['Readings'],
+                         [(1000, 10), (2000, 20), (3000, 30)])
+
+        del self.published[:]
+        ts._add_many([4, 5], [40, 50])
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(set(self.published[0][1].keys()), set(['uuid', 'Readings']))
+
+    def test_add_many_type(self):
+        ts = self.inst.get_timeseries('/a')
+        self.assertRaises(util.SmapException, ts._add_many, [1, 2], [1.5, 2])
+        self.assertRaises(util.SmapException, ts._add_many, [1, 2], ['a', 'b'])
+        self.assertRaises(util.SmapException, ts._add_many, [1, 2], [1])
+        self.assertEqual(len(ts['Readings']), 0)
+        self.assertEqual(self.published, [])
+
+    def test_add_batch(self):
+        self.inst._add_batch({'/a': [(1, 1), (2, 2)],
+                              '/b': [(1, 1.5)]})
+        self.assertEqual(list(self.inst.get_timeseries('/a')['Readings']),
+                         [(1000, 1), (2000, 2)])
+        self.assertEqual(list(self.inst.get_timeseries('/b')['Readings']),
+                         [(1000, 1.5)])
+
+    def test_add_batch_invalid(self):
+        # nothing is added if any stream is invalid
+        self.assertRaises(util.SmapException, self.inst._add_batch,
+                          {'/a': [(1, 1)], '/b': [(1, 1)]})
+        self.assertRaises(util.SmapException, self.inst._add_batch,
+                          {'/a': [(1, 1)], '/c': [(1, 1)]})
+        self.assertEqual(len(self.inst.get_timeseries('/a')['Readings']), 0)
+
+    def test_ingest_queue(self):
+        a, b = self.inst.get_timeseries('/a'), self.inst.get_timeseries('/b')
+        q = self.inst.ingest
+        q.push(a, (1, 1))
+        q.push(b, (1, 1.5))
+        q.push(a, (2, 2))
+        q.push(a, (3, 'bad'))
+        self.assertEqual(q.stats()['depth'], 4)
+        self.assertEqual(len(a['Readings']), 0)
+
+        q.drain()
+        # the bad reading is dropped but the rest are added
+        self.assertEqual(len(self.flushLoggedErrors(util.SmapException)), 1)
+        self.assertEqual(list(a['Readings']), [(1000, 1), (2000, 2)])
+        self.assertEqual(list(b['Readings']), [(1000, 1.5)])
+        stats = q.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['max_depth'], 4)
+        self.assertEqual(stats['enqueued'], 4)
+        self.assertEqual(stats['drains'], 1)
+
+        # readings for the same stream are published together
+        del self.published[:]
+        q.push(a, (4, 4))
+        q.push(a, (5, 5))
+        q.drain()
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(self.published[0][1]['Readings'], [(4000, 4), (5000, 5)])
+
+    def test_ingest_queue_errors(self):
+        """An error publishing one stream doesn't lose the others"""
+        a, b = self.inst.get_timeseries('/a'), self.inst.get_timeseries('/b')
+        def publish(path, val):
+            if path == '/a': raise IOError("disk full")
+        self.inst.reports.publish = publish
+        q = self.inst.ingest
+        q.push(a, (1, 1))
+        q.push(b, (1, 1.5))
+        q.drain()
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+        # stored, and not stored again one at a time
+        self.assertEqual(list(a['Readings']), [(1000, 1)])
+        self.assertEqual(list(b['Readings']), [(1000, 1.5)])
+
+class TestLookup(unittest.TestCase):
+    def setUp(self):
+        self.inst = core.SmapInstance(uuid.uuid1(), reportfile=None, autoflush=None)
+        self.inst.add_timeseries('/a/b', 'b', 'kW')
+        self.inst.add_timeseries('/a/c', 'c', 'kW')
+        self.inst.add_timeseries('/d', 'd', 'kW')
+
+    def test_lookup_r(self):
+        self.assertEqual(set(self.inst.lookup('/+').keys()),
+                         set(['/', '/a', '/a/b', '/a/c', '/d']))
+        # paths are relative to the resource
+        self.assertEqual(set(self.inst.lookup('/a/+').keys()),
+                         set(['/', '/b', '/c']))
+        self.assertEqual(self.inst.lookup('/a/+', pred=ICollection.providedBy).keys(),
+                         ['/'])
+
+    def test_lookup_paths(self):
+        paths = self.inst.lookup_paths('/a/+')
+        self.assertEqual(paths, set(['/a', '/a/b', '/a/c']))
+        self.inst.add_timeseries('/a/e', 'e', 'kW')
+        self.assertTrue('/a/e' in paths)
+        self.assertEqual(self.inst.lookup_paths('/d'), set(['/d']))
+        self.assertEqual(self.inst.lookup_paths('/x/+'), set())
+
+    def test_replace(self):
+        self.inst.add_timeseries('/d', 'd2', 'kW', replace=True)
+        self.assertEqual(self.inst.get_collection('/')['Contents'], ['a', 'd'])
+
+class TestDirty(unittest.TestCase):
+    def setUp(self):
+        self.inst = core.SmapInstance(uuid.uuid1(), reportfile=None, autoflush=None)
+        self.published = []
+        self.inst.reports.publish = lambda path, val: \
+            self.published.append(path)
+        self.inst.add_timeseries('/a/b', 'b', 'kW')
+        self.inst.add_timeseries('/a/c', 'c', 'kW')
+        self.inst.add_timeseries('/d', 'd', 'kW')
+        for path in ['/a/b', '/a/c', '/d']:
+            self.inst.get_timeseries(path)._add(1, 1)
+
+    def test_first_publish(self):
+        # new streams publish all of their ancestors
+        self.assertEqual(self.published, ['/', '/a', '/a/b', 
+                                          '/', '/a', '/a/c', 
+                                          '/', '/d'])
+        for path in ['/a/b', '/a/c', '/d']:
+            self.assertFalse(self.inst.get_timeseries(path).dirty)
+
+    def test_collection_metadata(self):
+        self.inst.get_collection('/a').set_metadata({'Extra': {'Test': 'here'}})
+        self.assertTrue(self.inst.get_timeseries('/a/b').dirty)
+        self.assertTrue(self.inst.get_timeseries('/a/c').dirty)
+        self.assertFalse(self.inst.get_timeseries('/d').dirty)
+
+        # only the changed collection is republished
+        del self.published[:]
+        self.inst.get_timeseries('/a/b')._add(2, 2)
+        self.assertEqual(self.published, ['/a', '/a/b'])
+        self.assertFalse(self.inst.get_timeseries('/a/b').dirty)
+        self.assertTrue(self.inst.get_timeseries('/a/c').dirty)
+
+        # setting the same metadata again is not a change
+        self.inst.get_collection('/a').set_metadata({'Extra': {'Test': 'here'}})
+        self.assertFalse(self.inst.get_timeseries('/a/b').dirty)
+
+    def test_timeseries_metadata(self):
+        self.inst.get_timeseries('/d').set_metadata({'Extra': {'Test': 'there'}})
+        del self.published[:]
+        self.inst.get_timeseries('/d')._add(2, 2)
+        self.inst.get_timeseries('/a/b')._add(2, 2)
+        self.assertEqual(self.published, ['/d', '/a/b'])
+
+class TestCompact(unittest.TestCase):
+    def setUp(self):
+        self.inst = core.SmapInstance(uuid.uuid1(), reportfile=None, autoflush=None,
+                                      compact=True)
+        self.a = self.inst.add_timeseries('/a', 'a', 'kW')
+        self.b = self.inst.add_timeseries('/b', 'b', 'kW')
+        self.c = self.inst.add_timeseries('/c', 'c', 'V')
+
+    def test_properties(self):
+        self.assertTrue(self.a['Properties'] is self.b['Properties'])
+        self.assertFalse(self.a['Properties'] is self.c['Properties'])
+        self.assertEqual(self.c['Properties']['UnitofMeasure'], 'V')
+        self.assertRaises(TypeError, self.a['Properties'].__setitem__, 
+                          'UnitofMeasure', 'W')
+        # replacing them is still allowed
+        self.a['Properties'] = dict(self.a['Properties'], UnitofMeasure='W')
+        self.assertEqual(self.b['Properties']['UnitofMeasure'], 'kW')
+
+    def test_slots(self):
+        # no per-instance dict is created unless something uses it
+        self.assertFalse(hasattr(self.a, '__dict__') and self.a.__dict__)
+        self.assertEqual(self.a.reader(None), (True, self.a))
+        self.assertEqual(self.a.writer, None)
@@ -31,10 +31,13 @@ import time
 import datetime
 import os
 import glob
-from smap.disklog import DiskLog
+from smap import disklog
+from smap.disklog import DiskLog, SegmentedLog
 from twisted.trial import unittest
+from twisted.internet import task
 
 import shutil
+import threading
 
 class TestDiskLog(unittest.TestCase):
     def test_1(self):
@@ -188,6 +191,94 @@ class TestDiskLog(unittest.TestCase):
         finally:
             shutil.rmtree("testdir")
 
+    def test_age_index(self):
+        """Expiry looks at the age index instead of the files, and
+        drops expired records together"""
+        try:
+            dl = DiskLog("testdir", 10)
+            expired = []
+            dl.expired = lambda: expired.append(dl.bounds())
+            for i in xrange(0, 5):
+                dl.append(i)
+            for i in xrange(0, 3):
+                dl.ctimes[i] -= 20
+            def getmtime(path):
+                self.fail("stat called")
+            self.patch(os.path, 'getmtime', getmtime)
+            dl.append(5)
+            self.assertEqual(expired, [(3, 5)])
+            self.assertEqual(dl.head(), 3)
+            self.assertEqual(len(dl.ctimes), 2)
+            self.assertFalse(os.path.exists("testdir/00000002"))
+            self.assertFalse('ctimes' in dl.meta)
+
+            dl.append(6)
+            dl.sync()
+            dl2 = DiskLog("testdir")
+            self.assertEqual(list(dl2.ctimes), list(dl.ctimes))
+        finally:
+            shutil.rmtree("testdir")
+
+    def test_age_index_upgrade(self):
+        """Records missing from the age index use their modification
+        time"""
+        try:
+            dl = DiskLog("testdir")
+            for i in xrange(0, 5):
+                dl.append(i)
+            dl.sync()
+            os.remove("testdir/AGES")
+            dl = DiskLog("testdir")
+            self.assertEqual(len(dl.ctimes), 4)
+            dl.pop()
+            self.assertEqual(len(dl.ctimes), 3)
+        finally:
+            shutil.rmtree("testdir")
+
+    def test_age_active_tail(self):
+        """The tail isn't expired, and its age is when data was last
+        added to it"""
+        try:
+            dl = DiskLog("testdir", 10)
+            dl.append([0])
+            dl.tail_time -= 20
+            dl.sync()
+            self.assertEqual(dl.head(), [0])
+            dl.extend_tail([1])
+            dl.append([2])
+            dl.sync()
+            self.assertEqual(dl.head(), [0, 1])
+        finally:
+            shutil.rmtree("testdir")
+
+    def test_age_index_compacted(self):
+        try:
+            dl = DiskLog("testdir")
+            for i in xrange(0, 3000):
+                dl.append(i)
+                if i % 10: dl.pop()
+            self.assertTrue(dl.ages_written < 2 * len(dl.ctimes) + 1024)
+            ages = os.path.getsize("testdir/AGES") // DiskLog.AGE.size
+            self.assertEqual(ages, dl.ages_written)
+        finally:
+            shutil.rmtree("testdir")
+
+    def test_replace(self):
+        try:
+            dl = DiskLog("testdir")
+            for i in xrange(0, 3):
+                dl.append([i])
+            dl.replace(0, [0, 0])
+            dl.replace(1, [1, 1])
+            dl.replace(2, [2, 2])
+            dl.sync()
+            dl = DiskLog("testdir")
+            self.assertEqual(dl.head(), [0, 0])
+            self.assertEqual(dl.get(1), [1, 1])
+            self.assertEqual(dl.tail(), [2, 2])
+        finally:
+            shutil.rmtree("testdir")
+
     def test_disappearing_logs(self):
         try:
             dl = DiskLog("testdir")
@@ -278,3 +369,341 @@ class TestDiskLog(unittest.TestCase):
             d = DiskLog("testdir")
         finally:
             shutil.rmtree("testdir")
+
+class SegmentedLogTests(object):
+    """Tests for both the threaded and unthreaded SegmentedLog"""
+    TEST_DIR = "testdir"
+
+    def setUp(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+        self.clock = task.Clock()
+        self.patch(disklog, 'reactor', self.clock)
+        self.fsyncs = []
+        fsync = os.fsync
+        def count_fsync(fd):
+            self.fsyncs.append(fd)
+            fsync(fd)
+        self.patch(os, 'fsync', count_fsync)
+        self.addCleanup(shutil.rmtree, self.TEST_DIR, True)
+
+    def open(self, **kwargs):
+        dl = SegmentedLog(self.TEST_DIR, **kwargs)
+        self.addCleanup(dl.close)
+        return dl
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.TEST_DIR, 'segment-*')))
+
+    def test_append_pop(self):
+        dl = self.open()
+        for i in xrange(0, 10):
+            dl.append(i)
+            self.assertEqual(dl.head(), 0)
+            self.assertEqual(dl.tail(), i)
+        self.assertEqual(len(dl), 10)
+        self.assertEqual(dl.get(5), 5)
+        for i in xrange(0, 10):
+            self.assertEqual(dl.head(), i)
+            dl.pop()
+        self.assertEqual(dl.head(), None)
+        self.assertEqual(dl.tail(), None)
+        self.assertEqual(dl.bounds(), (10, 10))
+
+    def test_reopen(self):
+        dl = self.open()
+        for i in xrange(0, 5):
+            dl.append([i])
+        dl.update_tail([4, 5])
+        dl.pop()
+        dl.close()
+
+        dl = self.open()
+        self.assertEqual(dl.bounds(), (1, 5))
+        self.assertEqual(dl.head(), [1])
+        self.assertEqual(dl.tail(), [4, 5])
+        self.assertEqual(dl.get(2), [2])
+
+    def test_reopen_empty(self):
+        """Sequence numbers keep counting up after the log empties"""
+        dl = self.open()
+        dl.append(1)
+        dl.append(2)
+        dl.pop(); dl.pop()
+        dl.close()
+        dl = self.open()
+        self.assertEqual(dl.bounds(), (2, 2))
+        self.assertEqual(dl.head(), None)
+        dl.append(3)
+        self.assertEqual(dl.bounds(), (2, 3))
+
+    def test_update_tail_after_commit(self):
+        dl = self.open()
+        dl.append([1])
+        dl.sync()
+        dl.update_tail([1, 2])
+        dl.sync()
+        dl.close()
+        self.assertEqual(self.open().tail(), [1, 2])
+
+    def test_replace(self):
+        dl = self.open()
+        for i in xrange(0, 3):
+            dl.append([i])
+        dl.replace(0, [0, 0])
+        dl.replace(1, [1, 1])
+        dl.replace(2, [2, 2])
+        self.assertEqual([dl.get(i) for i in xrange(0, 3)],
+                         [[0, 0], [1, 1], [2, 2]])
+        dl.close()
+        dl = self.open()
+        self.assertEqual(dl.head(), [0, 0])
+        self.assertEqual(dl.get(1), [1, 1])
+        self.assertEqual(dl.tail(), [2, 2])
+
+    def test_torn_write(self):
+        dl = self.open()
+        for i in xrange(0, 5):
+            dl.append(i)
+        dl.close()
+        path = self.segments()[-1]
+        with open(path, 'ab') as fp:
+            fp.write('\x20\0\0\0garbage')
+        size = os.path.getsize(path)
+
+        dl = self.open()
+        self.assertEqual(dl.bounds(), (0, 5))
+        self.assertEqual(dl.tail(), 4)
+        self.assertEqual(os.path.getsize(path), size - 11)
+        dl.append(5)
+        dl.close()
+        self.assertEqual(self.open().tail(), 5)
+
+    def test_corrupt_record(self):
+        dl = self.open()
+        for i in xrange(0, 5):
+            dl.append('record %i' % i)
+        dl.close()
+        path = self.segments()[-1]
+        data = open(path, 'rb').read()
+        # flip a byte in the last record
+        pos = data.rindex('record 4')
+        with open(path, 'r+b') as fp:
+            fp.seek(pos)
+            fp.write('X')
+
+        dl = self.open()
+        self.assertEqual(dl.bounds(), (0, 4))
+        self.assertEqual(dl.tail(), 'record 3')
+
+    def test_extend_tail(self):
+        """Committing a growing tail only writes the new items"""
+        dl = self.open()
+        dl.append(['x' * 100])
+        dl.sync()
+        for i in xrange(0, 50):
+            dl.extend_tail(['x' * 100])
+            dl.sync()
+        dl.close()
+        size = sum(map(os.path.getsize, self.segments()))
+        self.assertTrue(size < 51 * 200)
+
+        dl = self.open()
+        self.assertEqual(dl.tail(), ['x' * 100] * 51)
+        dl.extend_tail(['y'])
+        dl.append(['z'])
+        dl.close()
+        dl = self.open()
+        self.assertEqual(dl.get(0), ['x' * 100] * 51 + ['y'])
+        self.assertEqual(dl.tail(), ['z'])
+
+    def test_torn_length(self):
+        """A torn header is truncated without trusting its length"""
+        dl = self.open()
+        for i in xrange(0, 5):
+            dl.append(i)
+        dl.close()
+        path = self.segments()[-1]
+        size = os.path.getsize(path)
+        with open(path, 'ab') as fp:
+            fp.write(SegmentedLog.HEADER.pack(0x7fffffff, 0, 0, 5, 0))
+
+        dl = self.open()
+        self.assertEqual(dl.bounds(), (0, 5))
+        self.assertEqual(os.path.getsize(path), size)
+
+    def test_aging(self):
+        dl = self.open(max_age=datetime.timedelta(seconds=10))
+        dl.append(0)
+        dl.append(1)
+        dl.sync()
+        self.assertEqual(dl.head(), 0)
+        dl.index[0] = dl.index[0][:3] + (time.time() - 20,)
+        dl.append(2)
+        dl.sync()
+        self.assertEqual(dl.head(), 1)
+
+    def test_age_active_tail(self):
+        """Records expire by the age of their newest data, and the
+        tail never does"""
+        dl = self.open(max_age=10)
+        dl.append([0])
+        dl.sync()
+        dl.index[0] = dl.index[0][:3] + (time.time() - 20,)
+        dl.sync()
+        self.assertEqual(dl.head(), [0])
+        dl.extend_tail([1])
+        dl.append([2])
+        dl.sync()
+        self.assertEqual(dl.head(), [0, 1])
+
+    def test_age_bulk(self):
+        """Expired records are dropped without reading them back"""
+        dl = self.open(max_age=10, segment_size=1000)
+        expired = []
+        dl.expired = lambda: expired.append(dl.bounds())
+        for i in xrange(0, 50):
+            dl.append('x' * 100)
+        dl.sync()
+        for seq in xrange(0, 40):
+            dl.index[seq] = dl.index[seq][:3] + (time.time() - 20,)
+        reads = []
+        read_seqno = dl._read_seqno
+        def count_reads(seq):
+            reads.append(seq)
+            return read_seqno(seq)
+        self.patch(dl, '_read_seqno', count_reads)
+        dl.sync()
+        self.assertEqual(expired, [(40, 50)])
+        self.assertEqual(reads, [40])
+        self.assertTrue(len(self.segments()) < 3)
+
+
+class TestSegmentedLog(SegmentedLogTests, unittest.TestCase):
+    def test_group_commit(self):
+        dl = self.open(commit_interval=10)
+        for i in xrange(0, 100):
+            dl.append(i)
+        # nothing is committed until the timer fires
+        self.assertEqual(len(self.fsyncs), 0)
+        self.clock.advance(10)
+        self.assertEqual(len(self.fsyncs), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        # or enough has been written
+        dl.COMMIT_BYTES = 1000
+        for i in xrange(0, 100):
+            dl.append('x' * 100)
+        self.assertTrue(1 < len(self.fsyncs) < 20)
+
+    def test_write_failure(self):
+        """After a failed write the segment is cut back to its last
+        good record, and what was lost is written to a new one"""
+        dl = self.open()
+        for i in xrange(0, 5):
+            dl.append(i)
+        dl.sync()
+        size = os.path.getsize(self.segments()[-1])
+        fp = dl.fp
+        class FullDisk(object):
+            def write(self, data):
+                fp.write(data[:10])
+                raise IOError(28, "No space left on device")
+            def __getattr__(self, name):
+                return getattr(fp, name)
+        dl.fp = FullDisk()
+        dl.append(5)
+        dl.append(6)
+        self.flushLoggedErrors(IOError)
+        self.assertEqual(os.path.getsize(self.segments()[-1]), size)
+        self.assertEqual(dl.get(5), 5)
+        dl.sync()
+        self.assertEqual(dl.stats()['WriteErrors'], 1)
+        self.assertEqual(len(self.segments()), 2)
+        dl.close()
+
+        dl = self.open()
+        self.assertEqual(dl.bounds(), (0, 7))
+        self.assertEqual([dl.get(i) for i in xrange(0, 7)], range(0, 7))
+
+    def test_segments(self):
+        dl = self.open(segment_size=1000, commit_bytes=0)
+        for i in xrange(0, 100):
+            dl.append('x' * 100)
+        self.assertTrue(len(self.segments()) > 5)
+        for i in xrange(0, 99):
+            dl.pop()
+        # only the last segments are left
+        self.assertTrue(len(self.segments()) <= 2)
+        dl.close()
+        dl = self.open()
+        self.assertEqual(dl.bounds(), (99, 100))
+        self.assertEqual(dl.head(), 'x' * 100)
+
+
+class TestThreadedSegmentedLog(SegmentedLogTests, unittest.TestCase):
+    def open(self, **kwargs):
+        kwargs.setdefault('threaded', True)
+        return SegmentedLogTests.open(self, **kwargs)
+
+    def block(self, dl):
+        """Hold up the writer thread until the returned event is set"""
+        gate = threading.Event()
+        dl.writer.submit(0, gate.wait)
+        self.addCleanup(gate.set)
+        return gate
+
+    def test_off_thread(self):
+        threads = []
+        self.patch(os, 'fsync', lambda fd: threads.append(threading.currentThread()))
+        dl = self.open()
+        for i in xrange(0, 10):
+            dl.append(i)
+        dl.sync()
+        dl.close()
+        self.assertTrue(len(threads) > 0)
+        self.assertTrue(threading.currentThread() not in threads)
+
+    def test_read_unwritten(self):
+        dl = self.open()
+        gate = self.block(dl)
+        for i in xrange(0, 10):
+            dl.append(i)
+        dl.sync()
+        self.assertEqual(dl.get(5), 5)
+        self.assertEqual(dl.stats()['Writes'], 0)
+        gate.set()
+        dl.close()
+        self.assertEqual(dl.stats()['Writes'], 10)
+        self.assertEqual(self.open(threaded=False).get(5), 5)
+
+    def test_backlog(self):
+        """Falling behind is reported instead of waited for"""
+        dl = self.open(max_staged=1000)
+        gate = self.block(dl)
+        for i in xrange(0, 20):
+            dl.append('x' * 100)
+        self.assertTrue(dl.backlogged())
+        stats = dl.stats()
+        self.assertEqual(stats['Backlogs'], 1)
+        self.assertTrue(stats['Staged'] > 1000)
+        gate.set()
+        dl.close()
+        self.assertFalse(dl.backlogged())
+        self.assertEqual(dl.stats()['Staged'], 0)
+        self.assertEqual(self.open(threaded=False).bounds(), (0, 20))
+
+    def test_close_nowait(self):
+        """Closing without waiting returns before the writer is done"""
+        dl = self.open()
+        gate = self.block(dl)
+        for i in xrange(0, 10):
+            dl.append(i)
+        d = dl.close(wait=False)
+        self.assertFalse(d.called)
+        self.assertTrue(dl.writer.isAlive())
+        gate.set()
+        def check(_):
+            dl.writer.join()
+            self.assertEqual(self.open(threaded=False).bounds(), (0, 10))
+        d.addCallback(check)
+        return d
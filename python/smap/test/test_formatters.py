@@ -0,0 +1,184 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import zlib
+import uuid
+
+from twisted.trial import unittest
+from twisted.web import iweb
+
+from smap import formatters, schema, smapconf, util, sjson as json
+from smap.util import np
+
+class Consumer(object):
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+    def value(self):
+        return ''.join(self.data)
+
+def make_report(streams, readings):
+    return dict(('/s%i' % i, {
+                    'uuid': str(uuid.uuid1()),
+                    'Readings': [[j * 1000, j * 0.5] for j in xrange(0, readings)]})
+                for i in xrange(0, streams))
+
+def produce(formatter):
+    formatter._consumer = Consumer()
+    steps = len(list(formatter._produce()))
+    return formatter._consumer.value(), steps
+
+class TestGzipFormatters(unittest.TestCase):
+    def test_json(self):
+        report = make_report(3, 100)
+        data, _ = produce(formatters.GzipJson(report))
+        self.assertEqual(json.loads(zlib.decompress(data)), report)
+
+    def test_avro(self):
+        report = make_report(3, 100)
+        ids = dict((k, v['uuid']) for k, v in report.iteritems())
+        data, _ = produce(formatters.GzipAvro(report))
+        # uuids are put back the way they were after encoding
+        self.assertEqual(ids, dict((k, v['uuid']) for k, v in report.iteritems()))
+        self.assertEqual(zlib.decompress(data), schema.dump_report(report))
+
+    def test_encoder(self):
+        """Any encoder's output can be compressed"""
+        fmt = formatters.GzipFormatter(['a', 'b'], lambda v: iter(v * 3))
+        data, _ = produce(fmt)
+        self.assertEqual(zlib.decompress(data), 'ababab')
+        self.assertEqual(fmt.length, iweb.UNKNOWN_LENGTH)
+
+    def test_iter_report(self):
+        report = make_report(5, 10)
+        chunks = list(schema.iter_report(report))
+        self.assertEqual(len(chunks), 6)
+        self.assertEqual(''.join(chunks), schema.dump_report(report))
+        self.assertEqual(''.join(schema.iter_report({})), 
+                         schema.dump_report({}))
+
+    def test_incremental(self):
+        """Large reports are produced over several cooperative steps"""
+        report = make_report(20, 1000)
+        data, steps = produce(formatters.GzipJson(report))
+        self.assertTrue(steps > 1)
+        self.assertEqual(json.loads(zlib.decompress(data)), report)
+
+    def test_level(self):
+        report = make_report(3, 1000)
+        fast, _ = produce(formatters.GzipJson(report, level=0))
+        best, _ = produce(formatters.GzipJson(report, level=9))
+        self.assertTrue(len(best) < len(fast))
+        self.assertEqual(zlib.decompress(fast), zlib.decompress(best))
+
+    def test_level_config(self):
+        smapconf.SERVER['compressionlevel'] = 1
+        try:
+            self.assertEqual(formatters.GzipAvro({}).level, 1)
+        finally:
+            del smapconf.SERVER['compressionlevel']
+        self.assertEqual(formatters.GzipAvro({}).level, 
+                         formatters.GzipFormatter.level)
+
+    def test_start_producing(self):
+        report = make_report(2, 10)
+        consumer = Consumer()
+        d = formatters.GzipJson(report).startProducing(consumer)
+        d.addCallback(lambda _: self.assertEqual(
+                json.loads(zlib.decompress(consumer.value())), report))
+        return d
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self.report = {
+            '/': {'uuid': str(uuid.uuid1()), 'Contents': ['s0', 's1']},
+            '/s0': {'uuid': str(uuid.uuid1()),
+                    'Properties': {'ReadingType': 'double'},
+                    'Readings': [[1000, 0.5], [900, -1.25], [2 ** 40, 3e10]]},
+            '/s1': {'uuid': str(uuid.uuid1()),
+                    'Readings': [[1, 10], [2, -(2 ** 40)], [3, 0]]},
+            '/s2': {'uuid': str(uuid.uuid1()), 'Readings': []},
+            }
+
+    def check(self, rv):
+        self.assertEqual(set(rv.keys()), set(self.report.keys()))
+        for path, obj in self.report.iteritems():
+            for k, v in obj.iteritems():
+                if k == 'Readings':
+                    self.assertEqual(map(list, rv[path].get(k, [])), v)
+                else:
+                    self.assertEqual(rv[path][k], v)
+
+    def test_roundtrip(self):
+        rv = formatters.load_columnar(formatters.dump_columnar(self.report))
+        self.check(rv)
+        # the readings come back in columns of the right type
+        self.assertTrue(isinstance(rv['/s0']['Readings'], util.ReadingBuffer))
+        times, values = rv['/s1']['Readings'].columns()
+        self.assertEqual(values.dtype, np.int64)
+        self.assertEqual(times.tolist(), [1, 2, 3])
+        self.assertEqual(rv['/s0']['Readings'].columns()[1].dtype, np.float64)
+
+    def test_roundtrip_python(self):
+        self.patch(formatters, 'np', None)
+        rv = formatters.load_columnar(formatters.dump_columnar(self.report))
+        self.check(rv)
+
+    def test_missing_values(self):
+        rv = formatters.load_columnar(formatters.dump_columnar({
+                    '/s': {'uuid': 'x', 'Readings': [[1, None], [2, 1]]}}))
+        values = rv['/s']['Readings'].columns()[1]
+        self.assertTrue(np.isnan(values[0]))
+        self.assertEqual(values[1], 1.)
+
+    def test_reading_buffer(self):
+        buf = util.ReadingBuffer(dtype=np.int64)
+        buf.extend([(i * 1000, i) for i in xrange(0, 100)])
+        data = formatters.dump_columnar({'/s': {'uuid': 'x', 'Readings': buf}})
+        self.assertEqual(formatters.load_columnar(data)['/s']['Readings'], buf)
+
+    def test_size(self):
+        report = make_report(1, 1000)
+        for v in report.itervalues():
+            v['Readings'] = [[1350000000000 + t, float(t)] for t, _ in v['Readings']]
+        self.assertTrue(len(formatters.dump_columnar(report)) < 
+                        len(json.dumps(report)) / 2)
+
+    def test_truncated(self):
+        data = formatters.dump_columnar(self.report)
+        self.assertRaises(ValueError, formatters.load_columnar, data[:-10])
+        self.assertRaises(ValueError, formatters.load_columnar, 'garbage')
+
+    def test_gzip(self):
+        report = make_report(3, 100)
+        data, _ = produce(formatters.GzipColumnar(report))
+        self.assertEqual(zlib.decompress(data), formatters.dump_columnar(report))
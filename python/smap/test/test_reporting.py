@@ -32,11 +32,15 @@ from twisted.trial import unittest
 import sys
 sys.path.append('..')
 
+from twisted.internet import defer
 from uuid import UUID
 import uuid
+import os
 import shutil
+import time
+import cPickle as pickle
 
-from smap import reporting, util
+from smap import core, disklog, reporting, util
 
 
 class TestDataBuffer(unittest.TestCase):
@@ -161,3 +165,597 @@ class TestReportingCopy(unittest.TestCase):
         copy = reporting.reporting_copy(obj)
         self.assertEqual(obj, copy)
         self.assertNotEqual(id(obj), id(copy))
+
+
+class TestReporting(unittest.TestCase):
+    TEST_DIR = "test_dir"
+    def setUp(self):
+        try:
+            shutil.rmtree(self.TEST_DIR)
+        except OSError:
+            pass
+        self.inst = core.SmapInstance(uuid.uuid1(), autoflush=None,
+                                      reportfile=self.TEST_DIR + '/reports')
+        self.inst.add_timeseries('/a/b', 'b', 'kW')
+        self.reports = self.inst.reports
+        self.addCleanup(self.reports.log.close)
+        for rid, resource in [('all', '/+'), ('a', '/a/+'), ('d', '/d')]:
+            self.reports.add_report({'uuid' : rid,
+                                     'ReportResource' : resource,
+                                     'ReportDeliveryLocation' : ['http://localhost/']})
+
+    def subscribers(self, path):
+        return sorted(s['uuid'] for s in self.reports.topics.get(path, []))
+
+    def test_index(self):
+        self.assertEqual(self.subscribers('/'), ['all'])
+        self.assertEqual(self.subscribers('/a/b'), ['a', 'all'])
+        self.assertEqual(self.subscribers('/d'), [])
+
+        self.inst.add_timeseries('/a/c', 'c', 'kW')
+        self.inst.add_timeseries('/d', 'd', 'kW')
+        self.assertEqual(self.subscribers('/a/c'), ['a', 'all'])
+        self.assertEqual(self.subscribers('/d'), ['all', 'd'])
+        self.assertEqual(self.reports.get_report('d')['Topics'], set(['/d']))
+
+        # a full rebuild gives the same index
+        index = dict((k, self.subscribers(k)) for k in self.reports.topics)
+        self.reports.update_subscriptions()
+        self.assertEqual(index, dict((k, self.subscribers(k)) 
+                                     for k in self.reports.topics))
+
+    def test_publish(self):
+        for sub in self.reports.subscribers:
+            if len(sub['PendingData']):
+                sub['PendingData'].read()
+                sub['PendingData'].truncate()
+        self.reports.publish('/a/b', {'uuid' : 'b', 'Readings' : [(1, 1)]})
+        for rid, n in [('all', 1), ('a', 1), ('d', 0)]:
+            self.assertEqual(len(self.reports.get_report(rid)['PendingData']), n)
+        # the value is only logged once
+        self.assertEqual(self.reports.log.data.tail()[-1], 
+                         ('/a/b', {'uuid' : 'b', 'Readings' : [(1, 1)]}, 
+                          ('all', 'a')))
+
+    def test_reload(self):
+        pending = dict((s['uuid'], len(s['PendingData'])) 
+                       for s in self.reports.subscribers)
+        self.reports.save_reports()
+        inst = core.SmapInstance(uuid.uuid1(), autoflush=None,
+                                 reportfile=self.TEST_DIR + '/reports')
+        self.addCleanup(inst.reports.log.close)
+        self.assertEqual(pending, dict((s['uuid'], len(s['PendingData']))
+                                       for s in inst.reports.subscribers))
+
+    def reload(self):
+        inst = core.SmapInstance(uuid.uuid1(), autoflush=None,
+                                 reportfile=self.TEST_DIR + '/reports')
+        self.addCleanup(inst.reports.log.close)
+        return inst.reports
+
+    def pending(self, reports):
+        return dict((s['uuid'], len(s['PendingData']))
+                    for s in reports.subscribers)
+
+    def test_reload_counts(self):
+        """Saved counts are used instead of reading the log back"""
+        n = reporting.REPORT_RECORD_LIMIT
+        for i in xrange(0, 3 * n):
+            self.reports.publish('/a/b', {'uuid' : 'b', 'Readings' : [(i, i)]})
+        a = self.reports.get_report('a')['PendingData']
+        # part way through the first segment
+        rv, end, count = a.read_from(a.position, limit=10)
+        a.advance(end, count)
+        pending = self.pending(self.reports)
+        usage = self.reports.log.overflow_stats('a')
+        self.reports.save_reports()
+        # as on a restart, so it has all been written
+        self.reports.log.close()
+
+        def get(log, seq):
+            raise AssertionError("read back segment %i" % seq)
+        self.patch(disklog.SegmentedLog, 'get', get)
+        reports = self.reload()
+        self.assertEqual(pending, self.pending(reports))
+        self.assertEqual(usage, reports.log.overflow_stats('a'))
+
+    def test_reload_unsaved(self):
+        """Data added after the positions were saved is counted"""
+        self.reports.save_reports()
+        pending = self.pending(self.reports)
+        self.reports.publish('/a/b', {'uuid' : 'b', 'Readings' : [(1, 1)]})
+        self.reports.log.close()
+        reports = self.reload()
+        pending['a'] += 1
+        pending['all'] += 1
+        self.assertEqual(pending, self.pending(reports))
+
+    def test_close(self):
+        """The log is written out before the positions are saved"""
+        self.reports.publish('/a/b', {'uuid' : 'b', 'Readings' : [(1, 1)]})
+        pending = self.pending(self.reports)
+        store, saved = self.reports.store, []
+        save_positions = store.save_positions
+        def save(state):
+            saved.append(self.reports.log.data.closed)
+            save_positions(state)
+        self.patch(store, 'save_positions', save)
+        d = self.reports.close()
+        def check(_):
+            self.assertEqual(saved, [True])
+            self.assertFalse(self.reports.log.data.writer.isAlive())
+            self.assertEqual(pending, self.pending(self.reload()))
+        d.addCallback(check)
+        return d
+
+    def test_store(self):
+        """Changes to reports are saved as they are made"""
+        store = self.TEST_DIR + '/reports-reports/'
+        self.assertEqual(sorted(os.listdir(store)),
+                         ['report-a', 'report-all', 'report-d'])
+        self.reports.del_report('a')
+        self.reports.update_report({'uuid' : 'd', 'ReportResource' : '/a/b',
+                                    'ReportDeliveryLocation' : ['http://localhost/']})
+        self.assertEqual(sorted(os.listdir(store)), ['report-all', 'report-d'])
+        reports = self.reload()
+        self.assertEqual(sorted(s['uuid'] for s in reports.subscribers),
+                         ['all', 'd'])
+        self.assertEqual(reports.get_report('d')['ReportResource'], '/a/b')
+        # nothing was saved for d, so it gets everything still in the log
+        self.assertEqual(reports.get_report('d')['PendingData'].position, (0, 0))
+
+    def test_legacy(self):
+        """Reports saved together in the reportfile are moved to the store"""
+        self.reports.log.sync()
+        pending = dict((s['uuid'], len(s['PendingData']))
+                       for s in self.reports.subscribers)
+        util.pickle_dump(self.TEST_DIR + '/reports', self.reports.subscribers)
+        shutil.rmtree(self.TEST_DIR + '/reports-reports')
+        reports = self.reload()
+        self.assertEqual(pending, dict((s['uuid'], len(s['PendingData']))
+                                       for s in reports.subscribers))
+        self.assertFalse(os.path.exists(self.TEST_DIR + '/reports'))
+        self.assertEqual(len(self.reload().subscribers), 3)
+
+    def test_default_limit(self):
+        """Reports without MaxRecords are still bounded"""
+        self.assertEqual(self.reports.log.limits['a'],
+                         (reporting.BUFSIZE_LIMIT, None, 'drop-oldest'))
+
+    def test_remove(self):
+        self.reports.del_report('a')
+        self.assertEqual(self.subscribers('/a/b'), ['all'])
+        self.reports.update_report({'uuid' : 'all',
+                                    'ReportResource' : '/a/+',
+                                    'ReportDeliveryLocation' : ['http://localhost/']})
+        self.assertEqual(self.subscribers('/'), [])
+        self.assertEqual(self.subscribers('/a/b'), ['all'])
+
+
+class TestReportLog(unittest.TestCase):
+    TEST_DIR = "test_dir"
+    def setUp(self):
+        try:
+            shutil.rmtree(self.TEST_DIR)
+        except OSError:
+            pass
+        self.log = reporting.ReportLog(self.TEST_DIR)
+        self.addCleanup(self.log.close)
+        self.a = self.log.cursor('a')
+        self.b = self.log.cursor('b')
+
+    def add(self, key, i, ids):
+        self.log.add(key, {'uuid' : key, 'Readings' : [(i, i)]}, ids)
+
+    def test_cursors(self):
+        for i in xrange(0, 10):
+            self.add('/x', i, ['a', 'b'])
+            self.add('/y', i, ['b'])
+        self.assertEqual(len(self.a), 10)
+        self.assertEqual(len(self.b), 20)
+
+        rv = self.a.read()
+        self.assertEqual(rv.keys(), ['/x'])
+        self.assertEqual(rv['/x']['Readings'], [(i, i) for i in xrange(0, 10)])
+        # data added after a read isn't truncated
+        self.add('/x', 10, ['a'])
+        self.a.truncate()
+        self.assertEqual(len(self.a), 1)
+        self.assertEqual(self.a.read()['/x']['Readings'], [(10, 10)])
+        self.a.truncate()
+        self.assertEqual(len(self.a), 0)
+        self.assertRaises(util.SmapException, self.a.read)
+
+        rv = self.b.read()
+        self.assertEqual(sorted(rv.keys()), ['/x', '/y'])
+        self.assertEqual(len(rv['/y']['Readings']), 10)
+        self.b.truncate()
+        self.assertEqual(len(self.b), 0)
+
+    def test_metadata_split(self):
+        self.log.add('/x', {'uuid' : 'x', 'Metadata' : {'Test' : '1'}}, ['a'])
+        self.add('/x', 0, ['a'])
+        self.log.add('/x', {'uuid' : 'x', 'Metadata' : {'Test' : '2'}}, ['a'])
+        rv = self.a.read()
+        self.assertEqual(rv['/x']['Metadata'], {'Test' : '1'})
+        self.assertEqual(rv['/x']['Readings'], [(0, 0)])
+        self.a.truncate()
+        self.assertEqual(self.a.read()['/x']['Metadata'], {'Test' : '2'})
+
+    def test_collect(self):
+        n = reporting.REPORT_RECORD_LIMIT * 3
+        for i in xrange(0, n):
+            self.add('/x', i, ['a', 'b'])
+        self.assertEqual(len(self.log), 3)
+        while len(self.a):
+            self.a.read()
+            self.a.truncate()
+        # b still needs everything
+        self.assertEqual(len(self.log), 3)
+        readings = []
+        while len(self.b):
+            readings.extend(self.b.read()['/x']['Readings'])
+            self.b.truncate()
+        self.assertEqual(len(readings), n)
+        # only the tail is left
+        self.assertEqual(len(self.log), 1)
+
+        # the tail was full, so this starts a new segment
+        self.add('/x', n, ['a', 'b'])
+        self.log.remove('b')
+        self.assertEqual(len(self.log), 2)
+        self.assertEqual(self.a.read()['/x']['Readings'], [(n, n)])
+        self.a.truncate()
+        self.assertEqual(len(self.log), 1)
+
+    def test_reload(self):
+        for i in xrange(0, 10):
+            self.add('/x', i, ['a', 'b'])
+        self.a.read()
+        self.a.truncate()
+        self.log.sync()
+        state = [pickle.loads(pickle.dumps(c, 2)) for c in [self.a, self.b]]
+
+        log = reporting.ReportLog(self.TEST_DIR)
+        self.addCleanup(log.close)
+        map(log.attach, state)
+        self.assertEqual(len(log.cursors['a']), 0)
+        self.assertEqual(len(log.cursors['b']), 10)
+        self.assertEqual(len(log.cursors['b'].read()['/x']['Readings']), 10)
+
+    def test_durability(self):
+        self.log.set_durability('a', 'sync')
+        self.log.set_durability('b', 'none')
+        self.assertTrue(self.log.data.fsync)
+        self.add('/x', 1, ['b'])
+        self.assertTrue(self.log.data.dirty)
+        self.add('/x', 2, ['a', 'b'])
+        self.assertFalse(self.log.data.dirty)
+        self.assertEqual(self.log.data.unsynced, 0)
+
+        self.log.set_durability('a', 'none')
+        self.assertFalse(self.log.data.fsync)
+        self.assertRaises(util.SmapException, 
+                          self.log.set_durability, 'a', 'always')
+
+    def test_max_age(self):
+        self.log.set_max_age('a', 10)
+        self.assertEqual(self.log.data.max_age, None)
+        self.log.set_max_age('b', 20)
+        self.assertEqual(self.log.data.max_age, 20)
+
+        # fill a few segments, and make the first ones old
+        for i in xrange(0, 3 * reporting.REPORT_RECORD_LIMIT):
+            self.add('/x', i, ['a', 'b'])
+        self.log.sync()
+        head, tail = self.log.data.bounds()
+        self.assertEqual(tail - head, 3)
+        data = self.log.data
+        for seq in [head, head + 1]:
+            data.index[seq] = data.index[seq][:3] + (time.time() - 30,)
+        self.a.read()
+        self.log.sync()
+
+        self.assertEqual(self.log.data.bounds(), (head + 2, tail))
+        self.assertEqual(self.a.position, (head + 2, 0))
+        self.assertEqual(len(self.a), reporting.REPORT_RECORD_LIMIT)
+        # finishing the read from before data expired
+        self.a.truncate()
+        self.assertEqual(self.a.position, (head + 2, 0))
+        self.assertEqual(len(self.a), reporting.REPORT_RECORD_LIMIT)
+
+
+    def test_drop_oldest(self):
+        n = reporting.REPORT_RECORD_LIMIT
+        self.log.set_limits('a', max_records=2 * n)
+        for i in xrange(0, 4 * n + 1):
+            self.add('/x', i, ['a', 'b'])
+        head, tail = self.log.data.bounds()
+        # a segment is dropped each time it goes over
+        self.assertEqual(self.a.position, (head + 3, 0))
+        self.assertEqual(len(self.a), n + 1)
+        self.assertEqual(len(self.b), 4 * n + 1)
+        self.assertEqual(self.a.read()['/x']['Readings'][0], (3 * n, 3 * n))
+        stats = self.log.overflow_stats('a')
+        self.assertEqual(stats['Dropped'], 3 * n)
+        self.assertEqual(stats['PendingRecords'], n + 1)
+        self.assertEqual(self.log.overflow_stats('b')['Dropped'], 0)
+
+    def test_drop_newest(self):
+        n = reporting.REPORT_RECORD_LIMIT
+        self.log.set_limits('a', max_records=n, policy='drop-newest')
+        for i in xrange(0, 3 * n):
+            self.add('/x', i, ['a', 'b'])
+        # limits are checked as data is added, not once per segment
+        self.assertEqual(len(self.a), n + 1)
+        self.assertEqual(len(self.b), 3 * n)
+        self.assertEqual(self.log.overflow_stats('a')['Dropped'], 2 * n - 1)
+        # delivering its data lets it take new data again
+        while len(self.a):
+            self.a.read()
+            self.a.truncate()
+        self.add('/x', 3 * n, ['a'])
+        self.assertEqual(self.a.read()['/x']['Readings'][-1], (3 * n, 3 * n))
+
+    def test_backlogged(self):
+        """New data is dropped while the writer is behind, except for
+        reports with sync durability"""
+        self.log.set_durability('b', 'sync')
+        self.add('/x', 0, ['a', 'b'])
+        backlogged = [True]
+        self.patch(self.log.data, 'backlogged', lambda: backlogged[0])
+        self.add('/x', 1, ['a', 'b'])
+        self.assertEqual(len(self.a), 1)
+        self.assertEqual(len(self.b), 2)
+        self.assertEqual(self.log.overflow_stats('a')['BacklogDropped'], 1)
+        self.assertEqual(self.log.overflow_stats('b')['BacklogDropped'], 0)
+        self.assertEqual(self.log.overflow_stats('a')['Dropped'], 0)
+        self.assertEqual(self.log.shedding, 1)
+
+        backlogged[0] = False
+        self.add('/x', 2, ['a', 'b'])
+        self.assertEqual(len(self.a), 2)
+        self.assertEqual(self.log.shedding, None)
+
+    def test_downsample(self):
+        n = reporting.REPORT_RECORD_LIMIT
+        self.log.set_limits('a', max_records=2 * n, policy='downsample')
+        self.log.add('/y', {'uuid' : '/y', 'Readings' : [(0, 0), (1, 1)]},
+                     ['a', 'b'])
+        for i in xrange(0, 4 * n, 10):
+            self.log.add('/x', {'uuid' : '/x',
+                                'Readings' : [(j, j) for j in xrange(i, i + 10)]},
+                         ['a'])
+        stats = self.log.overflow_stats('a')
+        self.assertEqual(stats['PendingRecords'] + stats['Thinned'], 4 * n + 2)
+        self.assertTrue(0 < stats['Thinned'])
+        self.assertTrue(stats['PendingRecords'] <= 2 * n)
+        self.assertEqual(stats['Dropped'], 0)
+        self.assertEqual(len(self.a), 4 * n / 10 + 1)
+        rv = self.a.read()
+        # the oldest data has been thinned the most
+        self.assertEqual(rv['/x']['Readings'][:2], [(0, 0), (10, 10)])
+        # shared with a subscriber that doesn't downsample
+        self.assertEqual(len(rv['/y']['Readings']), 2)
+
+    def test_overflow_policy(self):
+        self.assertRaises(util.SmapException, self.log.set_limits,
+                          'a', 10, None, 'drop-everything')
+
+    def test_running_usage(self):
+        """Pending usage is kept as data is added and delivered,
+        without reading the log back"""
+        n = reporting.REPORT_RECORD_LIMIT
+        for i in xrange(0, 3 * n):
+            self.add('/x', i, ['a', 'b'])
+            self.add('/y', i, ['b'])
+        self.a.read()
+        self.a.truncate()
+        self.assertEqual(self.log.count('a', self.a.position), len(self.a))
+        self.patch(self.log, '_segment', lambda seq: self.fail("read back"))
+        readings = self.log.overflow_stats('a')['PendingRecords']
+        self.assertEqual(self.log.count('b', (0, 0)), 6 * n)
+        self.assertEqual(self.log.overflow_stats('b')['PendingRecords'], 6 * n)
+
+        self.log._total('a')
+        self.assertEqual(self.log.overflow_stats('a')['PendingRecords'],
+                         readings)
+
+    def test_consumed_removed(self):
+        """Finishing a delivery after the report was removed is
+        ignored"""
+        self.add('/x', 0, ['a'])
+        self.a.read()
+        self.log.remove('a')
+        self.a.truncate()
+        self.assertFalse('a' in self.log.pending)
+
+
+class FakeResponse:
+    def __init__(self, code):
+        self.code = code
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived('error')
+        protocol.connectionLost(None)
+
+
+class TestPipeline(unittest.TestCase):
+    TEST_DIR = "test_dir"
+    def setUp(self):
+        try:
+            shutil.rmtree(self.TEST_DIR)
+        except OSError:
+            pass
+        self.requests = []
+        test = self
+        class FakeAgent:
+            def __init__(self, *args, **kwargs):
+                pass
+            def request(self, method, url, headers, body):
+                d = defer.Deferred()
+                test.requests.append((url, body.producer._value, d))
+                return d
+        self.patch(reporting, 'Agent6', FakeAgent)
+        # one entry per log record
+        self.patch(reporting, 'REPORT_RECORD_LIMIT', 1)
+
+        self.log = reporting.ReportLog(self.TEST_DIR)
+        self.addCleanup(self.log.close)
+        self.rpt = reporting.HttpReportInstance(self.log.cursor('r'), {
+                'uuid' : 'r',
+                'ReportDeliveryLocation' : ['http://a/', 'http://b/'],
+                'MaxInFlight' : 3})
+        for i in xrange(0, 5):
+            self.log.add('/x', {'uuid' : 'x', 'Readings' : [(i, i)]}, ['r'])
+
+    def sent(self, i):
+        url, body, d = self.requests[i]
+        return url, body['/x']['Readings'][0][0]
+
+    def test_pipeline(self):
+        self.rpt.attempt()
+        self.assertEqual(map(self.sent, xrange(0, 3)), 
+                         [('http://a/', 0), ('http://a/', 1), ('http://a/', 2)])
+        self.assertTrue(self.rpt['Busy'])
+        self.assertEqual(self.rpt.attempt(), None)
+
+        # out of order acknowledgements don't truncate the log
+        self.requests[1][2].callback(FakeResponse(200))
+        self.assertEqual(len(self.rpt['PendingData']), 5)
+        self.requests[0][2].callback(FakeResponse(200))
+        self.assertEqual(len(self.rpt['PendingData']), 3)
+        # and the pipeline is refilled
+        self.assertEqual(map(self.sent, xrange(3, 5)), 
+                         [('http://a/', 3), ('http://a/', 4)])
+
+        # a failure moves on to the next location once everything
+        # in flight has finished, and starts from the failed chunk
+        self.requests[2][2].callback(FakeResponse(500))
+        self.assertTrue(self.rpt['Busy'])
+        self.requests[3][2].callback(FakeResponse(200))
+        self.requests[4][2].callback(FakeResponse(200))
+        self.assertFalse(self.rpt['Busy'])
+        self.assertEqual(len(self.rpt['PendingData']), 3)
+        self.assertEqual(len(self.requests), 5)
+
+        self.rpt.attempt()
+        self.assertEqual(map(self.sent, xrange(5, 8)), 
+                         [('http://b/', 2), ('http://b/', 3), ('http://b/', 4)])
+        for _, _, d in self.requests[5:]:
+            d.callback(FakeResponse(200))
+        self.assertEqual(len(self.rpt['PendingData']), 0)
+        self.assertFalse(self.rpt['Busy'])
+
+    def test_max_connections(self):
+        self.rpt['MaxConnections'] = 2
+        self.rpt.attempt()
+        # the third chunk waits for a connection
+        self.assertEqual(len(self.rpt['InFlight']), 3)
+        self.assertEqual(map(self.sent, xrange(0, 2)),
+                         [('http://a/', 0), ('http://a/', 1)])
+        self.assertEqual(len(self.requests), 2)
+        self.requests[0][2].callback(FakeResponse(200))
+        self.assertEqual(self.sent(2), ('http://a/', 2))
+        # and the chunk which refilled the pipeline waits in turn
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(self.rpt.stats()['ConnectionWaits'], 2)
+
+class TestConnectionPool(unittest.TestCase):
+    TEST_DIR = "test_dir"
+    def setUp(self):
+        try:
+            shutil.rmtree(self.TEST_DIR)
+        except OSError:
+            pass
+        from twisted.internet import reactor
+        from twisted.web import server, resource
+        class Archiver(resource.Resource):
+            isLeaf = True
+            def render_POST(self, request):
+                return ''
+        self.port = reactor.listenTCP(0, server.Site(Archiver()), 
+                                      interface='127.0.0.1')
+        self.patch(reporting, 'REPORT_RECORD_LIMIT', 1)
+
+        self.log = reporting.ReportLog(self.TEST_DIR)
+        self.addCleanup(self.log.close)
+        self.rpt = reporting.HttpReportInstance(self.log.cursor('r'), {
+                'uuid' : 'r',
+                'ReportDeliveryLocation' : 
+                ['http://127.0.0.1:%i/' % self.port.getHost().port]})
+        for i in xrange(0, 3):
+            self.log.add('/x', {'uuid' : 'x', 'Readings' : [(i, i)]}, ['r'])
+
+    def tearDown(self):
+        return defer.gatherResults([self.rpt.close(), 
+                                    self.port.stopListening()])
+
+    def test_reuse(self):
+        def check(_):
+            self.assertEqual(len(self.rpt['PendingData']), 0)
+            stats = self.rpt.stats()
+            self.assertEqual(dict((k, stats[k]) for k in 
+                                  ['Requests', 'Connections', 'Reused', 'Handshakes']),
+                             {'Requests' : 3, 
+                              'Connections' : 1,
+                              'Reused' : 2,
+                              'Handshakes' : 0})
+            self.assertEqual(stats['Delivered'], 3)
+            self.assertTrue(stats['DeliveredBytes'] > 0)
+        d = self.rpt.attempt()
+        d.addCallback(check)
+        return d
+
+class TestBatchPolicy(unittest.TestCase):
+    def test_fixed(self):
+        p = reporting.BatchPolicy()
+        p.success(reporting.REPORT_RECORD_LIMIT, 100000, 100)
+        p.failure()
+        self.assertEqual(p.size, reporting.REPORT_RECORD_LIMIT)
+
+    def test_adapt(self):
+        p = reporting.BatchPolicy(target_bytes=100000, target_latency=1)
+        # full, fast batches grow up to the target size
+        p.success(p.size, p.size * 2, 0.1)
+        self.assertEqual(p.size, 15000)
+        for i in xrange(0, 10):
+            p.success(p.size, p.size * 2, 0.1)
+        self.assertEqual(p.size, 50000)
+
+        # bigger readings shrink the batch
+        p.success(p.size, p.size * 100, 0.1)
+        self.assertTrue(p.size < 10000)
+
+        # as do slow deliveries and failures
+        size = p.size
+        p.success(p.size, p.size * 100, 5)
+        self.assertEqual(p.size, size / 2)
+        p.failure()
+        self.assertEqual(p.size, size / 4)
+        self.assertEqual(p.stats()['Failures'], 1)
+
+    def test_max_delay(self):
+        shutil.rmtree("test_dir", ignore_errors=True)
+        log = reporting.ReportLog("test_dir")
+        self.addCleanup(log.close)
+        rpt = reporting.HttpReportInstance(log.cursor('r'), {
+                'uuid' : 'r',
+                'ReportDeliveryLocation' : ['http://localhost/'],
+                'MaxDelay' : 60})
+        rpt['LastSuccess'] = util.now() - 1
+        rpt.get_policy().size = 2
+        log.add('/x', {'uuid' : 'x', 'Readings' : [(0, 0)]}, ['r'])
+        self.assertFalse(rpt.deliverable())
+        log.add('/x', {'uuid' : 'x', 'Readings' : [(1, 1)]}, ['r'])
+        self.assertTrue(rpt.deliverable())
+        rpt.get_policy().size = 10
+        self.assertFalse(rpt.deliverable())
+        # one entry can fill a batch
+        log.add('/x', {'uuid' : 'x', 'Readings' : [(i, i) for i in xrange(2, 10)]},
+                ['r'])
+        self.assertTrue(rpt.deliverable())
+        rpt.get_policy().size = 100
+        self.assertFalse(rpt.deliverable())
+        rpt['LastSuccess'] -= 61
+        self.assertTrue(rpt.deliverable())
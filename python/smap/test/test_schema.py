@@ -0,0 +1,80 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import uuid
+from twisted.trial import unittest
+from avro import io
+
+from smap import schema
+
+class TestValidate(unittest.TestCase):
+    def test_timeseries(self):
+        ts = {
+            'uuid': uuid.uuid1(),
+            'Properties': {'UnitofMeasure': 'kW',
+                           'ReadingType': 'long',
+                           'Timezone': 'America/Los_Angeles'},
+            'Metadata': {'Extra': {'Foo': 'Bar'}},
+            'Readings': [(1, 2), [3, 4.5]],
+            }
+        self.assertTrue(schema.validate('Timeseries', ts))
+        ts['uuid'] = str(ts['uuid'])
+        self.assertTrue(schema.validate('Timeseries', ts))
+        ts['uuid'] = 'foo'
+        self.assertFalse(schema.validate('Timeseries', ts))
+
+    def test_same_as_avro(self):
+        checks = [
+            ('Properties', {'UnitofMeasure': 'kW', 'ReadingType': 'long'}),
+            ('Properties', {'UnitofMeasure': 'kW', 'ReadingType': 'float'}),
+            ('Properties', {'UnitofMeasure': 10, 'ReadingType': 'long'}),
+            ('Metadata', {'Extra': {'Foo': 'Bar'}}),
+            ('Metadata', {'Extra': {'Foo': 10}}),
+            ('Metadata', {'BACnet': {'Out_Of_Service': True}}),
+            ('Metadata', {'BACnet': {'Out_Of_Service': 1}}),
+            ('Metadata', {'Instrument': {'MinValue': 1.5}}),
+            ('Metadata', '10'),
+            ('Collection', {'Contents': ['a', 'b']}),
+            ('Collection', {'Contents': 'a'}),
+            ]
+        for name, obj in checks:
+            s = schema.SCHEMA_NAMES.get_name(name, None)
+            # check twice so we hit the memo
+            self.assertEqual(schema.validate(name, obj), io.validate(s, obj))
+            self.assertEqual(schema.validate(name, obj), io.validate(s, obj))
+
+    def test_field(self):
+        self.assertTrue(schema.validate_field('Timeseries', 'Description', 'foo'))
+        self.assertFalse(schema.validate_field('Timeseries', 'Description', 10))
+        self.assertTrue(schema.validate_field('Timeseries', 'Metadata',
+                                              {'Extra': {'Foo': 'Bar'}}))
+        self.assertFalse(schema.validate_field('Timeseries', 'Metadata',
+                                               {'Extra': {'Foo': 10}}))
+        self.assertTrue(schema.validate_field('Timeseries', 'NotAField', 10))
+        self.assertFalse(schema.validate_field('NotASchema', 'Metadata', 10))
@@ -0,0 +1,205 @@
+"""
+Copyright (c) 2011, 2012, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions 
+are met:
+
+ - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+ - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the
+   distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS 
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL 
+THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, 
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES 
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR 
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, 
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED 
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from twisted.trial import unittest
+
+from smap import util, sjson as json
+
+class TestReadingBuffer(unittest.TestCase):
+    def test_append(self):
+        buf = util.ReadingBuffer(5)
+        for i in xrange(0, 3):
+            buf.append((i, i * 2))
+        self.assertEqual(len(buf), 3)
+        self.assertEqual(buf.tolist(), [(0, 0), (1, 2), (2, 4)])
+        self.assertEqual(buf[-1], (2, 4))
+        self.assertEqual(buf.seqno, 3)
+
+    def test_wrap(self):
+        buf = util.ReadingBuffer(5, dtype='int64')
+        ref = util.FixedSizeList(5)
+        for i in xrange(0, 13):
+            buf.append((i, i))
+            ref.append((i, i))
+            self.assertEqual(buf.tolist(), list(ref))
+        self.assertEqual(buf[0], (8, 8))
+        self.assertEqual(buf[1:3], [(9, 9), (10, 10)])
+        self.assertRaises(IndexError, buf.__getitem__, 5)
+
+    def test_extend(self):
+        buf = util.ReadingBuffer(4)
+        buf.append((0, 0.))
+        buf.extend([(1, 1.), (2, 2.), (3, 3.)])
+        self.assertEqual(buf.tolist(), [(0, 0.), (1, 1.), (2, 2.), (3, 3.)])
+        buf.extend([(i, float(i)) for i in xrange(4, 10)])
+        self.assertEqual(buf.tolist(), [(i, float(i)) for i in xrange(6, 10)])
+        self.assertEqual(buf.seqno, 10)
+        times, values = buf.columns()
+        self.assertEqual(list(times), range(6, 10))
+
+    def test_unbounded(self):
+        buf = util.ReadingBuffer()
+        for i in xrange(0, 100):
+            buf.append((i, float(i)))
+        self.assertEqual(len(buf), 100)
+        self.assertEqual(buf[0], (0, 0.))
+
+    def test_seqno(self):
+        buf = util.ReadingBuffer(3)
+        buf.append((0, 0.))
+        buf.append((1, 1., 12))
+        self.assertEqual(buf.tolist(), [(0, 0.), (1, 1., 12)])
+
+    def test_truncate(self):
+        buf = util.ReadingBuffer(10)
+        for i in xrange(0, 10):
+            buf.append((i, float(i)))
+        buf.truncate(buf.idxtoseq(4))
+        self.assertEqual(buf[0], (4, 4.))
+        buf.set_size(2)
+        self.assertEqual(buf.tolist(), [(8, 8.), (9, 9.)])
+        self.assertEqual(buf.seqno, 10)
+
+    def test_json(self):
+        buf = util.ReadingBuffer(2, init=[(1, 1), (2, 2)], dtype='int64')
+        self.assertEqual(json.loads(json.dumps({'Readings': buf})),
+                         {'Readings': [[1, 1], [2, 2]]})
+
+class TestPathTrie(unittest.TestCase):
+    def setUp(self):
+        self.trie = util.PathTrie()
+        for p in ['/', '/a', '/a/b', '/a/c', '/d']:
+            self.trie[p] = p
+
+    def test_lookup(self):
+        self.assertEqual(self.trie['/a/b'], '/a/b')
+        self.assertEqual(self.trie.get('//a//c/'), '/a/c')
+        self.assertEqual(self.trie.get(['a', 'c']), '/a/c')
+        self.assertEqual(self.trie.get('/a/x'), None)
+        self.assertRaises(KeyError, self.trie.__getitem__, '/x')
+        self.assertTrue('/d' in self.trie)
+        self.assertFalse('/a/b/c' in self.trie)
+        self.assertEqual(len(self.trie), 5)
+
+    def test_walk(self):
+        self.assertEqual(sorted(self.trie.walk('/a')),
+                         [('/a', '/a'), ('/a/b', '/a/b'), ('/a/c', '/a/c')])
+        self.assertEqual(list(self.trie.walk('/x')), [])
+        self.assertEqual(sorted(self.trie.iterkeys()), ['/', '/a', '/a/b', '/a/c', '/d'])
+
+    def test_subtree(self):
+        a = self.trie.subtree('/a')
+        self.assertEqual(a, set(['/a', '/a/b', '/a/c']))
+        root = self.trie.subtree('/')
+        self.trie['/a/e'] = 'e'
+        self.trie['/f'] = 'f'
+        # cached sets are updated in place
+        self.assertTrue(self.trie.subtree('/a') is a)
+        self.assertEqual(a, set(['/a', '/a/b', '/a/c', '/a/e']))
+        self.assertEqual(root, set(['/', '/a', '/a/b', '/a/c', '/a/e', '/d', '/f']))
+        self.assertEqual(self.trie.subtree('/x'), set())
+
+class TestPushMetadata(unittest.TestCase):
+    def test_push(self):
+        rpt = {
+            '/' : {'Contents' : ['a', 'c'],
+                   'Metadata' : {'Location' : {'Building' : 'Soda'}}},
+            '/a' : {'Contents' : ['b'],
+                    'Metadata' : {'Location' : {'Building' : 'Cory',
+                                                'Room' : '410'}}},
+            '/a/b' : {'uuid' : 'b', 'Readings' : [],
+                      'Metadata' : {'Extra' : {'Test' : 'b'}}},
+            '/c' : {'uuid' : 'c', 'Readings' : []},
+            }
+        util.push_metadata(rpt)
+        self.assertEqual(set(rpt.keys()), set(['/a/b', '/c']))
+        # collections nearer the root take precedence
+        self.assertEqual(rpt['/a/b']['Metadata'],
+                         {'Location' : {'Building' : 'Soda', 'Room' : '410'},
+                          'Extra' : {'Test' : 'b'}})
+        self.assertEqual(rpt['/c']['Metadata'],
+                         {'Location' : {'Building' : 'Soda'}})
+        self.assertEqual(rpt['/c']['uuid'], 'c')
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = util.MetadataCache()
+        self.cache.update('/', {'Contents' : ['a', 'c'],
+                                'Metadata' : {'Location' : {'Building' : 'Soda'}}})
+        self.cache.update('/a', {'Contents' : ['b'],
+                                 'Metadata' : {'Location' : {'Building' : 'Cory',
+                                                             'Room' : '410'}}})
+
+    def test_tags(self):
+        ts = {'uuid' : 'b', 'Readings' : [], 'Metadata' : {'Extra' : {'Test' : 'b'}}}
+        # the same as pushing the metadata down and flattening it
+        rpt = {'/a/b' : dict(ts)}
+        rpt['/'] = {'Metadata' : {'Location' : {'Building' : 'Soda'}}}
+        rpt['/a'] = {'Metadata' : {'Location' : {'Building' : 'Cory',
+                                                 'Room' : '410'}}}
+        util.push_metadata(rpt)
+        del rpt['/a/b']['Readings']
+        self.assertEqual(self.cache.tags('/a/b', ts),
+                         dict(util.buildkv('', rpt['/a/b'])))
+        self.assertEqual(self.cache.inherited('/c'),
+                         {'Metadata/Location/Building' : 'Soda'})
+
+    def test_invalidate(self):
+        ab, c = self.cache.inherited('/a/b'), self.cache.inherited('/c')
+        # resending a collection unchanged keeps what was merged
+        self.assertFalse(self.cache.update('/a', {'Contents' : ['b', 'd'],
+            'Metadata' : {'Location' : {'Building' : 'Cory', 'Room' : '410'}}}))
+        self.assertTrue(self.cache.inherited('/a/b') is ab)
+
+        self.assertTrue(self.cache.update('/a', {'Metadata' : {'Floor' : '4'}}))
+        # only what is beneath it is merged again
+        self.assertTrue(self.cache.inherited('/c') is c)
+        self.assertEqual(self.cache.inherited('/a/b'),
+                         {'Metadata/Location/Building' : 'Soda',
+                          'Metadata/Floor' : '4'})
+
+        # with versions, they are compared instead of the metadata
+        self.cache.update('/', {}, version=1)
+        self.assertFalse(self.cache.update('/', {'Metadata' : {'X' : 'y'}}, version=1))
+        self.assertEqual(self.cache.inherited('/c'), {})
+
+class TestFrozenDict(unittest.TestCase):
+    def test_frozen(self):
+        d = util.FrozenDict({'a' : 1})
+        self.assertEqual(d, {'a' : 1})
+        self.assertRaises(TypeError, d.__setitem__, 'b', 2)
+        self.assertRaises(TypeError, d.update, {'b' : 2})
+        self.assertRaises(TypeError, d.pop, 'a')
+        self.assertEqual(d, {'a' : 1})
+
+    def test_pickle(self):
+        import cPickle as pickle
+        d = pickle.loads(pickle.dumps(util.FrozenDict({'a' : 1}), 2))
+        self.assertEqual(d, {'a' : 1})
+        self.assertTrue(isinstance(d, util.FrozenDict))
@@ -45,6 +45,13 @@ from twisted.internet.protocol import Protocol
 from twisted.python.lockfile import FilesystemLock
 from twisted.python import log, failure
 
+try:
+    import numpy as np
+except ImportError:
+    # the column-oriented reading buffer needs numpy; we fall back to
+    # FixedSizeList without it.
+    np = None
+
 class SmapException(Exception):
     """Generic error"""
     def __init__(self, message, http_code=None):
@@ -140,19 +147,45 @@ def flatten(lst):
 """Push all metadata down to the leaves and remove the collections
 """
 def push_metadata(rpt):
+    # the metadata inherited from each collection prefix is merged
+    # once per report and shared by all the streams beneath it.
+    # collections nearer the root take precedence.
+    inherited = {(): {}}
+    def inherit(sp):
+        if not sp in inherited:
+            rv = inherit(sp[:-1])
+            path = join_path(sp[:-1])
+            if path in rpt:
+                upobj = rpt[path]
+                if 'Contents' in upobj:
+                    del upobj['Contents']
+                rv = dict_merge(upobj, rv)
+            inherited[sp] = rv
+        return inherited[sp]
+
     for k, v in rpt.iteritems():
-        sp = split_path(k)
         if 'Readings' in v:
-            for i in xrange(0, len(sp)):
-                if join_path(sp[:i]) in rpt:
-                    upobj = rpt[join_path(sp[:i])]
-                    if 'Contents' in upobj:
-                        del upobj['Contents']
-                    v.update(dict_merge(upobj, v))
+            sp = tuple(split_path(k))
+            v.update(dict_merge(inherit(sp), v))
     for k, v in rpt.items():
         if not 'Readings' in v:
             del rpt[k]
 
+class FrozenDict(dict):
+    """A dict which can't be modified once it's created, so that it
+    can be shared between objects.
+    """
+    __slots__ = []
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenDict can not be modified")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
 class FixedSizeList(list):
     """
     A class for keeping a circular buffer with a maximum size.
@@ -211,6 +244,384 @@ class FixedSizeList(list):
     def idxtoseq(self, idx):
         return self.seqno - len(self) + idx
 
+class ReadingBuffer(object):
+    """
+    A circular buffer of readings stored column-wise in preallocated
+    numpy arrays: int64 times, values of the stream's type, and
+    optionally int64 sequence numbers.  Appending is O(1) no matter how
+    large the buffer is.
+
+    Otherwise it behaves like a :py:class:`FixedSizeList` of ``(time,
+    value)`` or ``(time, value, seqno)`` tuples, so it can be used
+    anywhere a Timeseries' ``Readings`` are expected.  Use
+    :py:meth:`tolist` to get a plain list for serialization.
+    """
+    __slots__ = ['size', 'seqno', 'dtype', '_times', '_values', '_seqnos',
+                 '_start', '_len']
+
+    def __init__(self, size=None, init=None, seqno=0, dtype=None):
+        self.size = size
+        self.seqno = seqno
+        self.dtype = np.dtype(dtype if dtype else np.float64)
+        # the columns are allocated lazily, on the first write
+        self._times = self._values = self._seqnos = None
+        self._start = self._len = 0
+        if init:
+            self.extend(init)
+            self.seqno = seqno
+
+    def __repr__(self):
+        return "ReadingBuffer(size=" + str(self.size) + \
+            ", seqno=" + str(self.seqno) + ", init=" + \
+            repr(self.tolist()) + ")"
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        try:
+            return self.tolist() == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.tolist()[idx]
+        if idx < 0:
+            idx += self._len
+        if idx < 0 or idx >= self._len:
+            raise IndexError("ReadingBuffer index out of range")
+        pos = (self._start + idx) % len(self._times)
+        reading = self._times[pos].item(), self._values[pos].item()
+        if self._seqnos is not None and self._seqnos[pos]:
+            reading += (self._seqnos[pos].item(), )
+        return reading
+
+    def _alloc(self, capacity):
+        """Move the buffer contents into new columns of the given
+        capacity, which must be large enough to hold them."""
+        times, values, seqnos = self._ordered()
+        self._times = np.empty(capacity, dtype=np.int64)
+        self._values = np.empty(capacity, dtype=self.dtype)
+        if seqnos is not None:
+            self._seqnos = np.zeros(capacity, dtype=np.int64)
+            self._seqnos[:self._len] = seqnos
+        self._times[:self._len] = times
+        self._values[:self._len] = values
+        self._start = 0
+
+    def _reserve(self, n):
+        """Make sure there is room to write n more readings"""
+        if self.size:
+            if self._times is None:
+                self._alloc(self.size)
+        elif self._times is None or self._len + n > len(self._times):
+            self._alloc(max(self._len + n, 2 * self._len, 16))
+
+    def _order(self, col):
+        end = self._start + self._len
+        if end <= len(col):
+            return col[self._start:end]
+        return np.concatenate((col[self._start:], col[:end - len(col)]))
+
+    def _ordered(self):
+        if self._times is None:
+            return [], [], None
+        return (self._order(self._times), self._order(self._values),
+                self._order(self._seqnos) if self._seqnos is not None else None)
+
+    def _drop(self, n):
+        """Remove the n oldest readings"""
+        if n > 0:
+            self._start = (self._start + n) % len(self._times)
+            self._len -= n
+
+    def columns(self):
+        """Return the contents as ``(times, values)`` numpy arrays, in
+        order from oldest to newest."""
+        times, values, _ = self._ordered()
+        return (np.array(times, dtype=np.int64),
+                np.array(values, dtype=self.dtype))
+
+    def tolist(self):
+        """Return the readings as a list of tuples"""
+        if not self._len:
+            return []
+        times, values, seqnos = self._ordered()
+        rv = zip(times.tolist(), values.tolist())
+        if seqnos is not None:
+            rv = [(t, v, s) if s else (t, v)
+                  for ((t, v), s) in zip(rv, seqnos.tolist())]
+        return rv
+
+    def append(self, val):
+        self._reserve(1)
+        if len(val) > 2 and val[2] and self._seqnos is None:
+            self._seqnos = np.zeros(len(self._times), dtype=np.int64)
+
+        cap = len(self._times)
+        if self._len == cap:
+            # overwrite the oldest reading
+            pos = self._start
+            self._start = (self._start + 1) % cap
+        else:
+            pos = (self._start + self._len) % cap
+            self._len += 1
+        self._times[pos] = val[0]
+        self._values[pos] = val[1]
+        if self._seqnos is not None:
+            self._seqnos[pos] = val[2] if len(val) > 2 and val[2] else 0
+        self.seqno += 1
+        return True
+
+    def extend(self, val):
+        val = list(val)
+        if not len(val):
+            return
+        times = [v[0] for v in val]
+        values = [v[1] for v in val]
+        if any(len(v) > 2 and v[2] for v in val):
+            seqnos = [v[2] if len(v) > 2 and v[2] else 0 for v in val]
+        else:
+            seqnos = None
+        self.extend_columns(times, values, seqnos)
+
+    def extend_columns(self, times, values, seqnos=None):
+        """Append readings from parallel sequences of times, values,
+        and optionally sequence numbers, without building per-reading
+        tuples.
+        """
+        times = np.asarray(times, dtype=np.int64)
+        values = np.asarray(values, dtype=self.dtype)
+        if len(times) != len(values):
+            raise ValueError("times and values must have the same length")
+        n = len(times)
+        if n == 0:
+            return
+        self.seqno += n
+        self._reserve(n)
+        if seqnos is not None:
+            seqnos = np.asarray(seqnos, dtype=np.int64)
+            if self._seqnos is None:
+                self._seqnos = np.zeros(len(self._times), dtype=np.int64)
+
+        cap = len(self._times)
+        if n > cap:
+            # only the newest readings will fit
+            times, values = times[-cap:], values[-cap:]
+            if seqnos is not None: seqnos = seqnos[-cap:]
+            n = cap
+        self._drop(self._len + n - cap)
+
+        pos = (self._start + self._len) % cap
+        first = min(n, cap - pos)
+        cols = [(self._times, times), (self._values, values)]
+        if self._seqnos is not None:
+            cols.append((self._seqnos, seqnos if seqnos is not None
+                         else np.zeros(n, dtype=np.int64)))
+        for col, new in cols:
+            col[pos:pos+first] = new[:first]
+            col[:n-first] = new[first:]
+        self._len += n
+
+    def truncate(self, seq):
+        """Remove readings up to sequence number seq"""
+        rmpt = seq - (self.seqno - self._len)
+        if rmpt >= 0:
+            self._drop(min(rmpt, self._len))
+
+    def set_size(self, size):
+        times, values, seqnos = self._ordered()
+        seqno = self.seqno
+        self.size = size
+        self._times = self._values = self._seqnos = None
+        self._start = self._len = 0
+        self.extend_columns(times, values, seqnos)
+        self.seqno = seqno
+
+    def idxtoseq(self, idx):
+        return self.seqno - self._len + idx
+
+class PathTrie(object):
+    """
+    A mapping from sMAP paths to objects, stored as a tree with one
+    node per path component.  Paths may be given either as strings
+    or as lists of components.
+
+    Lookups cost O(depth) and the objects under a path can be iterated
+    without resolving each of their paths again.  The set of paths
+    under a node is computed the first time it is asked for, and then
+    kept up to date as new paths are added.
+    """
+    class Node(object):
+        __slots__ = ['obj', 'children', 'paths']
+        def __init__(self):
+            self.obj = None
+            self.children = {}
+            # cached set of the paths in this subtree, or None
+            self.paths = None
+
+    def __init__(self):
+        self.root = PathTrie.Node()
+        self.count = 0
+
+    @staticmethod
+    def split(path):
+        if isinstance(path, (list, tuple)):
+            return path
+        return [p for p in path.split('/') if p]
+
+    def _find(self, path):
+        node = self.root
+        for cmp in self.split(path):
+            node = node.children.get(cmp, None)
+            if node is None:
+                return None
+        return node
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, path):
+        node = self._find(path)
+        return node is not None and node.obj is not None
+
+    def get(self, path, default=None):
+        node = self._find(path)
+        if node is None or node.obj is None:
+            return default
+        return node.obj
+
+    def __getitem__(self, path):
+        node = self._find(path)
+        if node is None or node.obj is None:
+            raise KeyError(path)
+        return node.obj
+
+    def __setitem__(self, path, obj):
+        path = self.split(path)
+        fullpath = join_path(path)
+        node = self.root
+        ancestors = [node]
+        for cmp in path:
+            if not cmp in node.children:
+                node.children[cmp] = PathTrie.Node()
+            node = node.children[cmp]
+            ancestors.append(node)
+
+        if node.obj is None:
+            self.count += 1
+            for anc in ancestors:
+                if anc.paths is not None:
+                    anc.paths.add(fullpath)
+        node.obj = obj
+
+    def walk(self, path='/'):
+        """Iterate over ``(path, object)`` for every object at or below
+        *path*, breadth-first."""
+        path = self.split(path)
+        node = self._find(path)
+        if node is None: return
+        q = collections.deque([(join_path(path), node)])
+        while len(q) > 0:
+            cur_path, cur = q.popleft()
+            if cur.obj is not None:
+                yield cur_path, cur.obj
+            prefix = cur_path if cur_path != '/' else ''
+            for cmp, child in cur.children.iteritems():
+                q.append((prefix + '/' + cmp, child))
+
+    def subtree(self, path='/'):
+        """Return the set of paths at or below *path*.  The set is
+        cached and updated in place as paths are added, so callers
+        must not modify it."""
+        node = self._find(path)
+        if node is None:
+            return set()
+        if node.paths is None:
+            node.paths = set((p for p, _ in self.walk(path)))
+        return node.paths
+
+    def iterkeys(self):
+        return (p for p, _ in self.walk())
+
+    def itervalues(self):
+        return (o for _, o in self.walk())
+
+    def iteritems(self):
+        return self.walk()
+
+    __iter__ = iterkeys
+
+class MetadataCache(object):
+    """The metadata timeseries inherit from the collections above
+    them, flattened into ``{name : value}`` tags as by
+    :py:func:`buildkv`.
+
+    Collections are recorded with :py:meth:`update`, along with a
+    version which changes whenever their metadata does.  The tags
+    inherited beneath each collection are merged once and kept until
+    it or a collection above it changes, so changing one collection
+    only invalidates the collections beneath it.  As in
+    :py:func:`push_metadata`, collections nearer the root take
+    precedence, and a timeseries' own metadata takes precedence over
+    what it inherits.
+    """
+    SKIP = ('Contents', 'Readings')
+
+    def __init__(self):
+        # path -> [version, own tags, tags inherited beneath it or None]
+        self.collections = PathTrie()
+
+    @classmethod
+    def flatten(cls, obj):
+        """The tags for the metadata of *obj* itself"""
+        return dict(buildkv('', dict((k, v) for (k, v) in obj.iteritems()
+                                     if not k in cls.SKIP)))
+
+    def update(self, path, obj, version=None):
+        """Record the collection *obj* at *path*.  If *version* is
+        None, its tags are compared instead.  Returns True if it
+        changed."""
+        own = None
+        if version is None:
+            version = own = self.flatten(obj)
+        entry = self.collections.get(path)
+        if entry is not None and entry[0] == version:
+            return False
+        if own is None:
+            own = self.flatten(obj)
+        self.collections[path] = [version, own, None]
+        for _, entry in self.collections.walk(path):
+            entry[2] = None
+        return True
+
+    def inherited(self, path):
+        """The tags a timeseries at *path* inherits.  The dict is
+        shared, so callers must not modify it."""
+        path = PathTrie.split(path)
+        for i in xrange(len(path) - 1, -1, -1):
+            entry = self.collections.get(path[:i])
+            if entry is not None:
+                if entry[2] is None:
+                    entry[2] = dict(entry[1])
+                    entry[2].update(self.inherited(path[:i]))
+                return entry[2]
+        return {}
+
+    def tags(self, path, obj):
+        """The tags of the timeseries *obj* at *path*, with those it
+        inherits"""
+        rv = dict(self.inherited(path))
+        rv.update(self.flatten(obj))
+        return rv
+
 def pickle_load(filename):
     """Load an object from a gzipped pickle file while holding a
     filesystem lock
@@ -436,3 +847,26 @@ class RateLimiter:
             rv = self.method_if_disallowed(*args, **kwargs)
         return allowed, rv
 
+
+if __name__ == '__main__':
+    # compare the list-based and column-based reading buffers
+    import timeit
+
+    N = 5
+    READINGS = 100000
+
+    setup = """
+from __main__ import %s
+buf = %s(%i)
+for i in xrange(0, %i):
+    buf.append((i, float(i)))
+"""
+    for klass in ['FixedSizeList', 'ReadingBuffer']:
+        for size in [10, 1000, 10000, 100000]:
+            t = timeit.Timer(stmt="for i in xrange(0, %i): buf.append((i, float(i)))" % READINGS,
+                             setup=setup % (klass, klass, size, size))
+            print '%s(%i): append %0.03f usec/reading' % (
+                klass, size, 1e6 * t.timeit(number=N) / (N * READINGS))
+            t = timeit.Timer(stmt="list(buf)", setup=setup % (klass, klass, size, size))
+            print '%s(%i): read %0.03f msec/pass' % (
+                klass, size, 1000 * t.timeit(number=N * 10) / (N * 10))
@@ -61,6 +61,7 @@ class ArchiverServiceMaker(object):
     def makeService(self, options):
         if options['conf']:
             settings.conf = settings.load(options['conf'])
+            data.configure_caches()
 
         # we better add 
         reactor.suggestThreadPoolSize(settings.conf['threadpool size'])
@@ -95,6 +96,8 @@ class ArchiverServiceMaker(object):
             mongo_repub = republisher.MongoRepublisher(cp)
         else:
             mongo_repub = None
+        # and one ingest queue, since they can't share its log
+        ingest_queue = getIngestQueue(cp)
 
         service = MultiService()
         for svc in settings.conf['server']:
@@ -103,7 +106,8 @@ class ArchiverServiceMaker(object):
                            resources=scfg['resources'],
                            http_repub=http_repub, 
                            websocket_repub=websocket_repub,
-                           mongo_repub=mongo_repub)
+                           mongo_repub=mongo_repub,
+                           ingest_queue=ingest_queue)
 
             if not len(scfg['ssl']) > 1:
                 service.addService(internet.TCPServer(scfg['port'],
@@ -122,10 +126,10 @@ class ArchiverServiceMaker(object):
 # However, since this plugin gets installed for all smap installs,
 # just fail silently rather than print out a bunch of warnings.
 try:
-    from smap.archiver import settings, republisher
+    from smap.archiver import settings, republisher, data
     from smap.subscriber import subscribe
     from smap.ssl import SslServerContextFactory
-    from smap.archiver.server import getSite
+    from smap.archiver.server import getSite, getIngestQueue
 except ImportError:
     pass
 else: